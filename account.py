@@ -2,13 +2,62 @@ import base64
 import datetime
 import logging
 import random
-import time
+import threading
 import json
+from functools import wraps
 
+from clock import SystemClock, system_clock
 from hamster_kombat import HamsterKombatAPI, HamsterKombatUtils
-
-from utils import GamePromo, handle_error, BColors
+from ledger import DailyLedger
+from models import Boost, ClickerUser, Promo, Task, Upgrade, UpgradeTable
+from planner import UpgradePlanner
+from profiling import profiled
+from promo_keys import PromoKeyPool, get_promo_pool
+from resilience import get_guard
+from state import AccountState
+from storage import StateStore, get_store
+from tap_engine import TapEngine
+from transport import Transport
+
+from utils import handle_error, BColors
 import config
+import metrics
+
+
+_promo_games = None
+_promo_games_lock = threading.Lock()
+
+
+def load_supported_promos(store: StateStore = None) -> dict:
+    """`promo_games.json`, read once per process. The state store keeps a copy in case the file is gone."""
+    global _promo_games
+    with _promo_games_lock:
+        if _promo_games is None:
+            try:
+                with open(config.BASE_DIR / "promo_games.json", "r") as file:
+                    _promo_games = json.load(file)
+                if store is not None:
+                    store.save_catalog("promo_games", _promo_games)
+            except FileNotFoundError:
+                _promo_games = (store.load_catalog("promo_games") if store is not None else None) or {}
+        return _promo_games
+
+
+class AccountStopped(Exception):
+    """`Account.stop` was called while the account paused between two requests."""
+
+
+def flow(steps):
+    """
+    A method running the generator method `steps` with `_drive`. The generator yields each of its requests
+    and pauses, for `Account` they are done once yielded, `AsyncAccount` awaits them. Other steps run it
+    with `yield from`, so the decisions of an account are written once for both runners.
+    """
+    @wraps(steps)
+    def method(self, *args, **kwargs):
+        return self._drive(steps(self, *args, **kwargs))
+
+    return method
 
 
 class Account:
@@ -16,21 +65,22 @@ class Account:
     bearer_token: str
     user_agent: str
 
-    balance_coins: int
-    spend_tokens: int
+    spend_tokens: int = 0
     profit_per_hour: int
-    balance_keys: int
-    total_keys: int
 
-    available_taps: int
-    max_taps: int
-    earn_per_tap: int
+    planner: UpgradePlanner = None
+    next_daily_at: float = None
+    pending_mini_game: dict = None
+    # next wake-up of the loop, checkpointed so a restart resumes from it
+    wake_at: float = None
 
-    earn_passive_per_hour: int
-    _account_data: dict
+    state: AccountState
+    clock: SystemClock
+    clicker_user: ClickerUser = None
 
     max_card_price: int = 999_999_999_999
     target_balance: int
+    auto_upgrade_interval: int
     cooldown_after_auto_upgrade: int
 
     parallel_update: bool
@@ -47,23 +97,57 @@ class Account:
     # BIKE_RIDE_PROMO = "43e35910-c168-4634-ad4f-52fd764a843f"
     SUPPORTED_PROMO: dict
 
+    store: StateStore = None
+    promo_pool: PromoKeyPool
+    _config: dict = None
+    _config_at: float = None
+    _tg_data: dict = None
+    DAILY_JOBS = ("daily_cipher", "start_mini_game", "start_playground_game", "start_complete_tasks")
+
     utils = HamsterKombatUtils
 
+    # region state
+    @property
+    def balance_coins(self) -> int:
+        return self.state.projected_balance()
+
+    @property
+    def available_taps(self) -> int:
+        return self.state.projected_taps()
+
+    @property
+    def max_taps(self) -> int:
+        return self.state.max_taps
+
+    @property
+    def earn_per_tap(self) -> int:
+        return self.state.earn_per_tap
+
+    @property
+    def earn_passive_per_hour(self) -> int:
+        return self.state.earn_passive_per_hour
+
+    @property
+    def balance_keys(self) -> int:
+        return self.state.balance_keys
+
+    @property
+    def total_keys(self) -> int:
+        return self.state.total_keys
+    # endregion
+
     @property
     def min_profit_coefficient(self):
         return self.utils.profit_coefficient(price=self.target_balance - self.balance_coins,
                                              profit=self.earn_passive_per_hour)
 
     def log_account_info(self):
-        self.logger.info(f"""
-                    user name: {self.name},
-                    earn passive per hour: {self.earn_passive_per_hour},
-                    balance: {self.balance_coins},
-                    available taps: {self.available_taps},
-                    balance keys: {self.balance_keys},
-                """)
-
-    def __init__(self, name: str, bearer_token: str, user_agent: str, log_level: int = logging.INFO):
+        self.logger.info("user name: %s, earn passive per hour: %s, balance: %s, available taps: %s, balance keys: %s",
+                         self.name, self.earn_passive_per_hour, self.balance_coins, self.available_taps,
+                         self.balance_keys)
+
+    def __init__(self, name: str, bearer_token: str, user_agent: str, log_level: int = logging.INFO,
+                 clock: SystemClock = None, bootstrap: bool = True, transport: Transport = None):
         self.logger = logging.getLogger(f"HK_account_[{name}]")
         self.logger.setLevel(log_level)
 
@@ -73,11 +157,15 @@ class Account:
         self.bearer_token = f"Bearer {bearer_token}"
         self.user_agent = user_agent
 
-        self.api = HamsterKombatAPI(api_url=config.HK_API_URL, auth=self.bearer_token, user_agent=user_agent)
-        self.sync_account_data()
-
-        self.config = self.api.config()
-        self.tg_data = self.api.me_telegram()
+        self.clock = system_clock if clock is None else clock
+        # sends the requests instead of one opened from the config, e.g. a benchmark timing them
+        self.transport = transport
+        self.state = AccountState(sync_interval=config.SYNC_INTERVAL, drift_threshold=config.SYNC_DRIFT_THRESHOLD,
+                                  clock=self.clock)
+        self.tap_engine = TapEngine(self.state, min_fill=config.TAP_MIN_FILL, clock=self.clock)
+        self.store = get_store(config.STATE_DB)
+        self.ledger = DailyLedger(self.name, store=self.store, clock=self.clock)
+        self.api = self._create_api()
 
         self.auto_tap = config.AUTO_TAP
         self.auto_promos = config.AUTO_PROMOS
@@ -87,19 +175,179 @@ class Account:
         self.parallel_update = config.PARALLEL_UPDATE
         self.auto_task = config.AUTO_TASK
 
-        self.cooldown_after_auto_upgrade = config.COOLDOWN_AFTER_AUTO_UPGRADE
+        self.auto_upgrade_interval = config.COOLDOWN_AFTER_AUTO_UPGRADE
+        self.cooldown_after_auto_upgrade = self.auto_upgrade_interval
         self.target_balance = config.TARGET_BALANCE
 
-        with open("promo_games.json", "r") as file:
-            self.SUPPORTED_PROMO = json.load(file)
-
+        self.SUPPORTED_PROMO = load_supported_promos(self.store)
+        self.promo_pool = self._create_promo_pool()
+        self._stopped = threading.Event()
+
+        # the async runner can not do network calls from `__init__` and awaits `bootstrap` itself
+        if bootstrap:
+            self.bootstrap()
+
+    def _create_api(self) -> HamsterKombatAPI:
+        return HamsterKombatAPI(api_url=config.HK_API_URL, auth=self.bearer_token, user_agent=self.user_agent,
+                                pool_size=config.HTTP_POOL_SIZE, share_session=config.SHARE_HTTP_SESSION,
+                                use_preflight_cache=config.PREFLIGHT_CACHE,
+                                preflight_cache_ttl=config.PREFLIGHT_CACHE_TTL, clock=self.clock,
+                                account=self.name, guard=get_guard(config.HK_API_URL, clock=self.clock),
+                                http_transport=config.HTTP_TRANSPORT, cassette=config.HTTP_CASSETTE,
+                                cassette_mode=config.HTTP_CASSETTE_MODE, transport=self.transport,
+                                timeout=config.HTTP_TIMEOUT)
+
+    def _create_promo_pool(self) -> PromoKeyPool:
+        return get_promo_pool(self.store, clock=self.clock, transport=self.transport)
+
+    def _drive(self, steps):
+        """Run a step, its requests and pauses were done when it yielded them and the results are sent back."""
+        result = None
+        try:
+            while True:
+                result = steps.send(result)
+        except StopIteration as e:
+            return e.value
+
+    def _bootstrap(self):
+        """Rehydrate from the state store and fetch only what is missing or stale there."""
+        if not self._restore_account_data():
+            yield from self._sync_account_data()
+
+        # `config` and `tg_data` are loaded by the first daily jobs
+        self._restore_planner()
+        self._restore_schedule()
+        # keys a stopped run was still generating
+        self.promo_pool.resume(self.name)
         self.log_account_info()
 
+    bootstrap = flow(_bootstrap)
+
+    # region lazy data
+    # a step can not yield from a property, `load_lazy_data` fills these before the daily jobs read them
+    @property
+    def config(self) -> dict:
+        return self._config
+
+    @config.setter
+    def config(self, value: dict):
+        self._config = value
+        self._config_at = self.clock.time()
+        self._save_snapshot("config", value, updated_at=self._config_at)
+
+    @property
+    def tg_data(self) -> dict:
+        return self._tg_data
+
+    @tg_data.setter
+    def tg_data(self, value: dict):
+        self._tg_data = value
+        self._save_snapshot("tg_data", value)
+
+    def _load_lazy_data(self):
+        if self._config is None:
+            self._config, self._config_at = self._load_snapshot("config", max_age=config.CONFIG_SNAPSHOT_TTL,
+                                                                with_time=True)
+        if self._config is None:
+            self.config = yield self.api.config()
+
+        if self._tg_data is None:
+            self._tg_data = self._load_snapshot("tg_data")
+        if self._tg_data is None:
+            self.tg_data = yield self.api.me_telegram()
+
+    load_lazy_data = flow(_load_lazy_data)
+    # endregion
+
+    # region state store
+    def _save_snapshot(self, kind: str, data, updated_at: float = None):
+        if self.store is not None:
+            self.store.save_snapshot(self.name, kind, data, updated_at=updated_at)
+
+    def _load_snapshot(self, kind: str, max_age: float = None, with_time: bool = False):
+        data, updated_at = (None, None) if self.store is None else self.store.load_snapshot(self.name, kind, max_age)
+        return (data, updated_at) if with_time else data
+
+    def _restore_account_data(self) -> bool:
+        clicker_user, updated_at = self._load_snapshot("clicker_user", max_age=self.state.sync_interval,
+                                                       with_time=True)
+        if clicker_user is None:
+            return False
+        self.logger.info(f"account data restored from state store")
+        self.clicker_user = ClickerUser.from_dict(clicker_user)
+        self.state.apply(self.clicker_user, now=updated_at)
+        self.profit_per_hour = self.earn_passive_per_hour
+        return True
+
+    def _restore_planner(self):
+        upgrades, updated_at = self._load_snapshot("upgrades", max_age=config.CONFIG_SNAPSHOT_TTL, with_time=True)
+        if upgrades is None:
+            return
+        # cooldowns were relative to the snapshot time
+        elapsed = self.clock.time() - updated_at
+        upgrades = [
+            {**upgrade, "cooldownSeconds": max(0, upgrade.get("cooldownSeconds", 0) - elapsed)}
+            for upgrade in upgrades
+        ]
+        self.planner = self._update_planner({"upgradesForBuy": upgrades})
+
+    def _save_planner(self):
+        if self.planner is not None and self.store is not None:
+            self._save_snapshot("upgrades", self.planner.snapshot(), updated_at=self.planner.updated_at)
+
+    def _restore_schedule(self):
+        schedule = self._load_snapshot("schedule")
+        if schedule is not None:
+            self.next_daily_at = schedule.get("next_daily_at")
+            self.pending_mini_game = schedule.get("pending_mini_game")
+            self.wake_at = schedule.get("wake_at")
+            self.ledger.restore(schedule.get("reset_at"))
+
+    def _save_schedule(self):
+        self._save_snapshot("schedule", {"next_daily_at": self.next_daily_at,
+                                         "pending_mini_game": self.pending_mini_game,
+                                         "wake_at": self.wake_at, "reset_at": self.ledger.reset_at})
+
+    def checkpoint(self):
+        """Save where the loop is, the next start resumes from here."""
+        self._save_schedule()
+        self._save_planner()
+
+    def _pending_daily_jobs(self) -> list:
+        enabled = {
+            "daily_cipher": self.auto_daily_cipher,
+            "start_mini_game": self.auto_minigame,
+            "start_playground_game": self.auto_promos,
+            "start_complete_tasks": self.auto_task,
+        }
+        return [job for job in self.DAILY_JOBS if enabled[job] is True and not self.ledger.is_done(job)]
+
+    def _daily_job_kwargs(self, job: str) -> dict:
+        if job == "start_mini_game":
+            return {"tg_id": self.tg_data.get("telegramUser", {}).get("authUserId")}
+        return {}
+
+    def _record_daily_job(self, job: str, result):
+        self.ledger.record(job, result)
+    # endregion
+
     @handle_error
-    def sync_account_data(self):
+    def _sync_account_data(self):
         self.logger.info(f"sync account data")
-        account_data = self.api.sync()
+        return self._apply_account_data((yield self.api.sync()))
 
+    sync_account_data = flow(_sync_account_data)
+
+    def _refresh_account_data(self):
+        """Sync only when the local state has drifted too far, otherwise keep extrapolating it."""
+        if self.state.needs_sync():
+            return (yield from self._sync_account_data())
+        self.logger.info(f"using local account state, drift {self.state.drift():.2%}")
+        return self.clicker_user
+
+    refresh_account_data = flow(_refresh_account_data)
+
+    def _apply_account_data(self, account_data):
         if "clickerUser" not in account_data:
             self.logger.error(f"Invalid account data.")
             return False
@@ -108,174 +356,288 @@ class Account:
             self.logger.error(f"Invalid balance coins.")
             return False
 
-        self._account_data = account_data
-
-        self.balance_coins = account_data["clickerUser"]["balanceCoins"]
-        self.available_taps = account_data["clickerUser"]["availableTaps"]
-        self.max_taps = account_data["clickerUser"]["maxTaps"]
-        self.earn_per_tap = account_data["clickerUser"]["earnPerTap"]
-
-        self.earn_passive_per_hour = account_data["clickerUser"]["earnPassivePerHour"]
-
-        self.balance_keys = account_data["clickerUser"].get("balanceKeys", 0)
-        self.total_keys = account_data["clickerUser"].get("totalKeys", 0)
+        # only the fields in `ClickerUser` are kept, the rest of the response is dropped here
+        self.clicker_user = ClickerUser.from_dict(account_data["clickerUser"])
+        self.state.apply(self.clicker_user)
+        self._save_snapshot("clicker_user", self.clicker_user.to_dict(), updated_at=self.state.confirmed_at)
 
         self.spend_tokens = 0
         self.profit_per_hour = self.earn_passive_per_hour
 
-        return account_data
+        return self.clicker_user
+
+    def _run_taps(self) -> bool:
+        """
+        Tap once the energy is worth a request. When the free full energy boost is off cooldown the
+        energy is tapped, the boost taken and the refill tapped in the same run.
+        """
+        coins, requests = self.tap_engine.coins, self.tap_engine.requests
+        if self.tap_engine.needs_boost_check():
+            yield from self._check_free_boost()
+        if self.tap_engine.is_boost_ready():
+            if self.tap_engine.is_worth_tapping(before_boost=True):
+                yield from self._start_tap()
+            if (yield from self._boost_full_available_taps()):
+                yield from self._start_tap()
+            else:
+                self.tap_engine.boost_failed()
+        elif self.tap_engine.is_worth_tapping():
+            yield from self._start_tap()
+        return self._report_taps(coins, requests)
+
+    run_taps = flow(_run_taps)
+
+    def _report_taps(self, coins: int, requests: int) -> bool:
+        coins, requests = self.tap_engine.coins - coins, self.tap_engine.requests - requests
+        if requests:
+            self.logger.info("tapped %d coins in %d requests, %.0f coins per request since start",
+                             coins, requests, self.tap_engine.coins_per_request)
+            metrics.record_taps(self.name, coins, requests)
+        return requests > 0
 
     @handle_error
-    def boost_full_available_taps(self):
+    def _check_free_boost(self):
+        """Read the cooldown of the free full energy boost."""
         self.logger.info(f"checking for free tap boost")
 
-        boost_list = list(filter(
-            lambda x: x.get("price", -1) == 0 and x.get("id", "") == "BoostFullAvailableTaps",
-            self.api.boosts_to_buy_list()
-        ))
+        boost = self._free_full_taps_boost((yield self.api.boosts_to_buy_list()))
+        self.tap_engine.record()
+        self.tap_engine.update_boost(boost)
+        return boost
+
+    check_free_boost = flow(_check_free_boost)
+
+    @handle_error
+    def _boost_full_available_taps(self):
+        self.logger.info(f"free boost found, attempting to buy")
+        yield self._pause(random.randint(5, 15))
+        response = yield self.api.buy_boost(TapEngine.BOOST_ID)
+        self.tap_engine.record()
+        self._apply_boost(response)
+        self.logger.info(BColors.okblue(f"free boost bought successfully"))
+        return True
+
+    boost_full_available_taps = flow(_boost_full_available_taps)
+
+    def _apply_boost(self, response):
+        self._apply_mutation(response)
+        if isinstance(response, dict) and "boostsForBuy" in response:
+            self.tap_engine.update_boost(self._free_full_taps_boost(response))
+        else:
+            self.tap_engine.boost_used()
+
+    def _apply_mutation(self, response):
+        """Mutating endpoints return the updated `clickerUser`, apply it instead of syncing again."""
+        if isinstance(response, dict) and "clickerUser" in response:
+            spend_tokens = self.spend_tokens
+            self._apply_account_data(response)
+            self.spend_tokens = spend_tokens
+
+    def _free_full_taps_boost(self, boosts) -> Boost:
+        boost_list = [
+            boost for boost in Boost.from_list(boosts.get("boostsForBuy"))
+            if boost.price == 0 and boost.id == "BoostFullAvailableTaps"
+        ]
 
         if len(boost_list) < 1:
             self.logger.info(BColors.okblue(f"no free boosts available"))
-            return False
+            return None
 
-        boost = boost_list[0]
-        if boost.get("cooldownSeconds", 999999) == 0:
-            self.logger.info(f"free boost found, attempting to buy")
-            time.sleep(random.randint(5, 15))
-            self.api.buy_boost(boost["id"])
-            self.logger.info(BColors.okblue(f"free boost bought successfully"))
-            return True
+        return boost_list[0]
 
     @handle_error
-    def buy_card(self, card):
-        buy_card = self.api.buy_upgrade(card["id"])
-
-        cooldown_seconds = list(filter(lambda x: x["id"] == card["id"], buy_card["upgradesForBuy"]))[0]["cooldownSeconds"]
-        self.cooldown_after_auto_upgrade = min(self.cooldown_after_auto_upgrade, cooldown_seconds)
+    def _buy_card(self, card: Upgrade):
+        buy_card = yield self.api.buy_upgrade(card.id)
 
         if buy_card:
-            self.logger.info(BColors.okblue(f"card bought successfully"))
-            self.sync_account_data()
-            time.sleep(random.randint(3, 7))
-            # self.balance_coins -= card["price"]
-            # self.profit_per_hour += card["profitPerHourDelta"]
-            self.spend_tokens += card["price"]
-            # self.earn_passive_per_hour += card["profitPerHourDelta"]
-
-            return True
+            if not self._apply_bought_card(card, buy_card):
+                yield from self._sync_account_data()
+            yield self._pause(random.randint(3, 7))
+            return buy_card
         return False
 
+    buy_card = flow(_buy_card)
+
+    def _apply_bought_card(self, card: Upgrade, buy_card) -> bool:
+        """Apply the `buy-upgrade` response, returns False when it has no account data and a sync is needed."""
+        self._apply_card_cooldown(card, buy_card)
+        self.logger.info(BColors.okblue(f"card bought successfully"))
+
+        # buy-upgrade already returns the updated clickerUser, a separate sync is not needed
+        self._apply_mutation(buy_card)
+        self.spend_tokens += card.price
+        return "clickerUser" in buy_card
+
+    def _apply_card_cooldown(self, card: Upgrade, buy_card):
+        bought = next((x for x in buy_card.get("upgradesForBuy", []) if x["id"] == card.id), None)
+        if bought is not None:
+            self.cooldown_after_auto_upgrade = min(self.cooldown_after_auto_upgrade, bought.get("cooldownSeconds", 0))
+
     @handle_error
-    def buy_best_card(self):
+    def _buy_best_card(self):
         self.logger.info(f"checking for best card")
-        time.sleep(random.randint(2, 10))
-
-        upgrades = list(filter(
-            lambda x: not x["isExpired"] and x["isAvailable"] and x["profitPerHourDelta"] > 0
-                      and x["price"] <= self.max_card_price
-                      and self.utils.profit_coefficient(x["price"],
-                                                        x["profitPerHourDelta"]) >= self.min_profit_coefficient,
-            self.api.upgrades_for_buy().get("upgradesForBuy", [])
-        ))
-        upgrades.sort(
-                key=lambda x: self.utils.profit_coefficient(x["price"], x["profitPerHourDelta"]), reverse=True
-            )
+        yield self._pause(random.randint(2, 10))
 
-        self.logger.info(f"searching for the best upgrades")
-        if len(upgrades) == 0:
+        planner = self.planner = self._update_planner((yield self.api.upgrades_for_buy()))
+        if planner.next_purchase() is None:
             self.logger.warning(f"no upgrades available")
+            self._save_planner()
             return False
-        elif self.parallel_update:
-            upgrades = list(filter(lambda x: x.get("cooldownSeconds", 0) == 0, upgrades))
-        elif not self.parallel_update and upgrades[0].get("cooldownSeconds", 0) != 0:
-            self.logger.warning(BColors.warning(f"card is on cooldown"))
-            return False
 
-        for upgrade in upgrades:
-            if self.utils.profit_coefficient(upgrade["price"],
-                                             upgrade["profitPerHourDelta"]) >= self.min_profit_coefficient:
-                self.logger.info(
-                    f"best upgrade is {upgrade['name']} with profit "
-                    f"{upgrade['profitPerHourDelta']} and price {upgrade['price']}, Level: {upgrade['level']}"
-                )
-                if self.balance_coins < upgrade["price"]:
-                    self.logger.warning(BColors.warning(f"balance is too low to buy the best card."))
-                    return False
-                self.logger.info(f"attempting to buy the best card...")
-                if self.buy_card(upgrade):
-                    time.sleep(random.randint(10, 20))
-                    self.logger.info(BColors.okcyan(f"best card purchase completed successfully,"
-                                     f" Your profit per hour "
-                                     f"increased by {self.utils.number_to_string(self.profit_per_hour)}"
-                                     f" coins, Spend tokens: {self.utils.number_to_string(self.spend_tokens)}"))
+        while (upgrade := self._next_planned_card(planner)) is not None:
+            self.logger.info(f"attempting to buy the best card...")
+            buy_card = yield from self._buy_card(upgrade)
+            if not buy_card:
+                break
+            planner.apply_purchase(upgrade, buy_card)
+            yield self._pause(random.randint(10, 20))
+            self._log_card_purchase()
+
+        self._save_planner()
+        return True
+
+    buy_best_card = flow(_buy_best_card)
+
+    def _update_planner(self, upgrades_for_buy):
+        """The planner of the last cycle refreshed with `upgrades_for_buy`, a new one when the settings changed."""
+        self.logger.info(f"searching for the best upgrades")
+        upgrades = UpgradeTable.from_list(upgrades_for_buy.get("upgradesForBuy"))
+        planner = self.planner
+        if planner is not None and (planner.target_balance, planner.max_card_price, planner.parallel_update) == (
+                self.target_balance, self.max_card_price, self.parallel_update):
+            planner.refresh(upgrades, balance=self.balance_coins, earn_passive_per_hour=self.earn_passive_per_hour)
+        else:
+            planner = UpgradePlanner(
+                upgrades=upgrades,
+                balance=self.balance_coins,
+                earn_passive_per_hour=self.earn_passive_per_hour,
+                target_balance=self.target_balance,
+                max_card_price=self.max_card_price,
+                parallel_update=self.parallel_update,
+                lookahead=config.UPGRADE_LOOKAHEAD,
+                clock=self.clock,
+            )
+
+        if self.logger.isEnabledFor(logging.INFO):
+            plan = planner.plan()
+            self.logger.info("planned %d card purchases for %s coins", len(plan),
+                             self.utils.number_to_string(sum(upgrade.price for upgrade in plan)))
+        return planner
+
+    def _next_planned_card(self, planner: UpgradePlanner):
+        upgrade = planner.next_purchase()
+        if upgrade is None:
+            return None
+
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log_best_upgrade(upgrade, planner.unlocks(upgrade))
+        if self.balance_coins < upgrade.price:
+            self.logger.warning(BColors.warning(f"balance is too low to buy the best card."))
+            return None
+        return upgrade
+
+    def _log_best_upgrade(self, upgrade: Upgrade, unlocks: list = ()):
+        self.logger.info("best upgrade is %s with profit %s and price %s, Level: %s%s", upgrade.name,
+                         upgrade.profit_per_hour_delta, upgrade.price, upgrade.level,
+                         ", unlocks " + ", ".join(card.name for card in unlocks) if unlocks else "")
+
+    def _log_card_purchase(self):
+        self.logger.info(BColors.okcyan(f"best card purchase completed successfully,"
+                         f" Your profit per hour "
+                         f"increased by {self.utils.number_to_string(self.profit_per_hour)}"
+                         f" coins, Spend tokens: {self.utils.number_to_string(self.spend_tokens)}"))
+
+    @handle_error
+    def _start_mini_game(self, tg_id: str):
+        done, wait_time = self._mini_game_wait_time((yield self.api.start_keys_minigame()))
+        if done is not None:
+            return done
+
+        # the claim is not waited for here, `step` runs it once `next_wakeup` reaches the deadline
+        self.logger.info(f"Mini-game will be completed in {wait_time} seconds")
+        self.pending_mini_game = {"claim_at": self.clock.time() + wait_time, "wait_time": wait_time, "tg_id": tg_id}
+        self._save_schedule()
         return True
 
+    start_mini_game = flow(_start_mini_game)
+
     @handle_error
-    def start_mini_game(self, tg_id: str):
-        game_data = self.api.start_keys_minigame()
+    def _claim_mini_game(self):
+        pending, self.pending_mini_game = self.pending_mini_game, None
+        self._save_schedule()
+        yield self.api.claim_daily_keys_minigame(
+            cipher=self._mini_game_cipher(pending["wait_time"], pending["tg_id"])
+        )
+        self.logger.info(BColors.okblue(f"mini game claimed successfully."))
+        return True
+
+    claim_mini_game = flow(_claim_mini_game)
+
+    def _is_mini_game_due(self) -> bool:
+        return self.pending_mini_game is not None and self.pending_mini_game["claim_at"] <= self.clock.time()
+
+    def _mini_game_wait_time(self, game_data):
+        """Returns `(result, None)` when there is nothing to claim, otherwise `(None, seconds to wait)`."""
         if "dailyKeysMiniGame" not in game_data:
             self.logger.error(f"unable to get daily keys mini game.")
-            return False
+            return False, None
         elif "remainSecondsToGuess" not in game_data["dailyKeysMiniGame"]:
             self.logger.error(f"unable to get daily keys mini game.")
-            return False
+            return False, None
         elif game_data["dailyKeysMiniGame"]["isClaimed"] is True:
             self.logger.info(BColors.okblue(f"daily keys mini game already claimed."))
-            return True
+            return True, None
 
         wait_time = int(game_data["dailyKeysMiniGame"]["remainSecondsToGuess"] - random.randint(8, 15))
 
         if wait_time < 0:
             self.logger.error(f"unable to claim mini game.")
-            return
+            return False, None
 
-        self.logger.info(f"waiting for {wait_time} seconds, Mini-game will be completed in {wait_time} seconds")
-        time.sleep(wait_time)
+        return None, wait_time
 
+    @staticmethod
+    def _mini_game_cipher(wait_time: int, tg_id: str) -> str:
         cipher = ("0" + str(wait_time) + str(random.randint(10000000000, 99999999999)))[:10] + "|" + str(tg_id)
-        cipher_base64 = base64.b64encode(cipher.encode()).decode()
-        self.api.claim_daily_keys_minigame(cipher=cipher_base64)
-        self.logger.info(BColors.okblue(f"mini game claimed successfully."))
+        return base64.b64encode(cipher.encode()).decode()
 
     @handle_error
-    def start_playground_game(self):
+    def _start_playground_game(self):
+        """Hand today's missing keys to the promo key pool, they are applied by `apply_promo_keys` once ready."""
         self.logger.info(f"starting getting playground games")
 
-        promos = self.api.get_promos()
+        for promo_data, count in self._promo_keys_to_generate((yield self.api.get_promos())):
+            self.logger.info(BColors.okblue(f"queued {count} {promo_data.get('name', 'without_name')} keys."))
+            self.promo_pool.submit(self.name, self.user_agent, promo_data, count=count)
 
-        for promo in promos.get("promos", []):
-            self.complete_promo_game(promo=promo)
-
-        self.logger.info(BColors.okblue(f"playground games claimed successfully."))
+        return True
 
-    @handle_error
-    def complete_promo_game(self, promo):
-        if promo.get("promoId", "") in self.SUPPORTED_PROMO:
-            promo_data = self.SUPPORTED_PROMO[promo.get("promoId", "")]
-            self.logger.info(BColors.okblue(f"start getting key in {promo_data.get('name', 'without_name')} game."))
-
-            game_promo = GamePromo(user_agent=self.user_agent, app_token=promo_data["appToken"],
-                                   name=promo_data.get('name', 'without_name'))
-            time.sleep(random.randint(5, 15))
-            if game_promo.register_event(promo_id=promo.get("promoId"), max_retry=promo_data.get("maxRetry", 10),
-                                         delay=promo_data.get("delay", 120)) is True:
-
-                # time.sleep(random.randint(5, 15))
-                promo_code = game_promo.get_key(promo_id=promo.get("promoId"))
-                if promo_code is None:
-                    self.logger.error(
-                        f"unable to get {promo_data.get('name', 'without_name')} in Hamster FAM key."
-                    )
-                    return False
-
-                self.logger.info(f"key: {promo_code}")
-                time.sleep(random.randint(5, 15))
-                self.logger.info(f"claiming...")
-                self.api.apply_promo(promo_code=promo_code)
-                self.logger.info(BColors.okblue(
-                    f"playground {promo_data.get('name', 'without_name')} game claimed successfully."
-                ))
-                return True
+    start_playground_game = flow(_start_playground_game)
+
+    def _promo_keys_to_generate(self, promos) -> list:
+        to_generate = []
+        for promo in Promo.from_response(promos):
+            if promo.promo_id not in self.SUPPORTED_PROMO:
+                continue
+            count = promo.keys_per_day - promo.receive_keys_today - self.promo_pool.queued(self.name, promo.promo_id)
+            if count > 0:
+                to_generate.append(({"promoId": promo.promo_id, **self.SUPPORTED_PROMO[promo.promo_id]}, count))
+        return to_generate
+
+    def _apply_promo_keys(self):
+        for key in self.promo_pool.pending(self.name):
+            name = self.SUPPORTED_PROMO.get(key["promo_id"], {}).get("name", "without_name")
+            self.logger.info(f"claiming {name} key {key['code']}...")
+            try:
+                self._apply_mutation((yield self.api.apply_promo(promo_code=key["code"])))
+            except Exception as e:
+                self.logger.error(f"unable to apply {name} key: {e}")
+                self.promo_pool.mark_failed(self.name, key)
+                continue
+            self.promo_pool.mark_applied(self.name, key)
+            self.logger.info(BColors.okblue(f"playground {name} game claimed successfully."))
+
+    apply_promo_keys = flow(_apply_promo_keys)
 
     def check_play_ground_game_state(self, promo, promos):
         if not self.config["auto_playground_games"]:
@@ -295,99 +657,258 @@ class Account:
         return True
 
     @handle_error
-    def daily_cipher(self):
+    def _daily_cipher(self):
+        done, cipher = self._decode_daily_cipher()
+        if done is not None:
+            return done
+
+        yield self.api.claim_daily_cipher(cipher=cipher)
+        self.logger.info(BColors.okblue(f"successfully claimed daily cipher"))
+        return True
+
+    daily_cipher = flow(_daily_cipher)
+
+    def _decode_daily_cipher(self):
+        """Returns `(result, None)` when there is nothing to claim, otherwise `(None, decoded cipher)`."""
         self.logger.info(f"decoding daily cipher")
         cipher = self.config.get("dailyCipher", {}).get("cipher", None)
         if cipher is None:
-            return False
+            return False, None
         elif self.config.get("dailyCipher", {}).get("isClaimed", True):
             self.logger.info(BColors.okblue(f"daily cipher already claimed"))
-            return True
+            return True, None
         cipher = self.utils.daily_cipher_decode(cipher)
         self.logger.info(f"daily cipher: {cipher}")
-
-        self.api.claim_daily_cipher(cipher=cipher)
-        self.logger.info(BColors.okblue(f"successfully claimed daily cipher"))
-        return True
+        return None, cipher
 
     @handle_error
-    def start_tap(self):
+    def _start_tap(self):
         self.logger.info(f"Starting to tap")
-        time.sleep(random.randint(5, 15))
-        remains = self.available_taps - int(self.available_taps / self.earn_per_tap) * self.earn_per_tap
-        tap = self.api.tap(int(self.available_taps / self.earn_per_tap), remains)
+        yield self._pause(random.randint(5, 15))
+        count, available_taps = self._tap_args()
+        self._apply_mutation((yield self.api.tap(count, available_taps)))
+        self.tap_engine.record(coins=count * self.earn_per_tap)
         self.logger.info(BColors.okblue(f"Tapping completed successfully."))
         return True
 
+    start_tap = flow(_start_tap)
+
+    def _tap_args(self):
+        return self.tap_engine.tap_args()
+
     @handle_error
-    def completing_task(self, task):
-        self.logger.info(f"run {task['id']}")
-        if task["isCompleted"] is True:
-            self.logger.info(BColors.okblue(f"{task['id']} task already completed."))
+    def _completing_task(self, task: Task):
+        self.logger.info(f"run {task.id}")
+        if task.is_completed is True:
+            self.logger.info(BColors.okblue(f"{task.id} task already completed."))
             return True
         else:
-            self.logger.info(f"Attempting to complete {task['id']} task")
-            reward_coins = task["rewardCoins"]
-            time.sleep(random.randint(2, 10))
-            self.api.check_task(task_id=task['id'])
+            self.logger.info(f"Attempting to complete {task.id} task")
+            reward_coins = task.reward_coins
+            yield self._pause(random.randint(2, 10))
+            response = yield self.api.check_task(task_id=task.id)
+            checked = response.get("task") if isinstance(response, dict) else None
+            if not isinstance(checked, dict) or Task.from_dict(checked).is_completed is not True:
+                self.logger.error(f"failed to complete {task.id} task")
+                return False
+            self.ledger.task_finished(task.id)
             self.logger.info(BColors.okblue(
                 f"task completed successfully, Reward coins: {self.utils.number_to_string(reward_coins)}"
             ))
             return True
 
+    completing_task = flow(_completing_task)
+
     @handle_error
-    def start_complete_tasks(self):
+    def _start_complete_tasks(self):
         self.logger.info(f"start complete all available tasks")
 
-        tasks = self.api.list_tasks()
+        tasks = self._tasks_to_complete((yield self.api.list_tasks()))
+        if tasks is None:
+            return False
+
+        results = []
+        for task in tasks:
+            results.append((yield from self._completing_task(task)))
+        return all(results)
+
+    start_complete_tasks = flow(_start_complete_tasks)
+
+    def _tasks_to_complete(self, tasks):
         if not isinstance(tasks.get("tasks"), list):
             self.logger.error(f"failed get task list")
-            return False
+            return None
 
-        return all(list(map(
-            self.completing_task,
-            filter(lambda x: x.get("type", "") in ("WithLink", "WithLocaleLink", ) or x["id"] == "streak_days", tasks["tasks"])
-        )))
+        to_complete = []
+        for task in Task.from_list(tasks["tasks"]):
+            if task.type not in ("WithLink", "WithLocaleLink", ) and task.id != "streak_days":
+                continue
+            if task.is_completed is True:
+                self.ledger.task_finished(task.id)
+            elif not self.ledger.is_task_finished(task.id):
+                to_complete.append(task)
+        return to_complete
+
+    def close(self):
+        self.checkpoint()
+        self.api.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def start(self):
-        time.sleep(random.randint(60, 240))
+        with self:
+            self._start()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped.is_set()
+
+    def stop(self):
+        """
+        Let `start` return, a sleeping account at once and a running step at its next pause between
+        two requests, the request in flight is finished.
+        """
+        self._stopped.set()
+
+    def _pause(self, seconds: float):
+        if self.clock.wait(self._stopped, seconds):
+            # the step is repeated on the next start, the jobs it finished are not
+            self.wake_at = self.clock.time()
+            raise AccountStopped(self.name)
+
+    def first_wakeup(self) -> float:
+        """The wake-up checkpointed by the last run, or some time in the next few minutes on a first start."""
+        if self.wake_at is not None:
+            return self.wake_at
+        return self.clock.time() + random.randint(60, 240)
+
+    def _start(self):
+        if self.clock.wait(self._stopped, self.first_wakeup() - self.clock.time()):
+            return
         self.logger.info("Start account")
-        while True:
-            day = datetime.datetime.now().day
-            my_ip = self.api.ip()
-            self.logger.info(BColors.header(
-                f"account ip: {my_ip['ip']}; company: {my_ip['asn_org']}; country: {my_ip['country_code']}"
-            ))
+        while not self.stopped:
+            try:
+                self.step()
+            except AccountStopped:
+                break
+            except Exception as e:
+                # an error the retries could not help must not end the account thread
+                self.logger.error("step failed: %s", e, exc_info=True)
+                self.wake_at = self.clock.time() + config.MIN_WAKEUP_INTERVAL
+            self.clock.wait(self._stopped, self.wake_at - self.clock.time())
+        self.logger.info("Stop account")
+
+    def _step(self) -> float:
+        """Run whatever is due now and return the unix time this account should be woken up next."""
+        if self._is_daily_due():
+            yield from self._run_daily_jobs()
+        if self._is_mini_game_due():
+            yield from self._claim_mini_game()
+        if self.promo_pool.pending(self.name):
+            yield from self._apply_promo_keys()
+        yield from self._run_upgrade_cycle()
+
+        self.wake_at = wake_at = self.next_wakeup()
+        self._save_schedule()
+        self._export_metrics(wake_at)
+        self.logger.info(BColors.header("next auto update will be in %d seconds"), wake_at - self.clock.time())
+        return wake_at
+
+    step = profiled()(flow(_step))
+
+    def _run_daily_jobs(self):
+        if self.next_daily_at is not None:
+            self.config = yield self.api.config()
+        yield from self._load_lazy_data()
+        # the game day of the ledger ends with the daily cipher
+        self.ledger.observe_config(self.config, self._config_at)
+        self._log_ip((yield self.api.ip()))
+
+        for job in self._pending_daily_jobs():
+            self._record_daily_job(job, (yield from getattr(self, f"_{job}")(**self._daily_job_kwargs(job))))
+            yield self._pause(random.randint(10, 30))
+
+        self.next_daily_at = self._next_daily_time()
+        self._save_schedule()
+        self.ledger.prune(keep_days=config.STATE_KEEP_DAYS)
+        self.promo_pool.prune(self.name, keep_days=config.STATE_KEEP_DAYS)
+
+    run_daily_jobs = flow(_run_daily_jobs)
+
+    def _run_upgrade_cycle(self):
+        self.cooldown_after_auto_upgrade = self.auto_upgrade_interval
+        if not (yield from self._refresh_account_data()):
+            return
 
-            if self.auto_daily_cipher is True:
-                self.daily_cipher()
-                time.sleep(random.randint(10, 30))
-            if self.auto_minigame is True:
-                self.start_mini_game(tg_id=self.tg_data.get("telegramUser", {}).get("authUserId"))
-                time.sleep(random.randint(10, 30))
-            if self.auto_promos is True:
-                self.start_playground_game()
-                time.sleep(random.randint(10, 30))
-            if self.auto_task is True:
-                self.start_complete_tasks()
-                time.sleep(random.randint(10, 30))
+        if self.auto_tap is True and (yield from self._run_taps()):
+            yield self._pause(random.randint(10, 30))
 
-            while True:
-                self.cooldown_after_auto_upgrade = config.COOLDOWN_AFTER_AUTO_UPGRADE
-                if self.sync_account_data():
-                    if self.auto_upgrade is True:
-                        if self.auto_tap is True:
-                            self.start_tap()
-                            time.sleep(random.randint(10, 30))
-
-                        self.buy_best_card()
-
-                        self.log_account_info()
-                        self.logger.info(BColors.header(
-                            f"next auto update will be in {self.cooldown_after_auto_upgrade} seconds"
-                        ))
-                        time.sleep(self.cooldown_after_auto_upgrade)
-
-                if day != datetime.datetime.now().day and datetime.datetime.now().hour > random.randint(2, 13):
-                    self.config = self.api.config()
-                    break
+        if self.auto_upgrade is True and self._is_upgrade_due():
+            yield from self._buy_best_card()
+
+        self.log_account_info()
+
+    run_upgrade_cycle = flow(_run_upgrade_cycle)
+
+    def _is_upgrade_due(self) -> bool:
+        """
+        Whether `upgrades-for-buy` is worth a request on this wake-up: without a planner, once the planner
+        expects a card to be bought or after `auto_upgrade_interval` seconds. Tap and mini game wake-ups skip it.
+        """
+        planner = self.planner
+        if planner is None:
+            return True
+        now = self.clock.time()
+        if now - planner.updated_at >= self.auto_upgrade_interval:
+            return True
+        seconds = planner.seconds_until_next_purchase()
+        return seconds is not None and planner.updated_at + seconds <= now
+
+    def next_wakeup(self) -> float:
+        """
+        The earliest of: daily reset, pending mini game claim, taps refilled or the free boost ready,
+        the best card off cooldown and affordable. Never later than `cooldown_after_auto_upgrade`.
+        """
+        now = self.clock.time()
+        candidates = [now + self.cooldown_after_auto_upgrade]
+        if self.next_daily_at is not None:
+            candidates.append(self.next_daily_at)
+        if self.pending_mini_game is not None:
+            candidates.append(self.pending_mini_game["claim_at"])
+        if self.auto_tap is True and (tap_at := self.tap_engine.next_tap_at(now)) is not None:
+            candidates.append(tap_at)
+        if self.auto_upgrade is True and self.planner is not None:
+            seconds = self.planner.seconds_until_next_purchase()
+            if seconds is not None:
+                candidates.append(self.planner.updated_at + seconds)
+
+        return max(min(candidates), now + config.MIN_WAKEUP_INTERVAL)
+
+    def _export_metrics(self, wake_at: float):
+        metrics.set_account_gauges(
+            self.name, balance_coins=self.balance_coins, earn_passive_per_hour=self.earn_passive_per_hour,
+            available_taps=self.available_taps, spend_tokens=self.spend_tokens, next_wakeup_timestamp=wake_at,
+        )
+
+    def _is_daily_due(self) -> bool:
+        return self.next_daily_at is None or self.next_daily_at <= self.clock.time()
+
+    def _next_daily_time(self) -> float:
+        """
+        Some random time in the first three hours of the next game day, or, while the server's reset
+        is unknown, some random hour between 3 and 14 o'clock of the next day.
+        """
+        if (reset_at := self.ledger.reset_at) is not None:
+            return reset_at + random.randint(10 * 60, 3 * 3600)
+        tomorrow = self.clock.today() + datetime.timedelta(days=1)
+        return (datetime.datetime.combine(tomorrow, datetime.time())
+                + datetime.timedelta(hours=random.randint(3, 14), minutes=random.randint(0, 59))).timestamp()
+
+    def _log_ip(self, my_ip):
+        self.logger.info(BColors.header(
+            f"account ip: {my_ip['ip']}; company: {my_ip['asn_org']}; country: {my_ip['country_code']}"
+        ))
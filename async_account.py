@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import random
+import signal
+
+from account import Account, AccountStopped
+from async_client import AsyncGamePromo, AsyncHamsterKombatAPI, SharedAsyncSessions
+from bootstrap import bootstrap_accounts_async
+from clock import SystemClock
+from profiling import profiled
+from promo_keys import PromoKeyPool
+from resilience import get_guard
+from storage import StateStore
+from utils import BColors
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPromoKeyPool(PromoKeyPool):
+    """`PromoKeyPool` generating keys as tasks on the running event loop, at most `workers` at once."""
+
+    def __init__(self, store: StateStore = None, workers: int = 4, clock: SystemClock = None):
+        super().__init__(store=store, workers=workers, clock=clock)
+        self._semaphore = None
+        self._tasks = set()
+
+    def submit(self, account: str, user_agent: str, promo_data: dict, count: int = 1):
+        if self._stopped.is_set():
+            return
+        self._reserve(account, user_agent, promo_data, count)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        task = asyncio.get_running_loop().create_task(self._generate(account, user_agent, promo_data, count))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _generate(self, account: str, user_agent: str, promo_data: dict, count: int):
+        promo_id = promo_data["promoId"]
+        try:
+            async with self._semaphore:
+                logger.info(BColors.okblue(
+                    f"[{account}] start getting key in {promo_data.get('name', 'without_name')} game."
+                ))
+                async with self._game_promo(account, user_agent, promo_data,
+                                            game_promo_class=AsyncGamePromo) as game_promo:
+                    for _ in range(count):
+                        await self.clock.sleep_async(random.randint(5, 15))
+                        try:
+                            if await game_promo.register_event(promo_id=promo_id,
+                                                               max_retry=promo_data.get("maxRetry", 10),
+                                                               delay=promo_data.get("delay", 120)) is not True:
+                                return
+                            self._store_key(account, promo_data, await game_promo.get_key(promo_id=promo_id))
+                        finally:
+                            self._release(account, promo_id, 1)
+                            count -= 1
+        except Exception as e:
+            logger.error(f"[{account}] unable to get promo key: {e}", exc_info=True)
+        finally:
+            self._release(account, promo_id, count)
+
+    def shutdown(self, wait: bool = True):
+        for task in list(self._tasks):
+            task.cancel()
+
+
+_async_pool = None
+
+
+def get_async_promo_pool(store: StateStore = None, clock: SystemClock = None) -> AsyncPromoKeyPool:
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = AsyncPromoKeyPool(store=store, workers=config.PROMO_WORKERS, clock=clock)
+    return _async_pool
+
+
+class AsyncAccount(Account):
+    """
+    `Account` for the asyncio runner. The steps are the ones of `Account`, `_drive` awaits the requests
+    and pauses they yield, only the loop, the pauses and closing are redefined as coroutines.
+
+    Create it with `await AsyncAccount.create(...)`.
+    """
+    api: AsyncHamsterKombatAPI
+    _stopped_async: asyncio.Event = None
+
+    def __init__(self, name: str, bearer_token: str, user_agent: str, log_level: int = logging.INFO,
+                 clock: SystemClock = None):
+        super().__init__(name=name, bearer_token=bearer_token, user_agent=user_agent, log_level=log_level,
+                         clock=clock, bootstrap=False)
+
+    @classmethod
+    async def create(cls, name: str, bearer_token: str, user_agent: str, log_level: int = logging.INFO,
+                     clock: SystemClock = None):
+        account = cls(name=name, bearer_token=bearer_token, user_agent=user_agent, log_level=log_level, clock=clock)
+        await account.bootstrap()
+        return account
+
+    def _create_api(self) -> AsyncHamsterKombatAPI:
+        return AsyncHamsterKombatAPI(api_url=config.HK_API_URL, auth=self.bearer_token, user_agent=self.user_agent,
+                                     pool_size=config.HTTP_POOL_SIZE, share_session=config.SHARE_HTTP_SESSION,
+                                     use_preflight_cache=config.PREFLIGHT_CACHE,
+                                     preflight_cache_ttl=config.PREFLIGHT_CACHE_TTL, clock=self.clock,
+                                     account=self.name, guard=get_guard(config.HK_API_URL, clock=self.clock),
+                                     timeout=config.HTTP_TIMEOUT)
+
+    def _create_promo_pool(self) -> AsyncPromoKeyPool:
+        return get_async_promo_pool(self.store, clock=self.clock)
+
+    async def _drive(self, steps):
+        """Run a step on the event loop, a failed request is raised in the step at its `yield`."""
+        send, result = steps.send, None
+        while True:
+            try:
+                awaitable = send(result)
+            except StopIteration as e:
+                return e.value
+            try:
+                send, result = steps.send, await awaitable
+            except Exception as e:
+                send, result = steps.throw, e
+
+    async def close(self):
+        self.checkpoint()
+        await self.api.close()
+
+    async def start(self):
+        try:
+            await self._start()
+        finally:
+            await self.close()
+
+    def _stopped_event(self) -> asyncio.Event:
+        # created on the running loop, `__init__` may run outside of it
+        if self._stopped_async is None:
+            self._stopped_async = asyncio.Event()
+            if self.stopped:
+                self._stopped_async.set()
+        return self._stopped_async
+
+    def stop(self):
+        super().stop()
+        if self._stopped_async is not None:
+            self._stopped_async.set()
+
+    async def _pause(self, seconds: float):
+        if await self.clock.wait_async(self._stopped_event(), seconds):
+            self.wake_at = self.clock.time()
+            raise AccountStopped(self.name)
+
+    async def _start(self):
+        if await self.clock.wait_async(self._stopped_event(), self.first_wakeup() - self.clock.time()):
+            return
+        self.logger.info("Start account")
+        while not self.stopped:
+            try:
+                await self.step()
+            except AccountStopped:
+                break
+            except Exception as e:
+                self.logger.error("step failed: %s", e, exc_info=True)
+                self.wake_at = self.clock.time() + config.MIN_WAKEUP_INTERVAL
+            await self.clock.wait_async(self._stopped_event(), self.wake_at - self.clock.time())
+        self.logger.info("Stop account")
+
+    @profiled()
+    async def step(self) -> float:
+        return await self._drive(self._step())
+
+
+async def create_account(account_data: dict) -> AsyncAccount:
+    return await AsyncAccount.create(
+        name=account_data["name"],
+        bearer_token=account_data["bear_token"],
+        user_agent=account_data["user_agent"],
+    )
+
+
+async def run_accounts(accounts_data: list, registry=None):
+    """
+    Bootstrap the accounts concurrently and run each on the current event loop as soon as it is ready.
+    With a `registry` accounts added to its file are started and removed ones stopped while running.
+    Until SIGTERM or SIGINT, then every account is stopped at its next pause and checkpointed.
+    """
+    # account name -> the task running it, until it ended
+    accounts, tasks = {}, {}
+    stopping = asyncio.Event()
+
+    def start(account: AsyncAccount):
+        accounts[account.name] = account
+        task = tasks[account.name] = asyncio.create_task(account.start(), name=account.name)
+        task.add_done_callback(lambda done: tasks.pop(account.name) if tasks.get(account.name) is done else None)
+        if stopping.is_set():
+            # closed by its task right away
+            account.stop()
+
+    async def add(added: list):
+        # a changed account starts again once its old instance wrote its last checkpoint
+        stopped = [tasks[account_data["name"]] for account_data in added if account_data["name"] in tasks]
+        await asyncio.gather(*stopped, return_exceptions=True)
+        await bootstrap_accounts_async(added, create_account=create_account, on_ready=start,
+                                       concurrency=config.BOOTSTRAP_CONCURRENCY, rate=config.BOOTSTRAP_RATE)
+
+    def remove(names: list):
+        for name in names:
+            if (account := accounts.pop(name, None)) is not None:
+                account.stop()
+
+    def shutdown(signum: signal.Signals):
+        logger.info(f"{signum.name} received, stopping the accounts")
+        for default in (signal.SIGTERM, signal.SIGINT):
+            # a second signal ends the process right away
+            loop.remove_signal_handler(default)
+        stopping.set()
+        remove(list(accounts))
+        if _async_pool is not None:
+            _async_pool.stop()
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, shutdown, signum)
+        except NotImplementedError:  # pragma: no cover - windows event loops
+            pass
+
+    watcher = None
+    try:
+        await add(accounts_data)
+        if registry is not None:
+            watcher = asyncio.create_task(registry.watch_async(on_add=add, on_remove=remove), name="registry")
+        await stopping.wait()
+        if watcher is not None:
+            watcher.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+    finally:
+        await SharedAsyncSessions.close_all()
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+from hamster_kombat import APIError, HamsterKombatAPI, RequestTemplate, parse_retry_after
+from profiling import profiled
+from transport import DEFAULT_TIMEOUT
+from utils import GamePromo
+import metrics
+import models
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_async_session(pool_size: int = 10, cookies: bool = True,
+                         timeout: float = DEFAULT_TIMEOUT) -> aiohttp.ClientSession:
+    """
+    Create a keep-alive aiohttp session limited to `pool_size` open connections.
+    Without `cookies` it ignores every `Set-Cookie`, for a session every account sends through.
+    """
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size),
+                                 cookie_jar=None if cookies else aiohttp.DummyCookieJar(),
+                                 timeout=aiohttp.ClientTimeout(connect=timeout, sock_read=timeout))
+
+
+class SharedAsyncSessions:
+    """Event loop wide sessions keyed by host, the asyncio counterpart of `hamster_kombat.SharedSessions`."""
+    _sessions: dict = {}
+
+    @classmethod
+    def get(cls, host: str, pool_size: int = 10, timeout: float = DEFAULT_TIMEOUT) -> aiohttp.ClientSession:
+        session = cls._sessions.get(host)
+        if session is None or session.closed:
+            session = create_async_session(pool_size=pool_size, cookies=False, timeout=timeout)
+            cls._sessions[host] = session
+        return session
+
+    @classmethod
+    async def close_all(cls):
+        for session in cls._sessions.values():
+            await session.close()
+        cls._sessions.clear()
+
+
+class AsyncSessionMixin:
+    """
+    Lazily opens the aiohttp session, it has to be created inside the running event loop.
+    Endpoint methods of the sync clients return whatever `_request` returns, so with an async `_request`
+    every endpoint of `HamsterKombatAPI` becomes awaitable without being redefined.
+    """
+    URL: str
+    TRANSPORT_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+    CONNECT_ERRORS = (aiohttp.ClientConnectorError,)
+
+    def _init_session(self, session, share_session: bool, pool_size: int, timeout: float = DEFAULT_TIMEOUT,
+                      **transport_options):
+        # aiohttp is the only transport of the async clients
+        self._owns_session = session is None and not share_session
+        self._share_session = share_session
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self.session = session
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._share_session:
+            return SharedAsyncSessions.get(host=self.URL, pool_size=self._pool_size, timeout=self._timeout)
+        if self.session is None:
+            self.session = create_async_session(pool_size=self._pool_size, timeout=self._timeout)
+        return self.session
+
+    async def close(self):
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _send(self, log, template: RequestTemplate, data: dict = None):
+        session = self._get_session()
+
+        # region send option request
+        if template.needs_preflight():
+            started = time.perf_counter()
+            async with session.options(template.url, headers=template.option_headers) as response:
+                content = await response.read()
+                metrics.record_request(self.account, template.path, "preflight", time.perf_counter() - started,
+                                       response.status, received=len(content))
+                if not response.ok:
+                    log.error("Failed OPTION request for '%s' Status code is not 204, Response: %s",
+                              template.path, content.decode(errors="replace"),
+                              extra={"path": template.path, "method": template.method, "account": self.account})
+                    metrics.record_error(self.account, template.path)
+                    raise APIError(url=template.url, method="option", status=response.status,
+                                   headers=dict(template.option_headers),
+                                   retry_after=parse_retry_after(response.headers.get("Retry-After")))
+                template.store_preflight(response.headers)
+        # endregion
+
+        # region request
+        body = template.encode(data)
+        started = time.perf_counter()
+        async with session.request(template.method, template.url, headers=template.request_headers,
+                                   data=body) as response:
+            content = await response.read()
+            metrics.record_request(self.account, template.path, "request", time.perf_counter() - started,
+                                   response.status, sent=len(body or ""), received=len(content))
+            if not response.ok:
+                log.error("Failed '%s' request for '%s' Status code is not ok, Response: %s",
+                          template.method, template.path, content.decode(errors="replace"),
+                          extra={"path": template.path, "method": template.method, "data": data,
+                                 "account": self.account})
+                metrics.record_error(self.account, template.path)
+                raise APIError(url=template.url, method=template.method, status=response.status,
+                               headers=dict(template.request_headers), data=data,
+                               retry_after=parse_retry_after(response.headers.get("Retry-After")))
+            return models.loads(content) if content.strip() else None
+        # endregion
+
+
+class AsyncHamsterKombatAPI(AsyncSessionMixin, HamsterKombatAPI):
+    """`HamsterKombatAPI` on aiohttp, every endpoint method returns a coroutine."""
+
+    @profiled("account")
+    async def _request(self, method: str, path: str, headers: dict = None, data: dict = None):
+        template = self._get_template(method=method, path=path, has_body=data is not None, headers=headers)
+        if self.guard is None:
+            return await self._send(logger, template, data=data)
+        return await self.guard.call_async(lambda: self._send(logger, template, data=data), template,
+                                           clock=self.clock, transport_errors=self.TRANSPORT_ERRORS,
+                                           connect_errors=self.CONNECT_ERRORS, account=self.account)
+
+
+class AsyncGamePromo(AsyncSessionMixin, GamePromo):
+    """`GamePromo` on aiohttp, logs in on `__aenter__` instead of `__init__`."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs["auto_login"] = False
+        super().__init__(*args, **kwargs)
+
+    async def __aenter__(self):
+        self.client_token = await self.authorize()
+        return self
+
+    @profiled("account")
+    async def _request(self, method: str, path: str, headers: dict = None, data: dict = None, auth: str = None):
+        template = self._get_template(method=method, path=path, has_body=data is not None, headers=headers,
+                                      auth=auth)
+        if self.guard is None:
+            return await self._send(self.logger, template, data=data)
+        return await self.guard.call_async(lambda: self._send(self.logger, template, data=data), template,
+                                           clock=self.clock, transport_errors=self.TRANSPORT_ERRORS,
+                                           connect_errors=self.CONNECT_ERRORS, account=self.account)
+
+    async def authorize(self):
+        token = self._cached_token()
+        if token is None:
+            token = await self.login(app_token=self.app_token)
+            self._cache_token(token)
+        return token
+
+    async def _auth_request(self, path: str, data: dict):
+        try:
+            return await self._request(method="POST", path=path, headers=None, data=data, auth=self.client_token)
+        except APIError as e:
+            if not self._is_auth_error(e):
+                raise
+            self.logger.info(f"client token rejected, login again")
+            metrics.record_retry(self.account, path)
+            self._drop_token()
+            self.client_token = await self.authorize()
+            return await self._request(method="POST", path=path, headers=None, data=data, auth=self.client_token)
+
+    async def login(self, app_token: str):
+        self.logger.info(f"login to BikeRide")
+        result = await self._request(method="POST", path="promo/login-client", headers=None,
+                                     data=self._login_data(app_token), auth=None)
+        return self._parse_login(result)
+
+    async def register_event(self, promo_id: str, max_retry: int = 10, delay: int = 120):
+        path = "promo/register-event"
+        retry_count = 0
+        result = None
+
+        while retry_count <= max_retry:
+            retry_count += 1
+
+            try:
+                result = await self._auth_request(path=path, data=self._register_event_data(promo_id))
+            except Exception as e:
+                self.logger.error(f"Failed register event", exc_info=True)
+                result = None
+
+            if not self._has_code(result):
+                await self.clock.sleep_async(delay + random.randint(5, 15))
+                metrics.record_retry(self.account, path)
+                continue
+            break
+
+        return self._parse_register_event(result)
+
+    async def get_key(self, promo_id: str):
+        self.logger.info(f"getting key...")
+        result = await self._auth_request(path="promo/create-code", data={"promoId": promo_id})
+        return self._parse_key(result)
@@ -0,0 +1,342 @@
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+PROMO_GAMES = Path(__file__).resolve().parent.parent / "promo_games.json"
+
+
+class Player:
+    """Game state of one bearer token, passive income and taps are computed lazily like the real game."""
+    MAX_PASSIVE_HOURS = 3
+
+    def __init__(self, upgrades: list, now: float):
+        self.balance = 1_000_000
+        self.balance_keys = 0
+        self.taps = 500
+        self.max_taps = 1500
+        self.earn_per_tap = 1
+        self.taps_recover_per_sec = 3
+        self.earn_passive_per_hour = 1000
+        self.synced_at = now
+        self.upgrades = {upgrade["id"]: {"level": 1, "cooldown_until": 0} for upgrade in upgrades}
+        self.full_taps_boost_until = 0
+        self.completed_tasks = set()
+        self.cipher_claimed = False
+        self.mini_game_started_at = None
+        self.mini_game_claimed = False
+        self.keys_today = {}
+        self.day = int(now // 86400)
+        self.lock = threading.Lock()
+
+    def sync(self, now: float):
+        if int(now // 86400) != self.day:
+            self.day = int(now // 86400)
+            self.cipher_claimed = self.mini_game_claimed = False
+            self.completed_tasks.discard("streak_days")
+            self.keys_today = {}
+
+        elapsed = max(0.0, now - self.synced_at)
+        self.balance += int(self.earn_passive_per_hour * min(elapsed / 3600, self.MAX_PASSIVE_HOURS))
+        self.taps = min(self.max_taps, int(self.taps + self.taps_recover_per_sec * elapsed))
+        self.synced_at = now
+
+    def clicker_user(self) -> dict:
+        return {
+            "balanceCoins": self.balance,
+            "availableTaps": self.taps,
+            "maxTaps": self.max_taps,
+            "earnPerTap": self.earn_per_tap,
+            "tapsRecoverPerSec": self.taps_recover_per_sec,
+            "earnPassivePerHour": self.earn_passive_per_hour,
+            "balanceKeys": self.balance_keys,
+            "totalKeys": self.balance_keys,
+            "lastSyncUpdate": int(self.synced_at),
+        }
+
+
+class GameServer:
+    """
+    Stand-in for `api.hamsterkombatgame.io` and `api.gamepromo.io` on one port.
+
+    Every endpoint used by `HamsterKombatAPI` and `GamePromo` is served from in-memory game state per
+    bearer token, with card levels (price and profit grow by `price_growth` and `profit_growth` per
+    level), cooldowns, cards locked until another card is owned at a level, boosts, tasks, the daily
+    cipher, the keys mini game and promo codes. `latency` (seconds, uniformly jittered by half),
+    `error_rate` (HTTP 500) and `rate_limit_rate` (HTTP 429 with `Retry-After`) make the network less friendly. `clock` is the
+    `time` stand-in of the benchmark, so cooldowns follow the compressed time of the bot.
+    """
+    COOLDOWN_EVERY = 5
+    LOCKED_EVERY = 7
+    CIPHER = "HAMSTER"
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: int = 1, events_per_code: int = 2, clock=time, seed: int = 1, cards: int = 60,
+                 price_growth: float = 1.5, profit_growth: float = 1.07, cooldown: int = 3600):
+        self.price_growth = price_growth
+        self.profit_growth = profit_growth
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.events_per_code = events_per_code
+        self.clock = clock
+
+        rnd = random.Random(seed)
+        self.upgrades = [
+            {
+                "id": f"card_{i}",
+                "name": f"card {i}",
+                "section": "Markets",
+                "price": rnd.randint(1_000, 5_000_000),
+                "profitPerHourDelta": rnd.randint(10, 5_000),
+                "cooldown": cooldown if i % self.COOLDOWN_EVERY == 0 else 0,
+            }
+            for i in range(cards)
+        ]
+        # drawn after the cards, their prices and profits stay the same for a seed
+        for i in range(self.LOCKED_EVERY - 1, cards, self.LOCKED_EVERY):
+            self.upgrades[i]["condition"] = {"_type": "ByUpgrade", "upgradeId": f"card_{rnd.randrange(i)}",
+                                             "level": rnd.randint(1, 3)}
+        try:
+            with open(PROMO_GAMES, "r") as file:
+                self.promo_ids = list(json.load(file))
+        except FileNotFoundError:
+            self.promo_ids = []
+
+        self.players = {}
+        self.promo_tokens = {}
+        self.promo_codes = {}
+        self._lock = threading.Lock()
+
+    def player(self, token: str) -> Player:
+        with self._lock:
+            if token not in self.players:
+                self.players[token] = Player(self.upgrades, self.clock.time())
+            return self.players[token]
+
+    # region hamster kombat
+    @staticmethod
+    def is_unlocked(player: Player, upgrade: dict) -> bool:
+        condition = upgrade.get("condition")
+        # `level` is the one the next purchase buys, a card is owned one below it
+        return condition is None or player.upgrades[condition["upgradeId"]]["level"] - 1 >= condition["level"]
+
+    def upgrades_for_buy(self, player: Player, now: float) -> list:
+        upgrades = []
+        for upgrade in self.upgrades:
+            state = player.upgrades[upgrade["id"]]
+            upgrades.append({
+                "id": upgrade["id"],
+                "name": upgrade["name"],
+                "section": upgrade["section"],
+                "level": state["level"],
+                "price": int(upgrade["price"] * self.price_growth ** (state["level"] - 1)),
+                "profitPerHourDelta": int(upgrade["profitPerHourDelta"] * self.profit_growth ** (state["level"] - 1)),
+                "isAvailable": self.is_unlocked(player, upgrade),
+                "condition": upgrade.get("condition"),
+                "isExpired": False,
+                "cooldownSeconds": max(0, int(state["cooldown_until"] - now)),
+            })
+        return upgrades
+
+    def clicker(self, action: str, player: Player, data: dict, now: float):
+        player.sync(now)
+
+        if action in ("sync", "tap", "buy-upgrade", "buy-boost", "apply-promo"):
+            if action == "tap":
+                count = min(int(data.get("count", 0)), player.taps // player.earn_per_tap)
+                player.taps -= count * player.earn_per_tap
+                player.balance += count * player.earn_per_tap
+            elif action == "buy-upgrade":
+                card = next((x for x in self.upgrades_for_buy(player, now) if x["id"] == data.get("upgradeId")), None)
+                if card is None:
+                    return 400, {"error_code": "UPGRADE_NOT_FOUND"}
+                if not card["isAvailable"]:
+                    return 400, {"error_code": "UPGRADE_NOT_AVAILABLE"}
+                if card["cooldownSeconds"] > 0:
+                    return 400, {"error_code": "UPGRADE_COOLDOWN"}
+                if card["price"] > player.balance:
+                    return 400, {"error_code": "INSUFFICIENT_FUNDS"}
+                player.balance -= card["price"]
+                player.earn_passive_per_hour += card["profitPerHourDelta"]
+                state = player.upgrades[card["id"]]
+                state["level"] += 1
+                cooldown = next(x["cooldown"] for x in self.upgrades if x["id"] == card["id"])
+                state["cooldown_until"] = now + cooldown
+            elif action == "buy-boost":
+                if data.get("boostId") != "BoostFullAvailableTaps" or player.full_taps_boost_until > now:
+                    return 400, {"error_code": "BOOST_COOLDOWN"}
+                player.taps = player.max_taps
+                player.full_taps_boost_until = now + 3600
+            elif action == "apply-promo":
+                promo_id = self.promo_codes.pop(data.get("promoCode"), None)
+                if promo_id is None:
+                    return 400, {"error_code": "PROMO_CODE_INVALID"}
+                player.keys_today[promo_id] = player.keys_today.get(promo_id, 0) + 1
+                player.balance_keys += 1
+
+            response = {"clickerUser": player.clicker_user()}
+            if action == "buy-upgrade":
+                response["upgradesForBuy"] = self.upgrades_for_buy(player, now)
+            return 200, response
+
+        if action == "upgrades-for-buy":
+            return 200, {"upgradesForBuy": self.upgrades_for_buy(player, now), "sections": []}
+        if action == "boosts-for-buy":
+            return 200, {"boostsForBuy": [{
+                "id": "BoostFullAvailableTaps", "price": 0,
+                "cooldownSeconds": max(0, int(player.full_taps_boost_until - now)),
+            }]}
+        if action == "list-tasks":
+            return 200, {"tasks": [
+                {"id": task_id, "type": "WithLink", "rewardCoins": 1000, "isCompleted": task_id in player.completed_tasks}
+                for task_id in ("streak_days", "subscribe_channel", "follow_x")
+            ]}
+        if action == "list-airdrop-tasks":
+            return 200, {"airdropTasks": []}
+        if action == "check-task":
+            player.completed_tasks.add(data.get("taskId"))
+            player.balance += 1000
+            return 200, {"task": {"id": data.get("taskId"), "isCompleted": True}}
+        if action == "config":
+            cipher = base64.b64encode(self.CIPHER.encode()).decode()
+            return 200, {
+                "dailyCipher": {"cipher": cipher[:3] + "A" + cipher[3:], "isClaimed": player.cipher_claimed,
+                                "remainSeconds": 86400 - int(now % 86400)},
+                "dailyKeysMiniGame": {"isClaimed": player.mini_game_claimed, "remainSecondsToGuess": 30},
+            }
+        if action == "claim-daily-cipher":
+            if data.get("cipher") != self.CIPHER:
+                return 400, {"error_code": "DAILY_CIPHER_DOUBLE_CLAIMED"}
+            player.cipher_claimed = True
+            return 200, {"clickerUser": player.clicker_user()}
+        if action == "start-keys-minigame":
+            player.mini_game_started_at = now
+            return 200, {"dailyKeysMiniGame": {"isClaimed": player.mini_game_claimed, "remainSecondsToGuess": 30}}
+        if action == "claim-daily-keys-minigame":
+            player.mini_game_claimed = True
+            player.balance_keys += 1
+            return 200, {"clickerUser": player.clicker_user()}
+        if action == "get-promos":
+            return 200, {
+                "promos": [{"promoId": promo_id, "keysPerDay": 4} for promo_id in self.promo_ids],
+                "states": [{"promoId": promo_id, "receiveKeysToday": count}
+                           for promo_id, count in player.keys_today.items()],
+            }
+        return 404, {"error_code": "NOT_FOUND"}
+
+    # endregion
+
+    # region game promo
+    def promo(self, action: str, token: str, data: dict):
+        if action == "login-client":
+            client_token = uuid.uuid4().hex
+            self.promo_tokens[client_token] = 0
+            return 200, {"clientToken": client_token}
+
+        if token not in self.promo_tokens:
+            return 401, {"error_code": "NotAuthorized"}
+        if action == "register-event":
+            self.promo_tokens[token] += 1
+            return 200, {"hasCode": self.promo_tokens[token] >= self.events_per_code}
+        if action == "create-code":
+            if self.promo_tokens[token] < self.events_per_code:
+                return 400, {"error_code": "NoCode"}
+            self.promo_tokens[token] = 0
+            code = f"BENCH-{uuid.uuid4().hex[:12].upper()}"
+            self.promo_codes[code] = data.get("promoId")
+            return 200, {"promoCode": code}
+        return 404, {"error_code": "NOT_FOUND"}
+    # endregion
+
+    def handle(self, path: str, token: str, data: dict):
+        """`(status, body, headers)` of one POST."""
+        if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+            return 429, {"error_code": "TOO_MANY_REQUESTS"}, {"Retry-After": str(self.retry_after)}
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, {"error_code": "INTERNAL"}, {}
+
+        section, _, action = path.strip("/").partition("/")
+        if section == "ip":
+            return 200, {"ip": "127.0.0.1", "asn_org": "benchmark", "country_code": "XX"}, {}
+        if section == "auth" and action == "me-telegram":
+            return 200, {"telegramUser": {"authUserId": abs(hash(token)) % 10 ** 9}}, {}
+        if section == "promo":
+            return (*self.promo(action, token, data), {})
+        if section == "clicker":
+            player = self.player(token)
+            with player.lock:
+                return (*self.clicker(action, player, data, self.clock.time()), {})
+        return 404, {"error_code": "NOT_FOUND"}, {}
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, Nagle would hold the body for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _delay(self):
+                if server.latency:
+                    time.sleep(server.latency * random.uniform(0.5, 1.5))
+
+            def _send(self, status: int, body: bytes = b"", headers: dict = None):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_OPTIONS(self):
+                self._delay()
+                self._send(204, headers={"Access-Control-Max-Age": "600",
+                                         "Access-Control-Allow-Methods": "POST",
+                                         "Access-Control-Allow-Headers": "authorization,content-type"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    data = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    data = {}
+                token = self.headers.get("Authorization", "").partition(" ")[2]
+                self._delay()
+                status, body, headers = server.handle(self.path, token, data)
+                self._send(status, json.dumps(body).encode(), headers)
+
+        return Handler
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+        """Start serving on a daemon thread, the bound port is `server_port` of the result."""
+        httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, name="mock_server", daemon=True).start()
+        return httpd
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="local stand-in for the hamster kombat and game promo hosts")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    httpd = GameServer(latency=args.latency, error_rate=args.error_rate,
+                       rate_limit_rate=args.rate_limit_rate).serve(port=args.port)
+    print(f"serving on http://127.0.0.1:{httpd.server_port}")
+    threading.Event().wait()
@@ -0,0 +1,231 @@
+"""
+End-to-end throughput benchmark of the bot against `benchmarks.mock_server`.
+
+    python -m benchmarks.run --accounts 10 100 1000 --duration 60 --time-scale 60
+
+Every fleet size runs in its own process against one mock server process, with every sleep of
+the bot compressed by `--time-scale`. Reported per run: requests/sec, per-endpoint p50/p99 latency
+as seen by the client, peak RSS and peak thread count, total and per account.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from transport import RequestsTransport, Response, Transport  # noqa: E402
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class TimedTransport(Transport):
+    """`RequestsTransport` of the whole fleet recording the latency of every request per endpoint."""
+
+    def __init__(self, pool_size: int = 10):
+        self.inner = RequestsTransport(pool_size=pool_size, shared=True)
+        self.ERRORS, self.CONNECT_ERRORS = self.inner.ERRORS, self.inner.CONNECT_ERRORS
+        self.latencies = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def request(self, method: str, url: str, headers, data=None) -> Response:
+        started = time.perf_counter()
+        endpoint = f"{method.upper()} /{url.partition('://')[2].partition('/')[2]}"
+        try:
+            response = self.inner.request(method, url, headers, data=data)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        with self._lock:
+            self.errors += not response.ok
+            self.latencies.setdefault(endpoint, []).append(time.perf_counter() - started)
+        return response
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {endpoint: list(values) for endpoint, values in self.latencies.items()}
+
+    def close(self):
+        self.inner.close()
+
+
+def serve(port_queue, latency: float, error_rate: float, rate_limit_rate: float, scale: float, origin: float):
+    sys.path.insert(0, str(BASE_DIR))
+    from benchmarks.mock_server import GameServer
+    from clock import ScaledClock
+
+    httpd = GameServer(latency=latency, error_rate=error_rate, rate_limit_rate=rate_limit_rate,
+                       clock=ScaledClock(scale, origin)).serve()
+    port_queue.put(httpd.server_port)
+    threading.Event().wait()
+
+
+def run_fleet(result_queue, accounts: int, url: str, duration: float, scale: float, origin: float,
+              log_level: str, rate_limit: float):
+    """Child process: run `accounts` bots in threads for `duration` seconds and report."""
+    sys.path.insert(0, str(BASE_DIR))
+    os.environ.update({
+        "ACCOUNTS_COUNT": str(accounts),
+        "ACCOUNTS_NAMES": ";;".join(f"bench_{accounts}_{i}" for i in range(accounts)),
+        "ACCOUNTS_BEARER_TOKEN": ";;".join(f"token_{accounts}_{i}" for i in range(accounts)),
+        "ACCOUNTS_USERAGENT": ";;".join("Mozilla/5.0 (Linux; Android 10; K) benchmark" for _ in range(accounts)),
+        "HK_API_URL": url,
+        "PROMO_API_URL": url,
+        "STATE_DB": "",
+        "BOOTSTRAP_RATE": "0",
+        "RATE_LIMIT": str(rate_limit),
+    })
+
+    import logging
+
+    from account import Account
+    from bootstrap import bootstrap_accounts
+    from clock import ScaledClock
+    from promo_keys import stop_promo_pool
+    import config
+
+    # account loggers set their own level, filter on the handler
+    handler = logging.StreamHandler()
+    handler.setLevel(getattr(logging, log_level.upper()))
+    logging.basicConfig(level=getattr(logging, log_level.upper()), handlers=[handler])
+
+    # the accounts and the promo key pool they create sleep on the scaled clock and send through the timer
+    clock = ScaledClock(scale, origin)
+    transport = TimedTransport(pool_size=config.HTTP_POOL_SIZE)
+    started = time.perf_counter()
+    peak_threads = threading.active_count()
+    bots, stopping, lock = [], threading.Event(), threading.Lock()
+
+    def create_account(account_data: dict) -> Account:
+        return Account(name=account_data["name"], bearer_token=account_data["bear_token"],
+                       user_agent=account_data["user_agent"], clock=clock, transport=transport)
+
+    def start(bot: Account):
+        with lock:
+            if stopping.is_set():
+                bot.close()
+                return
+            thread = threading.Thread(target=bot.start, name=f"{bot.name} tg account", daemon=True)
+            bots.append((bot, thread))
+            thread.start()
+
+    threading.Thread(
+        target=bootstrap_accounts, name="bootstrap", daemon=True,
+        args=(config.ACCOUNTS, create_account, start, config.BOOTSTRAP_CONCURRENCY, 0),
+    ).start()
+
+    while time.perf_counter() - started < duration:
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(0.2)
+
+    elapsed = time.perf_counter() - started
+    snapshot = transport.snapshot()
+    total = sum(len(values) for values in snapshot.values())
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result_queue.put({
+        "accounts": accounts,
+        "seconds": round(elapsed, 1),
+        "requests": total,
+        "errors": transport.errors,
+        "requests_per_sec": round(total / elapsed, 1),
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+        "rss_per_account_kb": round(peak_rss_kb / accounts, 1),
+        "peak_threads": peak_threads,
+        "threads_per_account": round(peak_threads / accounts, 2),
+        "endpoints": {
+            endpoint: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            }
+            for endpoint, values in sorted(snapshot.items())
+        },
+    })
+    result_queue.close()
+    result_queue.join_thread()
+
+    # the accounts finish the request in flight and stop at their next pause
+    with lock:
+        stopping.set()
+    stop_promo_pool()
+    for bot, thread in bots:
+        bot.stop()
+    for bot, thread in bots:
+        thread.join()
+
+
+def print_report(results: list):
+    print(f"{'accounts':>8} {'req/s':>9} {'requests':>9} {'errors':>7} {'RSS MB':>8} {'RSS/acc KB':>10}"
+          f" {'threads':>8} {'thr/acc':>8}")
+    for result in results:
+        print(f"{result['accounts']:>8} {result['requests_per_sec']:>9} {result['requests']:>9}"
+              f" {result['errors']:>7} {result['peak_rss_mb']:>8} {result['rss_per_account_kb']:>10}"
+              f" {result['peak_threads']:>8} {result['threads_per_account']:>8}")
+
+    for result in results:
+        print(f"\n{result['accounts']} accounts")
+        print(f"  {'endpoint':<42} {'count':>7} {'p50 ms':>8} {'p99 ms':>8}")
+        for endpoint, stats in result["endpoints"].items():
+            print(f"  {endpoint:<42} {stats['count']:>7} {stats['p50_ms']:>8} {stats['p99_ms']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run N accounts against the local mock server")
+    parser.add_argument("--accounts", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--duration", type=float, default=60, help="wall clock seconds per fleet size")
+    parser.add_argument("--time-scale", type=float, default=60, help="how much faster the bot sleeps run")
+    parser.add_argument("--latency", type=float, default=0.02, help="mock server seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0, help="RATE_LIMIT of the bot, 0 is unlimited")
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    origin = time.time()
+
+    port_queue = context.Queue()
+    server = context.Process(target=serve, daemon=True, args=(
+        port_queue, args.latency, args.error_rate, args.rate_limit_rate, args.time_scale, origin,
+    ))
+    server.start()
+    url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+    results = []
+    try:
+        for accounts in args.accounts:
+            result_queue = context.Queue()
+            fleet = context.Process(target=run_fleet, args=(
+                result_queue, accounts, url, args.duration, args.time_scale, origin, args.log_level,
+                args.rate_limit,
+            ))
+            fleet.start()
+            results.append(result_queue.get(timeout=args.duration + 600))
+            fleet.join()
+    finally:
+        server.terminate()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
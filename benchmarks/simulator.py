@@ -0,0 +1,164 @@
+"""
+Offline economy simulator.
+
+    python -m benchmarks.simulator --days 30 --accounts 20 --cooldown 1800 7200 --parallel-update true false
+
+Runs the real `Account.step` (planner, `buy_best_card`, `start_tap`, daily jobs) of many accounts against
+the `GameServer` card economy in-process. Every account shares one `VirtualClock`, accounts are stepped
+in wake-up order and the clock jumps straight to the next wake-up, so a month of one account takes 1 to 2.5
+seconds, most of it decoding the `upgradesForBuy` tables of its requests.
+Every combination of the strategy options is simulated with `--accounts` accounts and the mean
+profit/hour curve of each strategy is reported.
+"""
+import argparse
+import csv
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# the simulator needs no real accounts and no state store, set before `config` is imported
+os.environ.setdefault("ACCOUNTS_NAMES", "simulated")
+os.environ.setdefault("ACCOUNTS_BEARER_TOKEN", "simulated")
+os.environ.setdefault("ACCOUNTS_USERAGENT", "simulated")
+os.environ["STATE_DB"] = ""
+
+from account import Account  # noqa: E402
+from benchmarks.mock_server import GameServer  # noqa: E402
+from clock import VirtualClock  # noqa: E402
+from hamster_kombat import APIError, HamsterKombatAPI  # noqa: E402
+
+
+class SimulatedAPI(HamsterKombatAPI):
+    """`HamsterKombatAPI` answered by an in-process `GameServer`, the endpoint methods are the real ones."""
+
+    def __init__(self, server: GameServer, auth: str, clock: VirtualClock):
+        self.server = server
+        self.AUTH = auth
+        self.clock = clock
+
+    def _request(self, method: str, path: str, headers: dict = None, data: dict = None):
+        status, body, _ = self.server.handle(path, self.AUTH.partition(" ")[2], data or {})
+        if status != 200:
+            raise APIError(url=path, method=method, status=status, data=data, response=json.dumps(body))
+        return body
+
+    def close(self):
+        pass
+
+
+class SimulatedAccount(Account):
+    def __init__(self, name: str, server: GameServer, clock: VirtualClock, cooldown: int, target_balance: int,
+                 parallel_update: bool):
+        self.server = server
+        super().__init__(name=name, bearer_token=name, user_agent="simulator", log_level=logging.CRITICAL,
+                         clock=clock, bootstrap=False)
+        # promo keys come from another host, the economy is about coins
+        self.auto_promos = False
+        self.auto_upgrade_interval = cooldown
+        self.target_balance = target_balance
+        self.parallel_update = parallel_update
+        self.bootstrap()
+
+    def _create_api(self) -> SimulatedAPI:
+        return SimulatedAPI(self.server, self.bearer_token, self.clock)
+
+
+def simulate(strategies: list, accounts: int, days: float, seed: int = 1, sample_interval: int = 3600) -> dict:
+    """`{strategy name: [(hour, mean profit/hour, mean balance), ...]}` sampled every `sample_interval` seconds."""
+    random.seed(seed)
+    clock = VirtualClock(start=1_720_000_800)
+    server = GameServer(clock=clock, seed=seed)
+    start, end = clock.time(), clock.time() + days * 86400
+
+    heap = []
+    counter = itertools.count()
+    for strategy in strategies:
+        for i in range(accounts):
+            account = SimulatedAccount(name=f"{strategy['name']}#{i}", server=server, clock=clock,
+                                       cooldown=strategy["cooldown"], target_balance=strategy["target_balance"],
+                                       parallel_update=strategy["parallel_update"])
+            heapq.heappush(heap, (clock.time(), next(counter), strategy["name"], account))
+
+    samples = {strategy["name"]: [] for strategy in strategies}
+    next_sample = start
+    while heap:
+        wake_at, _, name, account = heap[0]
+        # sample before time moves past the sampling point
+        while next_sample <= min(wake_at, end):
+            by_strategy = {}
+            for _, _, sample_name, sample_account in heap:
+                by_strategy.setdefault(sample_name, []).append(sample_account)
+            for sample_name, members in by_strategy.items():
+                samples[sample_name].append((
+                    (next_sample - start) / 3600,
+                    sum(x.state.earn_passive_per_hour for x in members) / len(members),
+                    sum(x.state.projected_balance(next_sample) for x in members) / len(members),
+                ))
+            next_sample += sample_interval
+        if wake_at >= end:
+            break
+
+        heapq.heappop(heap)
+        clock.advance_to(wake_at)
+        try:
+            wake_at = account.step()
+        except Exception as e:
+            logging.error(f"{account.name} step failed: {e}", exc_info=True)
+            wake_at = clock.time() + 60
+        heapq.heappush(heap, (wake_at, next(counter), name, account))
+
+    return samples
+
+
+def parse_bool(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes", "y")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare upgrade strategies on a simulated card economy")
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--accounts", type=int, default=10, help="accounts per strategy")
+    parser.add_argument("--cooldown", type=int, nargs="+", default=[1800],
+                        help="COOLDOWN_AFTER_AUTO_UPGRADE values")
+    parser.add_argument("--target-balance", type=int, nargs="+", default=[18_000_000_000])
+    parser.add_argument("--parallel-update", type=parse_bool, nargs="+", default=[True])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--csv", help="write the hourly profit/hour curves to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    strategies = [
+        {"name": f"cooldown={cooldown} target={target} parallel={parallel}", "cooldown": cooldown,
+         "target_balance": target, "parallel_update": parallel}
+        for cooldown, target, parallel in itertools.product(args.cooldown, args.target_balance, args.parallel_update)
+    ]
+
+    started = time.perf_counter()
+    samples = simulate(strategies, accounts=args.accounts, days=args.days, seed=args.seed)
+    elapsed = time.perf_counter() - started
+
+    marks = sorted({1, 7, 14, 30, int(args.days)} & set(range(1, int(args.days) + 1)))
+    print(f"{len(strategies) * args.accounts} accounts, {args.days} days simulated in {elapsed:.1f}s\n")
+    print(f"{'strategy':<50}" + "".join(f"{f'day {day} p/h':>16}" for day in marks) + f"{'balance':>16}")
+    for name, curve in samples.items():
+        by_hour = {int(hour): profit for hour, profit, _ in curve}
+        row = "".join(f"{int(by_hour.get(day * 24, curve[-1][1])):>16}" for day in marks)
+        print(f"{name:<50}{row}{int(curve[-1][2]):>16}")
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["strategy", "hour", "profit_per_hour", "balance"])
+            for name, curve in samples.items():
+                writer.writerows([name, int(hour), int(profit), int(balance)] for hour, profit, balance in curve)
+
+
+if __name__ == '__main__':
+    main()
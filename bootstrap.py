@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class StartRate:
+    """Spaces out account starts so at most `rate` of them begin per second, shared between threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + self.interval
+            return start_at - now
+
+    def wait(self):
+        time.sleep(self._reserve())
+
+    async def wait_async(self):
+        await asyncio.sleep(self._reserve())
+
+
+def bootstrap_accounts(accounts_data: list, create_account, on_ready, concurrency: int = 8, rate: float = 1):
+    """
+    Initialize accounts on a pool of `concurrency` threads, starting at most `rate` per second.
+    Every account is handed to `on_ready` as soon as it is initialized, not after the whole fleet.
+    Blocks until every account was tried and returns the initialized ones.
+    """
+    start_rate = StartRate(rate)
+
+    def init(account_data):
+        start_rate.wait()
+        try:
+            account = create_account(account_data)
+        except Exception as e:
+            logger.error(f"unable to init account {account_data['name']}: {e}", exc_info=True)
+            return None
+        on_ready(account)
+        return account
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="bootstrap") as executor:
+        return [account for account in executor.map(init, accounts_data) if account is not None]
+
+
+async def bootstrap_accounts_async(accounts_data: list, create_account, on_ready, concurrency: int = 8,
+                                   rate: float = 1):
+    """`bootstrap_accounts` for the asyncio runner, `create_account` is a coroutine function."""
+    start_rate = StartRate(rate)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def init(account_data):
+        async with semaphore:
+            await start_rate.wait_async()
+            try:
+                account = await create_account(account_data)
+            except Exception as e:
+                logger.error(f"unable to init account {account_data['name']}: {e}", exc_info=True)
+                return None
+        on_ready(account)
+        return account
+
+    accounts = await asyncio.gather(*(init(account_data) for account_data in accounts_data))
+    return [account for account in accounts if account is not None]
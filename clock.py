@@ -0,0 +1,98 @@
+import asyncio
+import datetime
+import threading
+import time
+
+
+class SystemClock:
+    """Wall clock. Everything in `Account` and the API clients reads time and sleeps through a clock."""
+
+    def time(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds: float):
+        time.sleep(max(0.0, seconds))
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        """`sleep` that returns early once `event` is set, returns whether it is set."""
+        return event.wait(max(0.0, seconds))
+
+    async def sleep_async(self, seconds: float):
+        await asyncio.sleep(max(0.0, seconds))
+
+    async def wait_async(self, event: asyncio.Event, seconds: float) -> bool:
+        """`sleep_async` that returns early once `event` is set, returns whether it is set."""
+        try:
+            await asyncio.wait_for(event.wait(), max(0.0, seconds))
+        except asyncio.TimeoutError:
+            pass
+        return event.is_set()
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def today(self) -> datetime.date:
+        return self.now().date()
+
+
+class ScaledClock(SystemClock):
+    """Wall clock running `scale` times faster since `origin`, sleeps are shortened to match."""
+
+    def __init__(self, scale: float = 1.0, origin: float = None):
+        self.scale = scale
+        self.origin = time.time() if origin is None else origin
+
+    def time(self) -> float:
+        return self.origin + (time.time() - self.origin) * self.scale
+
+    def sleep(self, seconds: float):
+        time.sleep(max(0.0, seconds) / self.scale)
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        return event.wait(max(0.0, seconds) / self.scale)
+
+    async def sleep_async(self, seconds: float):
+        await asyncio.sleep(max(0.0, seconds) / self.scale)
+
+    async def wait_async(self, event: asyncio.Event, seconds: float) -> bool:
+        return await super().wait_async(event, seconds / self.scale)
+
+
+class VirtualClock(SystemClock):
+    """Clock that only moves when somebody sleeps on it or calls `advance`, sleeping returns at once."""
+
+    def __init__(self, start: float = None):
+        self._now = time.time() if start is None else start
+        self._lock = threading.Lock()
+
+    def time(self) -> float:
+        return self._now
+
+    def advance(self, seconds: float):
+        with self._lock:
+            self._now += max(0.0, seconds)
+
+    def advance_to(self, timestamp: float):
+        with self._lock:
+            self._now = max(self._now, timestamp)
+
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        if not event.is_set():
+            self.advance(seconds)
+        return event.is_set()
+
+    async def sleep_async(self, seconds: float):
+        self.advance(seconds)
+        await asyncio.sleep(0)
+
+    async def wait_async(self, event: asyncio.Event, seconds: float) -> bool:
+        if not event.is_set():
+            self.advance(seconds)
+        await asyncio.sleep(0)
+        return event.is_set()
+
+
+system_clock = SystemClock()
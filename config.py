@@ -12,19 +12,42 @@ SEPARATOR = os.environ.get("SEPARATOR", ";;")
 ACCOUNTS_COUNT = int(os.environ.get("ACCOUNTS_COUNT", 1))
 
 HK_API_URL = os.environ.get("HK_API_URL", "https://api.hamsterkombatgame.io")
+# host the promo keys are generated on
+PROMO_API_URL = os.environ.get("PROMO_API_URL", "https://api.gamepromo.io")
 
-ACCOUNT_NAMES = os.environ["ACCOUNTS_NAMES"].split(SEPARATOR, ACCOUNTS_COUNT)
-ACCOUNTS_BEARER_TOKEN = os.environ["ACCOUNTS_BEARER_TOKEN"].split(SEPARATOR, ACCOUNTS_COUNT)
-ACCOUNTS_USERAGENT = os.environ["ACCOUNTS_USERAGENT"].split(SEPARATOR, ACCOUNTS_COUNT)
-
-ACCOUNTS = [
-    {
-        "name": ACCOUNT_NAMES[i],
-        "bear_token": ACCOUNTS_BEARER_TOKEN[i],
-        "user_agent": ACCOUNTS_USERAGENT[i],
-    }
-    for i in range(ACCOUNTS_COUNT)
-]
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+# seconds to connect and then between two reads of an answer, a host that stops answering fails the request
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+# one connection pool per host for every account, it keeps no cookies so they can not leak between accounts
+SHARE_HTTP_SESSION = bool(strtobool(os.environ.get("SHARE_HTTP_SESSION", "False")))
+PREFLIGHT_CACHE = bool(strtobool(os.environ.get("PREFLIGHT_CACHE", "True")))
+PREFLIGHT_CACHE_TTL = int(os.environ.get("PREFLIGHT_CACHE_TTL", 600))  # used when no Access-Control-Max-Age
+# "requests" is HTTP/1.1 keep-alive, "http2" multiplexes every account on a few shared connections per host
+HTTP_TRANSPORT = os.environ.get("HTTP_TRANSPORT", "requests").lower()
+# directory of per account cassettes, "record" saves the real exchanges, "replay" answers from them with no network
+HTTP_CASSETTE = os.environ.get("HTTP_CASSETTE", "")
+HTTP_CASSETTE_MODE = os.environ.get("HTTP_CASSETTE_MODE", "replay").lower()
+
+# JSON lines file with one account per line, re-read while running, the env variables below are used without it
+ACCOUNTS_FILE = os.environ.get("ACCOUNTS_FILE", "")
+ACCOUNTS_RELOAD_INTERVAL = int(os.environ.get("ACCOUNTS_RELOAD_INTERVAL", 10))
+
+if ACCOUNTS_FILE:
+    # loaded by `registry`
+    ACCOUNTS = []
+else:
+    ACCOUNT_NAMES = os.environ["ACCOUNTS_NAMES"].split(SEPARATOR, ACCOUNTS_COUNT)
+    ACCOUNTS_BEARER_TOKEN = os.environ["ACCOUNTS_BEARER_TOKEN"].split(SEPARATOR, ACCOUNTS_COUNT)
+    ACCOUNTS_USERAGENT = os.environ["ACCOUNTS_USERAGENT"].split(SEPARATOR, ACCOUNTS_COUNT)
+
+    ACCOUNTS = [
+        {
+            "name": ACCOUNT_NAMES[i],
+            "bear_token": ACCOUNTS_BEARER_TOKEN[i],
+            "user_agent": ACCOUNTS_USERAGENT[i],
+        }
+        for i in range(ACCOUNTS_COUNT)
+    ]
 AUTO_TAP = bool(strtobool(os.environ.get("AUTO_TAP", "True")))
 AUTO_DAILY_CIPHER = bool(strtobool(os.environ.get("AUTO_DAILY_CIPHER", "True")))
 AUTO_MINIGAME = bool(strtobool(os.environ.get("AUTO_MINIGAME", "True")))
@@ -33,9 +56,86 @@ AUTO_PROMOS = bool(strtobool(os.environ.get("AUTO_PROMOS", "True")))
 AUTO_TASK = bool(strtobool(os.environ.get("AUTO_TASK", "True")))
 
 
+# "threads" runs one OS thread per account, "asyncio" runs every account on one event loop,
+# "scheduler" runs every account from one timer thread with a small worker pool
+RUN_MODE = os.environ.get("RUN_MODE", "threads").lower()
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 4))
+
+# "supervisor" splits the accounts across SUPERVISOR_WORKERS processes (0 is one per core),
+# each of them runs its share with WORKER_RUN_MODE and reports every SUPERVISOR_STATUS_INTERVAL seconds
+SUPERVISOR_WORKERS = int(os.environ.get("SUPERVISOR_WORKERS", 0))
+WORKER_RUN_MODE = os.environ.get("WORKER_RUN_MODE", "threads").lower()
+SUPERVISOR_STATUS_INTERVAL = int(os.environ.get("SUPERVISOR_STATUS_INTERVAL", 15))
+# seconds the workers get to checkpoint their accounts after SIGTERM before they are killed
+SHUTDOWN_TIMEOUT = int(os.environ.get("SHUTDOWN_TIMEOUT", 30))
+
+# accounts initialized at the same time on start and how many of them may start per second
+BOOTSTRAP_CONCURRENCY = int(os.environ.get("BOOTSTRAP_CONCURRENCY", 8))
+BOOTSTRAP_RATE = float(os.environ.get("BOOTSTRAP_RATE", 1))
+
+# promo keys generated at the same time for all accounts
+PROMO_WORKERS = int(os.environ.get("PROMO_WORKERS", 4))
+# promo client tokens are reused per account and game for this many seconds
+PROMO_TOKEN_TTL = int(os.environ.get("PROMO_TOKEN_TTL", 86400))
+
+# requests per second and burst to one host, shared by every account, 0 disables the limit
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT", 10))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 20))
+# retries of a request failed with 429, 5xx or a connection error, with jittered exponential backoff,
+# a request that changes the game state only on 429 or a connection that never opened
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", 3))
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 1))
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", 60))
+# failures in a row that hold every request to the host and for how long, 0 disables the breaker
+CIRCUIT_FAILURES = int(os.environ.get("CIRCUIT_FAILURES", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", 30))
+
 PARALLEL_UPDATE = bool(strtobool(os.environ.get("PARALLEL_UPDATE", "True")))
 
+# a tap request is made once energy reaches this share of `maxTaps`, the free full energy boost is used as well
+TAP_MIN_FILL = float(os.environ.get("TAP_MIN_FILL", 0.9))
+
+# cards are ranked together with the locked cards their purchase unlocks, not only by their own profit
+UPGRADE_LOOKAHEAD = bool(strtobool(os.environ.get("UPGRADE_LOOKAHEAD", "True")))
+
 TARGET_BALANCE: int = 18_000_000_000
 COOLDOWN_AFTER_AUTO_UPGRADE = int(os.environ.get("COOLDOWN_AFTER_AUTO_UPGRADE", 1800))  # 30 min
 
-IS_DEBUG = bool(strtobool(os.environ.get("IS_DEBUG", "False")))
\ No newline at end of file
+# an account is never woken up more often than this
+MIN_WAKEUP_INTERVAL = int(os.environ.get("MIN_WAKEUP_INTERVAL", 60))
+
+# full clicker/sync runs when this many seconds passed since the last confirmed state
+SYNC_INTERVAL = int(os.environ.get("SYNC_INTERVAL", 3600))
+# or when extrapolated passive income exceeds this share of the confirmed balance
+SYNC_DRIFT_THRESHOLD = float(os.environ.get("SYNC_DRIFT_THRESHOLD", 0.05))
+
+# SQLite file with account snapshots and daily job status for warm restarts, empty disables it
+STATE_DB = os.environ.get("STATE_DB", str(BASE_DIR / "state.sqlite3"))
+# config and upgrades snapshots older than this are fetched again on start
+CONFIG_SNAPSHOT_TTL = int(os.environ.get("CONFIG_SNAPSHOT_TTL", 3600))
+# daily job outcomes and applied or failed promo keys older than this many days are deleted by the daily jobs
+# of their account
+STATE_KEEP_DAYS = int(os.environ.get("STATE_KEEP_DAYS", 7))
+
+# Prometheus `/metrics` endpoint, 0 disables it and every metric
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_ADDRESS = os.environ.get("METRICS_ADDRESS", "127.0.0.1")
+
+# SIGUSR1 toggles a PROFILE_KIND capture ("sample" or "cprofile") of PROFILE_ACCOUNTS, every account when empty,
+# SIGUSR2 one of the memory, `/profile` of the metrics server controls them as well, the output goes to PROFILE_DIR
+PROFILE_DIR = os.environ.get("PROFILE_DIR", str(BASE_DIR / "profiles"))
+PROFILE_KIND = os.environ.get("PROFILE_KIND", "sample").lower()
+PROFILE_ACCOUNTS = [name for name in os.environ.get("PROFILE_ACCOUNTS", "").split(",") if name]
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.01))  # seconds between two samples
+
+IS_DEBUG = bool(strtobool(os.environ.get("IS_DEBUG", "False")))
+
+# records are written by a background thread, accounts only put them on a queue
+LOG_QUEUE = bool(strtobool(os.environ.get("LOG_QUEUE", "True")))
+# JSON lines instead of colored text, on stderr and in the files
+LOG_JSON = bool(strtobool(os.environ.get("LOG_JSON", "False")))
+# rotating file in `log/`, empty disables it, and `log/accounts/<name>.log` per account
+LOG_FILE = os.environ.get("LOG_FILE", "")
+LOG_ACCOUNT_FILES = bool(strtobool(os.environ.get("LOG_ACCOUNT_FILES", "False")))
+# identical warnings and errors of a logger are written once per this many seconds, 0 writes all of them
+LOG_DEDUP_INTERVAL = float(os.environ.get("LOG_DEDUP_INTERVAL", 60))
\ No newline at end of file
@@ -2,11 +2,19 @@ import base64
 import logging
 import enum
 import json
-import datetime
+import email.utils
+import threading
 import time
+from types import MappingProxyType
 
 import requests
 
+from clock import SystemClock, system_clock
+from profiling import profiled
+from transport import DEFAULT_TIMEOUT, HTTP1, REPLAY, RequestsTransport, Transport, open_transport
+import metrics
+import models
+
 
 logger = logging.getLogger(__name__)
 
@@ -66,7 +74,7 @@ class HamsterKombatUtils:
 
 class APIError(Exception):
     def __init__(self, message: str = "", url: str = "", method: str = "post", status: int = 500,
-                 headers: dict = None, data: dict = None, response: str = ""):
+                 headers: dict = None, data: dict = None, response: str = "", retry_after: float = None):
         if len(message) > 0:
             self.message = message
         else:
@@ -77,21 +85,152 @@ class APIError(Exception):
         self.status = status
         self.response = response
         self.method = method
+        # seconds from the `Retry-After` header of a 429 or 503 response
+        self.retry_after = retry_after
 
     def __str__(self):
         return f"{self.__class__.__name__}.{self.message} for url '{self.url}' with status {self.status}"
 
 
+def parse_retry_after(value) -> float:
+    """`Retry-After` header in seconds, it is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class PreflightCache:
+    """
+    Remembers successful CORS preflight (OPTIONS) responses the way a browser does.
+
+    Entries are keyed by (host, path, method, requested headers) and live for the `Access-Control-Max-Age`
+    returned by the server, or for `ttl` seconds when the server does not send one.
+    """
+
+    def __init__(self, ttl: int = 600):
+        self.ttl = ttl
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url: str, method: str, request_headers: str) -> tuple:
+        host, _, path = url.partition("://")[2].partition("/")
+        return host, path, method.upper(), frozenset(filter(None, request_headers.lower().split(",")))
+
+    def is_fresh(self, key: tuple) -> bool:
+        expires = self._expires.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def store(self, key: tuple, response_headers) -> None:
+        try:
+            max_age = int(response_headers.get("Access-Control-Max-Age", self.ttl))
+        except (TypeError, ValueError):
+            max_age = self.ttl
+        with self._lock:
+            if max_age <= 0:
+                self._expires.pop(key, None)
+                return
+            self._expires[key] = time.monotonic() + max_age
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+
+
+class RequestTemplate:
+    """
+    Everything about a call to one endpoint that does not change between calls: the url,
+    the frozen preflight and request headers and the preflight cache key.
+    Templates are immutable, so a client can be shared between threads.
+    A request with a body changes the game state, it is not `idempotent` unless told otherwise.
+    """
+    __slots__ = ("method", "url", "path", "option_headers", "request_headers", "has_body", "idempotent",
+                 "preflight_cache", "preflight_key")
+
+    def __init__(self, method: str, url: str, path: str, option_headers: dict, request_headers: dict,
+                 has_body: bool, preflight_cache: "PreflightCache" = None, access_control_headers: str = "",
+                 idempotent: bool = None):
+        self.method = method.lower()
+        self.url = url
+        self.path = path
+        self.option_headers = MappingProxyType(dict(option_headers))
+        self.request_headers = MappingProxyType(dict(request_headers))
+        self.has_body = has_body
+        self.idempotent = not has_body if idempotent is None else idempotent
+        self.preflight_cache = preflight_cache
+        self.preflight_key = None
+        if preflight_cache is not None:
+            self.preflight_key = preflight_cache.key(url, method, access_control_headers)
+
+    def needs_preflight(self) -> bool:
+        return self.preflight_cache is None or not self.preflight_cache.is_fresh(self.preflight_key)
+
+    def store_preflight(self, response_headers) -> None:
+        if self.preflight_cache is not None:
+            self.preflight_cache.store(self.preflight_key, response_headers)
+
+    def encode(self, data):
+        if not self.has_body:
+            return None
+        return json.dumps(data, separators=(",", ":"))
+
+
 class HamsterKombatAPI:
     URL: str
     USER_AGENT: str
     AUTH: str
     DEFAULT_HEADERS: dict
 
-    def __init__(self, api_url: str, auth: str, user_agent: str, additional_headers: dict = None):
+    # errors of the HTTP client that mean the request never got an answer, or never left, for the guard
+    TRANSPORT_ERRORS = RequestsTransport.ERRORS
+    CONNECT_ERRORS = RequestsTransport.CONNECT_ERRORS
+
+    # (method, path, has body) of every endpoint, their templates are built in `__init__`
+    ENDPOINTS = (
+        ("post", "clicker/sync", False),
+        ("post", "clicker/upgrades-for-buy", False),
+        ("post", "clicker/buy-upgrade", True),
+        ("post", "clicker/tap", True),
+        ("post", "clicker/boosts-for-buy", False),
+        ("post", "clicker/buy-boost", True),
+        ("post", "clicker/list-tasks", False),
+        ("post", "clicker/list-airdrop-tasks", False),
+        ("post", "clicker/config", False),
+        ("post", "clicker/claim-daily-cipher", True),
+        ("post", "clicker/check-task", True),
+        ("post", "clicker/start-keys-minigame", False),
+        ("post", "clicker/claim-daily-keys-minigame", True),
+        ("post", "clicker/apply-promo", True),
+        ("post", "clicker/get-promos", False),
+        ("post", "ip", False),
+        ("post", "auth/me-telegram", False),
+    )
+
+    def __init__(self, api_url: str, auth: str, user_agent: str, additional_headers: dict = None,
+                 pool_size: int = 10, share_session: bool = False, session: requests.Session = None,
+                 use_preflight_cache: bool = True, preflight_cache_ttl: int = 600, clock: SystemClock = None,
+                 account: str = None, guard=None, http_transport: str = HTTP1, cassette: str = None,
+                 cassette_mode: str = REPLAY, transport: Transport = None, timeout: float = DEFAULT_TIMEOUT):
         self.URL = api_url if api_url[-1] == "/" else api_url + "/"
+        # only labels the metrics
+        self.account = account
+        # `resilience.HostGuard` shared by every client of the host, None sends without limits or retries
+        self.guard = guard
+        self.clock = system_clock if clock is None else clock
         self.USER_AGENT = user_agent
         self.AUTH = auth
+        self.preflight_cache = PreflightCache(ttl=preflight_cache_ttl) if use_preflight_cache else None
+
+        self._init_session(session=session, share_session=share_session, pool_size=pool_size,
+                           http_transport=http_transport, cassette=cassette, cassette_mode=cassette_mode,
+                           transport=transport, timeout=timeout)
 
         # Default headers
         self.DEFAULT_HEADERS = {
@@ -116,53 +255,118 @@ class HamsterKombatAPI:
                 '"Android WebView";v="125", "Chromium";v="125", "Not.A/Brand";v="24"'
             )
 
+        # templates are built from DEFAULT_HEADERS, changing it after this point has no effect
+        self._templates = {}
+        for method, path, has_body in self.ENDPOINTS:
+            self._get_template(method=method, path=path, has_body=has_body)
+
     @property
     def is_android(self) -> bool:
         return "android" in self.USER_AGENT.lower()
 
-    def _request(self, method: str, path: str, headers: dict = None, data: dict = None):
-        # region url path
+    def _init_session(self, session, share_session: bool, pool_size: int, http_transport: str = HTTP1,
+                      cassette: str = None, cassette_mode: str = REPLAY, transport: Transport = None,
+                      timeout: float = DEFAULT_TIMEOUT):
+        # sessions passed in or taken from the shared pool belong to someone else and are not closed by `close`
+        self.transport, self._owns_session = open_transport(
+            self.URL, kind=http_transport, pool_size=pool_size, share=share_session, session=session,
+            cassette=cassette, cassette_mode=cassette_mode, account=self.account, transport=transport,
+            timeout=timeout,
+        )
+        self.TRANSPORT_ERRORS = self.transport.ERRORS
+        self.CONNECT_ERRORS = self.transport.CONNECT_ERRORS
+
+    def close(self):
+        if self._owns_session:
+            self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _build_template(self, method: str, path: str, has_body: bool, headers: dict = None) -> "RequestTemplate":
         if path[0] == "/":
             path = path[1::]
-        url = self.URL + path
-        # endregion
 
-        # region headers
-        _headers = self.DEFAULT_HEADERS
+        base_headers = dict(self.DEFAULT_HEADERS)
         if headers is not None:
-            _headers.update(headers)
-        option_headers = _headers
-        req_headers = _headers
+            base_headers.update(headers)
 
-        option_headers.update({
-            "Access-Control-Request-Headers": "authorization",
+        request_headers = "authorization,content-type" if has_body else "authorization"
+        option_headers = {
+            **base_headers,
+            "Access-Control-Request-Headers": request_headers,
             "Access-Control-Request-Method": method.upper(),
-        })
-        req_headers.update({
-            "Authorization": self.AUTH,
-        })
-        if data is not None:
-            option_headers["Access-Control-Request-Headers"] = "authorization,content-type"
+        }
+        req_headers = {**base_headers, "Authorization": self.AUTH}
+        if has_body:
             req_headers.update({"Content-Type": "application/json", "Accept": "application/json"})
-        # endregion
 
+        return RequestTemplate(method=method, url=self.URL + path, path=path, option_headers=option_headers,
+                               request_headers=req_headers, has_body=has_body,
+                               preflight_cache=self.preflight_cache, access_control_headers=request_headers)
+
+    def _get_template(self, method: str, path: str, has_body: bool, headers: dict = None) -> "RequestTemplate":
+        # one-off headers are never cached, every other call reuses the template built for the endpoint
+        if headers is not None:
+            return self._build_template(method=method, path=path, has_body=has_body, headers=headers)
+
+        key = (method, path, has_body)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._build_template(method=method, path=path, has_body=has_body)
+            self._templates[key] = template
+        return template
+
+    @profiled("account")
+    def _request(self, method: str, path: str, headers: dict = None, data: dict = None):
+        template = self._get_template(method=method, path=path, has_body=data is not None, headers=headers)
+        if self.guard is None:
+            return self._send(logger, template, data=data)
+        return self.guard.call(lambda: self._send(logger, template, data=data), template, clock=self.clock,
+                               transport_errors=self.TRANSPORT_ERRORS, connect_errors=self.CONNECT_ERRORS,
+                               account=self.account)
+
+    def _send(self, log, template: RequestTemplate, data: dict = None):
         # region send option request
-        response = requests.options(url=url, headers=option_headers)
-        if not response.ok:
-            logger.error(f"Failed OPTION request for '{path}' Status code is not 204, Response: {response.text}",
-                         extra={"path": path, "method": method, "headers": _headers})
-            raise APIError(url=url, method="option", status=response.status_code, headers=option_headers)
+        if template.needs_preflight():
+            started = time.perf_counter()
+            response = self.transport.request("options", template.url, template.option_headers)
+            metrics.record_request(self.account, template.path, "preflight", time.perf_counter() - started,
+                                   response.status_code, received=len(response.content))
+            if not response.ok:
+                log.error("Failed OPTION request for '%s' Status code is not 204, Response: %s",
+                          template.path, response.text,
+                          extra={"path": template.path, "method": template.method, "account": self.account})
+                metrics.record_error(self.account, template.path)
+                raise APIError(url=template.url, method="option", status=response.status_code,
+                               headers=dict(template.option_headers),
+                               retry_after=parse_retry_after(response.headers.get("Retry-After")))
+            template.store_preflight(response.headers)
         # endregion
 
         # region request
-        response = requests.request(method=method.lower(), url=url, headers=req_headers, data=json.dumps(data))
+        body = template.encode(data)
+        started = time.perf_counter()
+        response = self.transport.request(template.method, template.url, template.request_headers, data=body)
+        metrics.record_request(self.account, template.path, "request", time.perf_counter() - started,
+                               response.status_code, sent=len(body or ""), received=len(response.content))
         if not response.ok:
-            logger.error(f"Failed '{method}' request for '{path}' Status code is not ok, Response: {response.text}",
-                         extra={"path": path, "method": method, "headers": _headers, "data": data})
-            raise APIError(url=url, method=method, status=response.status_code, headers=req_headers, data=data)
+            log.error("Failed '%s' request for '%s' Status code is not ok, Response: %s",
+                      template.method, template.path, response.text,
+                      extra={"path": template.path, "method": template.method, "data": data, "account": self.account})
+            metrics.record_error(self.account, template.path)
+            raise APIError(url=template.url, method=template.method, status=response.status_code,
+                           headers=dict(template.request_headers), data=data,
+                           retry_after=parse_retry_after(response.headers.get("Retry-After")))
         # endregion
 
-        return response.json()
+        return models.loads(response.content)
+
+    def _timestamp(self) -> int:
+        return int(self.clock.time() * 1000)
 
     def sync(self):
         path = "clicker/sync"
@@ -175,7 +379,7 @@ class HamsterKombatAPI:
     def buy_upgrade(self, upgrade_id):
         path = "clicker/buy-upgrade"
         data = {
-            "timestamp": int(datetime.datetime.now().timestamp() * 1000),
+            "timestamp": self._timestamp(),
             # "timestamp": int(str(datetime.datetime.now().microsecond)[:3]),
             # "timestamp": int(str(time.time_ns() / 1000000).split(".")[-1]),
             "upgradeId": upgrade_id,
@@ -185,7 +389,7 @@ class HamsterKombatAPI:
     def tap(self, tap_count: int, available_taps: int):
         path = "clicker/tap"
         data = {
-            "timestamp": int(datetime.datetime.now().timestamp() * 1000),
+            "timestamp": self._timestamp(),
             "availableTaps": available_taps,
             "count": tap_count,
         }
@@ -198,7 +402,7 @@ class HamsterKombatAPI:
     def buy_boost(self, boost_id: int):
         path = "clicker/buy-boost"
         data = {
-            "timestamp": int(datetime.datetime.now().timestamp() * 1000),
+            "timestamp": self._timestamp(),
             "boostId": boost_id,
         }
         return self._request(method="post", path=path, data=data)
@@ -0,0 +1,100 @@
+import datetime
+import logging
+
+from clock import SystemClock, system_clock
+
+
+logger = logging.getLogger(__name__)
+
+
+class DailyLedger:
+    """
+    What the daily jobs of one account already did in the current game day.
+
+    A game day ends at the server's daily reset, `dailyCipher.remainSeconds` of `config` counted
+    from when it was fetched, not at local midnight. Job outcomes are kept per game day and the
+    tasks finished for good across days, in memory and in the state store when there is one, so
+    work known to be done makes no request, after a restart neither.
+    """
+    # tasks that can be completed again every game day
+    DAILY_TASKS = ("streak_days",)
+    DAY_SECONDS = 86400
+
+    def __init__(self, account: str, store=None, clock: SystemClock = None):
+        self.account = account
+        self.store = store
+        self.clock = system_clock if clock is None else clock
+        # unix time the current game day ends, None until `config` was seen
+        self._reset_at = None
+        self._day = None
+        self._jobs = {}
+        finished = None if store is None else store.load_snapshot(account, "finished_tasks")[0]
+        self.finished_tasks = set(finished or ())
+
+    def observe_config(self, config_data: dict, fetched_at: float):
+        remain_seconds = (config_data or {}).get("dailyCipher", {}).get("remainSeconds")
+        if remain_seconds is None or fetched_at is None:
+            return
+        # whole minutes, the latency of the request must not make every fetch a different day
+        reset_at = round((fetched_at + remain_seconds) / 60) * 60
+        if reset_at != self.reset_at:
+            logger.debug("[%s] game day ends at %s", self.account, self._format(reset_at))
+        self._reset_at = reset_at
+
+    def restore(self, reset_at: float):
+        """The end of a game day checkpointed by an earlier run, until `config` is read again."""
+        if self._reset_at is None and reset_at is not None:
+            self._reset_at = reset_at
+
+    @property
+    def reset_at(self):
+        """The end of the current game day, moved on by whole days once it passes."""
+        if self._reset_at is not None and self._reset_at <= self.clock.time():
+            days = (self.clock.time() - self._reset_at) // self.DAY_SECONDS + 1
+            self._reset_at += days * self.DAY_SECONDS
+        return self._reset_at
+
+    @staticmethod
+    def _format(timestamp: float) -> str:
+        return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%MZ")
+
+    @property
+    def day(self) -> str:
+        """The game day as the UTC time it ends, the local date until `config` told the reset."""
+        reset_at = self.reset_at
+        return self.clock.today().isoformat() if reset_at is None else self._format(reset_at)
+
+    def _jobs_of_day(self) -> dict:
+        day = self.day
+        if day != self._day:
+            self._day = day
+            done = {} if self.store is None else self.store.load_daily_jobs(self.account, day)
+            self._jobs = {job: status for job, (status, _) in done.items()}
+        return self._jobs
+
+    def is_done(self, job: str) -> bool:
+        return self._jobs_of_day().get(job) == "done"
+
+    def record(self, job: str, result):
+        status = "done" if result is True else "failed"
+        self._jobs_of_day()[job] = status
+        if self.store is not None:
+            self.store.save_daily_job(self.account, self._day, job, status)
+
+    def prune(self, keep_days: int):
+        """Forget the job outcomes recorded more than `keep_days` ago."""
+        if self.store is not None:
+            self.store.prune_daily_jobs(keep_days, account=self.account)
+
+    def is_task_finished(self, task_id: str) -> bool:
+        if task_id in self.DAILY_TASKS:
+            return self.is_done(f"task:{task_id}")
+        return task_id in self.finished_tasks
+
+    def task_finished(self, task_id: str):
+        if task_id in self.DAILY_TASKS:
+            self.record(f"task:{task_id}", True)
+        elif task_id not in self.finished_tasks:
+            self.finished_tasks.add(task_id)
+            if self.store is not None:
+                self.store.save_snapshot(self.account, "finished_tasks", sorted(self.finished_tasks))
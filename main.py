@@ -1,32 +1,220 @@
-import random
+import signal
 import threading
 import time
+from functools import partial
 
 from account import Account
+from bootstrap import bootstrap_accounts
+from promo_keys import stop_promo_pool
+from registry import AccountRegistry, get_registry
 from utils import setup_logging
 import config
+import metrics
+import profiling
 
 import logging
 
 
 logger = logging.getLogger(__name__)
-setup_logging()
+setup_logging(is_debug=config.IS_DEBUG, queued=config.LOG_QUEUE, json_lines=config.LOG_JSON,
+              log_file=config.LOG_FILE, account_files=config.LOG_ACCOUNT_FILES,
+              dedup_interval=config.LOG_DEDUP_INTERVAL)
+
+
+def create_account(account_data: dict, account_class: type = Account) -> Account:
+    return account_class(
+        name=account_data["name"],
+        bearer_token=account_data["bear_token"],
+        user_agent=account_data["user_agent"]
+    )
+
+
+def bootstrap(accounts_data: list, on_ready, account_class: type = Account):
+    return bootstrap_accounts(accounts_data, create_account=partial(create_account, account_class=account_class),
+                              on_ready=on_ready,
+                              concurrency=config.BOOTSTRAP_CONCURRENCY, rate=config.BOOTSTRAP_RATE)
+
+
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def on_shutdown(callback):
+    """
+    Call `callback` on the first SIGTERM or SIGINT, a second one ends the process right away.
+    It runs in a thread of its own, a signal handler may interrupt the main thread holding a lock.
+    """
+    def handler(signum, frame):
+        logger.info(f"{signal.Signals(signum).name} received, stopping the accounts")
+        for default in SHUTDOWN_SIGNALS:
+            signal.signal(default, signal.SIG_DFL)
+        threading.Thread(target=callback, name="shutdown", daemon=True).start()
+
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, handler)
+
+
+def run_threads(accounts_data: list, registry: AccountRegistry = None):
+    # account name -> the thread running it
+    threads = {}
+    accounts = {}
+    stopping = threading.Event()
+    lock = threading.Lock()
+
+    def start_thread(account: Account):
+        with lock:
+            if stopping.is_set():
+                account.close()
+                return
+            accounts[account.name] = account
+            thread = threading.Thread(target=account.start, name=f"{account.name} tg account")
+            threads[account.name] = thread
+            thread.start()
+
+    def stop_accounts(names: list, wait: bool = True):
+        """
+        Stop the accounts, with `wait` until their threads ended. A changed account is bootstrapped again
+        right after, its old thread must have written its last checkpoint before the new one reads it.
+        """
+        with lock:
+            stopped = [accounts.pop(name) for name in names if name in accounts]
+        for account in stopped:
+            account.stop()
+        if not wait:
+            return
+        for account in stopped:
+            thread = threads[account.name]
+            thread.join()
+            with lock:
+                if threads.get(account.name) is thread:
+                    del threads[account.name]
+
+    def shutdown():
+        with lock:
+            stopping.set()
+        stop_accounts(list(accounts), wait=False)
+        stop_promo_pool()
+
+    on_shutdown(shutdown)
+    bootstrap(accounts_data, on_ready=start_thread)
+    if registry is not None:
+        registry.watch(on_add=lambda added: bootstrap(added, on_ready=start_thread), on_remove=stop_accounts,
+                       stopped=stopping)
+    # an account checkpoints and closes itself once its loop ends
+    with lock:
+        running = list(threads.values())
+    list(map(lambda x: x.join(), running))
+
+
+def run_scheduler(accounts_data: list, registry: AccountRegistry = None):
+    from scheduler import Scheduler, ScheduledAccount
+
+    scheduler = Scheduler(workers=config.SCHEDULER_WORKERS)
+    bootstrap_scheduled = partial(bootstrap, account_class=ScheduledAccount)
+    accounts = {}
+
+    def schedule(account: Account):
+        accounts[account.name] = account
+        scheduler.add(account, wake_at=account.first_wakeup())
+
+    def remove_accounts(names: list):
+        """
+        Remove the accounts and wait until they are closed. A changed account is bootstrapped again right
+        after, its old instance must have written its last checkpoint before the new one reads it.
+        """
+        removed = [scheduler.remove(account) for name in names if (account := accounts.pop(name, None)) is not None]
+        for closed in removed:
+            closed.wait()
+
+    # accounts are scheduled while the rest of the fleet is still bootstrapping
+    threading.Thread(target=bootstrap_scheduled, name="bootstrap", daemon=True, args=(accounts_data, schedule)).start()
+    if registry is not None:
+        threading.Thread(
+            target=registry.watch, name="registry", daemon=True,
+            args=(lambda added: bootstrap_scheduled(added, on_ready=schedule), remove_accounts),
+        ).start()
+
+    def shutdown():
+        scheduler.stop()
+        for account in list(accounts.values()):
+            account.stop()
+        stop_promo_pool()
+
+    on_shutdown(shutdown)
+    try:
+        # returns once the running steps are done
+        scheduler.run()
+    finally:
+        # closing checkpoints the accounts, the waiting ones resume at their wake-up
+        list(map(lambda x: x.close(), list(accounts.values())))
+
+
+def run_asyncio(accounts_data: list, registry: AccountRegistry = None):
+    import asyncio
+    from async_account import run_accounts
+
+    asyncio.run(run_accounts(accounts_data, registry))
+
+
+def run_supervisor(accounts_data: list, watch: bool = False):
+    from supervisor import Supervisor
+
+    supervisor = Supervisor(accounts_data, workers=config.SUPERVISOR_WORKERS, run_mode=config.WORKER_RUN_MODE,
+                            status_interval=config.SUPERVISOR_STATUS_INTERVAL, watch=watch,
+                            shutdown_timeout=config.SHUTDOWN_TIMEOUT)
+    # the workers are sent SIGTERM and given SHUTDOWN_TIMEOUT seconds to checkpoint their accounts
+    on_shutdown(supervisor.stop)
+    # the accounts run in the workers, they are the ones to profile
+    setup_profiling(forward=supervisor.signal_workers)
+    supervisor.run()
+
+
+def setup_profiling(forward=None):
+    profiling.profiler.directory = config.PROFILE_DIR
+    profiling.profiler.interval = config.PROFILE_INTERVAL
+    profiling.install_signal_handlers(kind=config.PROFILE_KIND, accounts=config.PROFILE_ACCOUNTS, forward=forward)
+
+
+# a worker process of the supervisor runs its shard with one of the single process runners
+RUNNERS = {
+    "threads": run_threads,
+    "scheduler": run_scheduler,
+    "asyncio": run_asyncio,
+}
+
+
+def get_runner(run_mode: str, setting: str = "WORKER_RUN_MODE"):
+    """The single process runner of `run_mode`, a typo fails instead of running the accounts another way."""
+    if run_mode not in RUNNERS:
+        expected = [*RUNNERS, "supervisor"] if setting == "RUN_MODE" else list(RUNNERS)
+        raise ValueError(f"unknown {setting} {run_mode!r}, expected one of {', '.join(expected)}")
+    return RUNNERS[run_mode]
 
 
 if __name__ == '__main__':
-    threads = []
+    # a typo in RUN_MODE or WORKER_RUN_MODE fails before anything starts
+    if config.RUN_MODE == "supervisor":
+        # the workers run their shard with it
+        get_runner(config.WORKER_RUN_MODE)
+    else:
+        runner = get_runner(config.RUN_MODE, setting="RUN_MODE")
+    if config.METRICS_PORT:
+        routes = {}
+        if config.RUN_MODE != "supervisor":
+            routes["/profile"] = partial(profiling.handle_request, kind=config.PROFILE_KIND,
+                                         accounts=config.PROFILE_ACCOUNTS)
+        metrics.start_server(port=config.METRICS_PORT, address=config.METRICS_ADDRESS, routes=routes)
+    if config.RUN_MODE != "supervisor":
+        setup_profiling()
+
+    # accounts of ACCOUNTS_FILE are watched for changes, the ones of the env variables are fixed
+    registry = get_registry()
+    accounts_data = config.ACCOUNTS if registry is None else registry.load()
+
     try:
-        for account_data in config.ACCOUNTS:
-            account = Account(
-                name=account_data["name"],
-                bearer_token=account_data["bear_token"],
-                user_agent=account_data["user_agent"]
-            )
-            threads.append(threading.Thread(target=account.start, name=f"{account_data['name']} tg account"))
-            time.sleep(random.randint(10, 60))
-
-        list(map(lambda x: x.start(), threads))
-        list(map(lambda x: x.join(), threads))
+        if config.RUN_MODE == "supervisor":
+            run_supervisor(accounts_data, watch=registry is not None)
+        else:
+            runner(accounts_data, registry)
     except Exception as e:
         logger.error(e)
         time.sleep(10)
@@ -0,0 +1,221 @@
+import bisect
+import logging
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    """
+    Counters, histograms and gauges exported in the Prometheus text format.
+
+    Every thread writes into its own shard, so recording never takes a lock, only the first write
+    of a thread does. A scrape copies and sums the shards. Gauges are last-write-wins values in a
+    shared dict. Nothing is recorded until `enabled` is set, which `start_server` does.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.enabled = False
+        self._types = {}
+        self._help = {}
+        self._shards = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._gauges = {}
+        self._remote = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._types[name] = kind
+        self._help[name] = help_text
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name: str, labels: tuple, value: float = 1):
+        if not self.enabled:
+            return
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        """Histogram sample, stored as per-bucket counts followed by sum and count."""
+        if not self.enabled:
+            return
+        shard = self._shard()
+        key = (name, labels)
+        histogram = shard.get(key)
+        if histogram is None:
+            histogram = shard[key] = [0] * (len(self.BUCKETS) + 3)
+        histogram[bisect.bisect_left(self.BUCKETS, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def set_gauge(self, name: str, labels: tuple, value: float):
+        if self.enabled:
+            self._gauges[(name, labels)] = value
+
+    def set_remote(self, source: str, values: dict):
+        """Replace the last `snapshot` received from another process, it is added to every scrape."""
+        with self._lock:
+            self._remote[source] = values
+
+    def snapshot(self) -> dict:
+        """Every value of this process, picklable, for `set_remote` of a supervisor."""
+        return self._collect()
+
+    def _collect(self) -> dict:
+        with self._lock:
+            shards = list(self._shards) + list(self._remote.values())
+        totals = {}
+        for shard in shards:
+            for key, value in dict(shard).items():
+                if isinstance(value, list):
+                    total = totals.setdefault(key, [0] * len(value))
+                    for i, x in enumerate(value):
+                        total[i] += x
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        totals.update(dict(self._gauges))
+        return totals
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in labels]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> str:
+        by_name = {}
+        for (name, labels), value in self._collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            kind = self._types.get(name, "untyped")
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name]):
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), value):
+                    cumulative += count
+                    le = 'le="' + str(bound) + '"'
+                    lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{self._labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.describe("hk_request_duration_seconds", "histogram", "HTTP request latency per endpoint and phase.")
+registry.describe("hk_requests_total", "counter", "HTTP requests per endpoint, account, phase and status.")
+registry.describe("hk_api_errors_total", "counter", "APIError raised per endpoint and account.")
+registry.describe("hk_bytes_total", "counter", "Request and response body bytes per endpoint and account.")
+registry.describe("hk_retries_total", "counter", "Requests repeated after a failure per endpoint and account.")
+registry.describe("hk_tap_coins_total", "counter", "Coins earned by tap requests per account.")
+registry.describe("hk_tap_requests_total", "counter", "Tap, boost list and boost purchase requests per account.")
+registry.describe("hk_account_balance_coins", "gauge", "Projected balance of the account.")
+registry.describe("hk_account_earn_passive_per_hour", "gauge", "Passive income of the account.")
+registry.describe("hk_account_available_taps", "gauge", "Projected available taps of the account.")
+registry.describe("hk_account_spend_tokens", "gauge", "Coins spent on cards since start.")
+registry.describe("hk_account_next_wakeup_timestamp", "gauge", "Unix time of the next step of the account.")
+registry.describe("hk_worker_up", "gauge", "1 while the worker process of the shard is running.")
+registry.describe("hk_worker_restarts", "gauge", "Times the worker process of the shard was restarted.")
+registry.describe("hk_worker_accounts", "gauge", "Accounts assigned to the shard.")
+registry.describe("hk_worker_threads", "gauge", "Threads of the worker process.")
+registry.describe("hk_worker_max_rss_bytes", "gauge", "Peak resident memory of the worker process.")
+
+
+def record_request(account: str, endpoint: str, phase: str, seconds: float, status: int, sent: int = 0,
+                   received: int = 0):
+    """One finished HTTP exchange, `phase` is `preflight` for the OPTIONS request and `request` otherwise."""
+    if not registry.enabled:
+        return
+    account = account or ""
+    registry.observe("hk_request_duration_seconds", (("endpoint", endpoint), ("phase", phase)), seconds)
+    registry.inc("hk_requests_total",
+                 (("account", account), ("endpoint", endpoint), ("phase", phase), ("status", status)))
+    if sent:
+        registry.inc("hk_bytes_total", (("account", account), ("direction", "sent"), ("endpoint", endpoint)), sent)
+    if received:
+        registry.inc("hk_bytes_total", (("account", account), ("direction", "received"), ("endpoint", endpoint)),
+                     received)
+
+
+def record_error(account: str, endpoint: str):
+    registry.inc("hk_api_errors_total", (("account", account or ""), ("endpoint", endpoint)))
+
+
+def record_retry(account: str, endpoint: str):
+    registry.inc("hk_retries_total", (("account", account or ""), ("endpoint", endpoint)))
+
+
+def record_taps(account: str, coins: int, requests: int):
+    registry.inc("hk_tap_coins_total", (("account", account),), coins)
+    registry.inc("hk_tap_requests_total", (("account", account),), requests)
+
+
+def set_account_gauges(account: str, **values):
+    """`hk_account_<name>` gauges of one account, e.g. `set_account_gauges(name, balance_coins=...)`."""
+    for name, value in values.items():
+        registry.set_gauge(f"hk_account_{name}", (("account", account),), value)
+
+
+def start_server(port: int, address: str = "127.0.0.1", routes: dict = None) -> ThreadingHTTPServer:
+    """
+    Serve `/metrics` on a daemon thread and start recording. `routes` adds paths answered by
+    `handler(method, query) -> (status, body)`, e.g. the `/profile` controls.
+    """
+    routes = routes or {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, body: bytes, content_type: str = "text/plain; charset=utf-8"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self, method: str) -> bool:
+            path, _, query = self.path.partition("?")
+            handler = routes.get(path)
+            if handler is None:
+                return False
+            status, body = handler(method, dict(urllib.parse.parse_qsl(query)))
+            self._reply(status, body.encode())
+            return True
+
+        def do_GET(self):
+            if self._route("GET"):
+                return
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            self._reply(200, registry.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+        def do_POST(self):
+            if not self._route("POST"):
+                self.send_error(404)
+
+    registry.enabled = True
+    httpd = ThreadingHTTPServer((address, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"metrics are served on http://{address}:{httpd.server_port}/metrics")
+    return httpd
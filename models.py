@@ -0,0 +1,193 @@
+import json
+import sys
+from array import array
+
+try:
+    import orjson
+except ImportError:  # optional, `pip install orjson` for faster response decoding
+    orjson = None
+
+
+def loads(content):
+    """Parse a response body, with `orjson` when it is installed."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+class Model:
+    """
+    A record decoded from one JSON object of a response.
+
+    `FIELDS` lists `(attribute, response key, default)` of the only keys the bot reads, the rest of
+    the object is dropped. Subclasses declare `__slots__` from `FIELDS`, so a record is a few
+    pointers instead of a dict with every field of the response.
+    """
+    __slots__ = ()
+    FIELDS: tuple = ()
+
+    def __init__(self, **values):
+        for name, _, default in self.FIELDS:
+            setattr(self, name, values.get(name, default))
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        model = cls.__new__(cls)
+        for name, key, default in cls.FIELDS:
+            setattr(model, name, data.get(key, default))
+        return model
+
+    @classmethod
+    def from_list(cls, items) -> list:
+        return [cls.from_dict(item) for item in items or ()]
+
+    def to_dict(self) -> dict:
+        """Back to the response keys, the state store keeps records in this form."""
+        return {key: getattr(self, name) for name, key, _ in self.FIELDS}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name, _, _ in self.FIELDS)
+        return f"{self.__class__.__name__}({values})"
+
+
+class ClickerUser(Model):
+    FIELDS = (
+        ("balance_coins", "balanceCoins", 0),
+        ("available_taps", "availableTaps", 0),
+        ("max_taps", "maxTaps", 0),
+        ("earn_per_tap", "earnPerTap", 1),
+        # older responses do not carry it, the last known value is kept then
+        ("taps_recover_per_sec", "tapsRecoverPerSec", None),
+        ("earn_passive_per_hour", "earnPassivePerHour", 0),
+        ("balance_keys", "balanceKeys", 0),
+        ("total_keys", "totalKeys", 0),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class Upgrade(Model):
+    FIELDS = (
+        ("id", "id", ""),
+        ("name", "name", ""),
+        ("level", "level", 0),
+        ("price", "price", 0),
+        ("profit_per_hour_delta", "profitPerHourDelta", 0),
+        ("cooldown_seconds", "cooldownSeconds", 0),
+        ("is_available", "isAvailable", False),
+        ("is_expired", "isExpired", False),
+        # what unlocks a card that is not available, e.g. `{"_type": "ByUpgrade", "upgradeId": ..., "level": 5}`
+        ("condition", "condition", None),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class Boost(Model):
+    FIELDS = (
+        ("id", "id", ""),
+        ("price", "price", -1),
+        ("level", "level", 0),
+        ("max_level", "maxLevel", 0),
+        ("cooldown_seconds", "cooldownSeconds", 999999),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class Task(Model):
+    FIELDS = (
+        ("id", "id", ""),
+        ("type", "type", ""),
+        ("is_completed", "isCompleted", False),
+        ("reward_coins", "rewardCoins", 0),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class Promo(Model):
+    FIELDS = (
+        ("promo_id", "promoId", ""),
+        ("keys_per_day", "keysPerDay", 1),
+        # from `states` of the same response
+        ("receive_keys_today", "receiveKeysToday", 0),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+    @classmethod
+    def from_response(cls, response: dict) -> list:
+        """`get-promos` joined with today's state of every promo."""
+        received = {state.get("promoId"): state.get("receiveKeysToday", 0) for state in response.get("states", [])}
+        promos = cls.from_list(response.get("promos"))
+        for promo in promos:
+            promo.receive_keys_today = received.get(promo.promo_id, 0)
+        return promos
+
+
+class UpgradeTable:
+    """
+    `upgradesForBuy` as one row per card in parallel arrays.
+
+    Price, profit and cooldown are machine numbers in `array`s and the availability flags are a
+    `bytearray`, card ids and names are interned and so shared by every account. Ranking reads
+    the arrays directly, an `Upgrade` is only built for the few cards the planner hands out.
+    `conditions` holds the unlock condition of a card as received, None for most of them.
+    """
+    __slots__ = ("ids", "names", "levels", "prices", "profits", "cooldowns", "flags", "conditions", "index")
+
+    AVAILABLE = 1
+    EXPIRED = 2
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.levels = array("l")
+        self.prices = array("q")
+        self.profits = array("q")
+        self.cooldowns = array("d")
+        self.flags = bytearray()
+        self.conditions = []
+        self.index = {}
+
+    @classmethod
+    def from_list(cls, upgrades) -> "UpgradeTable":
+        table = cls()
+        for upgrade in upgrades or ():
+            table.append(upgrade)
+        return table
+
+    def append(self, upgrade: dict):
+        card_id = sys.intern(upgrade["id"])
+        self.index[card_id] = len(self.ids)
+        self.ids.append(card_id)
+        self.names.append(sys.intern(upgrade.get("name", card_id)))
+        self.levels.append(int(upgrade.get("level", 0)))
+        self.prices.append(int(upgrade.get("price", 0)))
+        self.profits.append(int(upgrade.get("profitPerHourDelta", 0)))
+        self.cooldowns.append(upgrade.get("cooldownSeconds", 0) or 0)
+        self.flags.append((self.AVAILABLE if upgrade.get("isAvailable", False) else 0)
+                          | (self.EXPIRED if upgrade.get("isExpired", False) else 0))
+        self.conditions.append(upgrade.get("condition") or None)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, card_id: str) -> bool:
+        return card_id in self.index
+
+    def is_available(self, row: int) -> bool:
+        return self.flags[row] == self.AVAILABLE
+
+    def upgrade(self, row: int) -> Upgrade:
+        flags = self.flags[row]
+        return Upgrade(id=self.ids[row], name=self.names[row], level=self.levels[row], price=self.prices[row],
+                       profit_per_hour_delta=self.profits[row], cooldown_seconds=self.cooldowns[row],
+                       is_available=bool(flags & self.AVAILABLE), is_expired=bool(flags & self.EXPIRED),
+                       condition=self.conditions[row])
+
+    def get(self, card_id: str):
+        row = self.index.get(card_id)
+        return None if row is None else self.upgrade(row)
+
+    def to_list(self) -> list:
+        return [self.upgrade(row).to_dict() for row in range(len(self))]
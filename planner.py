@@ -0,0 +1,187 @@
+import heapq
+
+from clock import SystemClock, system_clock
+from hamster_kombat import HamsterKombatUtils
+from models import Upgrade, UpgradeTable
+from upgrade_graph import UpgradeGraph
+
+
+class UpgradePlanner:
+    """
+    Ranks one `upgradesForBuy` snapshot and hands out cards in purchase order.
+
+    Cards live in a heap keyed by (-profit coefficient, payback hours, price). The ranking is updated
+    incrementally from the `upgradesForBuy` list returned by `buy-upgrade`, stale heap entries are
+    skipped lazily, so buying several cards in a cycle needs a single `upgrades-for-buy` request.
+    Ranking reads the price and profit arrays of the `UpgradeTable`, cards are handed out as `Upgrade`.
+
+    With `lookahead` a card is ranked by the `UpgradeGraph` value of its purchase, itself and the
+    locked cards it unlocks, so a prerequisite of a better card is bought to open it.
+    """
+    utils = HamsterKombatUtils
+
+    def __init__(self, upgrades: UpgradeTable, balance: int, earn_passive_per_hour: int, target_balance: int,
+                 max_card_price: int, parallel_update: bool = True, lookahead: bool = True,
+                 clock: SystemClock = None):
+        self.clock = system_clock if clock is None else clock
+        self.balance = balance
+        self.earn_passive_per_hour = earn_passive_per_hour
+        self.target_balance = target_balance
+        self.max_card_price = max_card_price
+        self.parallel_update = parallel_update
+        self.graph = UpgradeGraph(max_card_price=max_card_price) if lookahead else None
+
+        self._heap = []
+        self._keys = {}
+        self._table = UpgradeTable()
+        self.update(upgrades)
+
+    @property
+    def min_profit_coefficient(self) -> float:
+        return self.utils.profit_coefficient(price=self.target_balance - self.balance,
+                                             profit=self.earn_passive_per_hour)
+
+    @classmethod
+    def rank_key(cls, price: int, profit: int) -> tuple:
+        return -cls.utils.profit_coefficient(price, profit), price / profit, price
+
+    def _is_candidate(self, table: UpgradeTable, row: int) -> bool:
+        return table.is_available(row) and table.profits[row] > 0 and table.prices[row] <= self.max_card_price
+
+    def update(self, upgrades: UpgradeTable):
+        """Apply a fresh `upgradesForBuy` table, only cards whose ranking changed are pushed again."""
+        # `cooldownSeconds` of the cards are relative to this moment
+        self.updated_at = self.clock.time()
+        self._table = upgrades
+        if self.graph is not None:
+            self.graph.update(upgrades)
+        keys = {}
+        prices, profits = upgrades.prices, upgrades.profits
+        for row, card_id in enumerate(upgrades.ids):
+            if not self._is_candidate(upgrades, row):
+                continue
+
+            if self.graph is not None:
+                key = self.rank_key(*self.graph.value(card_id))
+            else:
+                key = self.rank_key(prices[row], profits[row])
+            keys[card_id] = key
+            if self._keys.get(card_id) != key:
+                heapq.heappush(self._heap, (key, card_id))
+        self._keys = keys
+        # a planner kept across cycles drops the stale entries now and then instead of growing the heap
+        if len(self._heap) > 2 * len(keys) + 64:
+            self._heap = [(key, card_id) for card_id, key in keys.items()]
+            heapq.heapify(self._heap)
+
+    def refresh(self, upgrades: UpgradeTable, balance: int, earn_passive_per_hour: int):
+        """Start the next cycle from a fresh `upgradesForBuy` table, the cards that did not change keep their rank."""
+        self.balance = balance
+        self.earn_passive_per_hour = earn_passive_per_hour
+        self.update(upgrades)
+
+    def _cooldown(self, card_id: str) -> float:
+        return self._table.cooldowns[self._table.index[card_id]]
+
+    def _peek(self):
+        while self._heap:
+            key, card_id = self._heap[0]
+            if self._keys.get(card_id) == key:
+                return card_id
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_ready(self):
+        """Id of the best card that is not on cooldown, respecting `parallel_update` like the old selection did."""
+        skipped = []
+        try:
+            while (card_id := self._peek()) is not None:
+                if self._cooldown(card_id) == 0:
+                    return card_id
+                if not self.parallel_update:
+                    return None
+                skipped.append(heapq.heappop(self._heap))
+            return None
+        finally:
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+
+    def unlocks(self, upgrade: Upgrade) -> list:
+        """The locked cards the purchase of `upgrade` was ranked with, in the order they would be bought."""
+        if self.graph is None:
+            return []
+        return [self._table.get(card_id) for card_id in self.graph.chain(upgrade.id)[1:]]
+
+    def next_purchase(self) -> Upgrade:
+        """Best card worth buying now, `None` when there is none. The card may still cost more than `balance`."""
+        card_id = self._pop_ready()
+        if card_id is None:
+            return None
+        if -self._keys[card_id][0] < self.min_profit_coefficient:
+            return None
+        return self._table.get(card_id)
+
+    def apply_purchase(self, upgrade: Upgrade, response: dict = None):
+        """Account for a bought card, re-ranking from the `buy-upgrade` response when there is one."""
+        self._keys.pop(upgrade.id, None)
+        if response and "clickerUser" in response:
+            self.balance = response["clickerUser"].get("balanceCoins", self.balance - upgrade.price)
+            self.earn_passive_per_hour = response["clickerUser"].get(
+                "earnPassivePerHour", self.earn_passive_per_hour + upgrade.profit_per_hour_delta
+            )
+        else:
+            self.balance -= upgrade.price
+            self.earn_passive_per_hour += upgrade.profit_per_hour_delta
+
+        if response and isinstance(response.get("upgradesForBuy"), list):
+            self.update(UpgradeTable.from_list(response["upgradesForBuy"]))
+
+    def seconds_until_next_purchase(self):
+        """
+        Seconds after `updated_at` until `next_purchase` returns a card the balance, growing at
+        `earn_passive_per_hour`, can cover. `None` when that never happens with this snapshot.
+        """
+        table = self._table
+        best = None
+        better_cooldown = float("inf")
+        for key, card_id in sorted((key, card_id) for card_id, key in self._keys.items()):
+            if -key[0] < self.min_profit_coefficient:
+                break
+            row = table.index[card_id]
+            cooldown = table.cooldowns[row]
+            missing = table.prices[row] - self.balance
+            if missing <= 0:
+                wait = cooldown
+            elif self.earn_passive_per_hour > 0:
+                wait = max(cooldown, missing / self.earn_passive_per_hour * 3600)
+            else:
+                wait = None
+
+            # the card is only picked while every better card is still on cooldown
+            if wait is not None and wait < better_cooldown:
+                best = wait if best is None else min(best, wait)
+            better_cooldown = min(better_cooldown, cooldown)
+            if not self.parallel_update or better_cooldown <= 0:
+                break
+        return best
+
+    def snapshot(self) -> list:
+        """Every known card as of `updated_at`, enough to rebuild the planner after a restart."""
+        return self._table.to_list()
+
+    def plan(self) -> list:
+        """
+        The purchase sequence for this cycle projected from the current snapshot and balance.
+        Stops at the first card the balance can not cover, cheaper cards are not bought ahead of it.
+        """
+        heap, keys = list(self._heap), dict(self._keys)
+        balance, earn = self.balance, self.earn_passive_per_hour
+        sequence = []
+        try:
+            while (upgrade := self.next_purchase()) is not None and upgrade.price <= self.balance:
+                sequence.append(upgrade)
+                self.apply_purchase(upgrade)
+        finally:
+            self._heap, self._keys = heap, keys
+            self.balance, self.earn_passive_per_hour = balance, earn
+        return sequence
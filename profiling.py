@@ -0,0 +1,370 @@
+import cProfile
+import collections
+import dis
+import inspect
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+
+logger = logging.getLogger(__name__)
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+MEMORY = "memory"
+KINDS = (SAMPLE, CPROFILE, MEMORY)
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SampleCapture:
+    """
+    Samples the stacks of every thread each `interval` seconds and counts the ones inside a scope
+    of `profiled`, from the outermost scope down, under the name of its account. Written as folded
+    stacks, `flamegraph.pl`, speedscope and inferno read them. Async tasks are told apart by the
+    scope of the coroutine running when the sample is taken.
+    """
+    kind = SAMPLE
+
+    def __init__(self, path: str, accounts: frozenset = None, interval: float = 0.01):
+        self.path = path
+        self.accounts = accounts
+        self.interval = interval
+        self.samples = collections.Counter()
+        # frame of a running scope -> its account, read by the sampler thread
+        self.scopes = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def enter(self, frame, account: str):
+        self.scopes.setdefault(frame, account)
+        return frame
+
+    def exit(self, frame):
+        self.scopes.pop(frame, None)
+
+    def _sample(self):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            labels, account, cut = [], None, 0
+            while frame is not None:
+                # the outermost scope wins, the stack is cut above it
+                if frame in self.scopes:
+                    account, cut = self.scopes[frame], len(labels)
+                if frame.f_code not in _SCOPE_CODES:
+                    labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if account is not None:
+                self.samples[";".join([account, *reversed(labels[:cut])])] += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def stop(self) -> list:
+        self._stopped.set()
+        self._thread.join()
+        with open(self.path, "w", encoding="utf-8") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+        logger.info("%d samples of %d stacks written to %s", sum(self.samples.values()), len(self.samples), self.path)
+        return [self.path]
+
+
+class CProfileCapture:
+    """
+    Deterministic `cProfile` of the scopes of `profiled`, a profiler per account and thread that
+    runs while the thread is inside a scope of the account, written per account as `pstats` files
+    for snakeviz, gprof2dot or flameprof. A scope still running on `stop` is written when it ends.
+    On an event loop a scope spans its awaits, the loop and the tasks run meanwhile are counted in it.
+    """
+    kind = CPROFILE
+
+    def __init__(self, path: str, accounts: frozenset = None):
+        self.path = path
+        self.accounts = accounts
+        self.stopped = False
+        # (thread, account) -> [profile, depth]
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self):
+        pass
+
+    def _account_path(self, account: str) -> str:
+        root, ext = os.path.splitext(self.path)
+        return f"{root}-{account}{ext}"
+
+    def enter(self, frame, account: str):
+        key = (threading.get_ident(), account)
+        with self._lock:
+            entry = self._profiles.setdefault(key, [cProfile.Profile(), 0])
+            entry[1] += 1
+            if entry[1] > 1:
+                return key
+        # one profiler per thread, a scope of another account nested in this one is counted in it
+        if getattr(self._local, "active", None) is None:
+            try:
+                entry[0].enable()
+                self._local.active = key
+            except ValueError:
+                # python 3.12 allows one profiler per process, this thread is not profiled
+                pass
+        return key
+
+    def exit(self, key):
+        with self._lock:
+            entry = self._profiles[key]
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+        if getattr(self._local, "active", None) == key:
+            entry[0].disable()
+            self._local.active = None
+        if self.stopped:
+            self._write(key)
+
+    def _write(self, key):
+        with self._lock:
+            entry = self._profiles.get(key)
+            if entry is None or entry[1] > 0:
+                return
+            del self._profiles[key]
+            path = self._account_path(key[1])
+            stats = pstats.Stats(entry[0])
+            if not stats.stats:
+                return
+            if os.path.exists(path):
+                stats.add(path)
+            stats.dump_stats(path)
+
+    def stop(self) -> list:
+        self.stopped = True
+        paths = sorted({self._account_path(account) for _, account in self._profiles})
+        for key in list(self._profiles):
+            self._write(key)
+        logger.info("cProfile stats written to %s", ", ".join(paths) or "nothing, no scope ran")
+        return paths
+
+
+class MemoryCapture:
+    """
+    `tracemalloc` from start to stop. The allocations made inside a scope of `profiled` and still
+    alive on stop are written as folded stacks weighted by bytes, and the whole snapshot next to
+    them for `python -m tracemalloc`-style analysis. Allocations are not told apart by account.
+    """
+    kind = MEMORY
+
+    def __init__(self, path: str, accounts: frozenset = None, frames: int = 64):
+        self.path = path
+        self.accounts = accounts
+        self.frames = frames
+
+    def start(self):
+        tracemalloc.start(self.frames)
+
+    def enter(self, frame, account: str):
+        return None
+
+    def exit(self, token):
+        pass
+
+    def stop(self) -> list:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot_path = os.path.splitext(self.path)[0] + ".tracemalloc"
+        snapshot.dump(snapshot_path)
+
+        scoped = snapshot.filter_traces([tracemalloc.Filter(True, __file__, all_frames=True)])
+        scope_lines = {line for code in _SCOPE_CODES for _, line in dis.findlinestarts(code)}
+        stacks = collections.Counter()
+        for statistic in scoped.statistics("traceback"):
+            # oldest first, cut above the outermost scope
+            own = [index for index, frame in enumerate(statistic.traceback)
+                   if frame.filename == __file__ and frame.lineno in scope_lines]
+            if not own:
+                continue
+            stacks[";".join(f"{os.path.basename(frame.filename)}:{frame.lineno}"
+                            for index, frame in enumerate(statistic.traceback) if index > own[0] and index not in own)
+                   ] += statistic.size
+        with open(self.path, "w", encoding="utf-8") as file:
+            for stack, size in stacks.most_common():
+                file.write(f"{stack} {size}\n")
+        for statistic in scoped.statistics("lineno")[:10]:
+            logger.info("%s", statistic)
+        return [self.path, snapshot_path]
+
+
+CAPTURES = {
+    SAMPLE: SampleCapture,
+    CPROFILE: CProfileCapture,
+    MEMORY: MemoryCapture,
+}
+
+
+class Profiler:
+    """
+    Captures started and stopped at runtime, one of each kind at a time, by `start`/`stop`, a
+    signal or the `/profile` endpoint of the metrics server. Output goes to `directory` named by
+    kind, process and start time, so captures of the supervisor workers do not collide.
+    """
+
+    def __init__(self, directory: str = "profiles", interval: float = 0.01):
+        self.directory = directory
+        self.interval = interval
+        self.captures = {}
+        self._lock = threading.Lock()
+        self._timers = {}
+
+    def start(self, kind: str = SAMPLE, accounts=None, seconds: float = None) -> bool:
+        """Start a capture of `accounts`, every account when empty, stopped after `seconds` when given."""
+        if kind not in CAPTURES:
+            raise ValueError(f"unknown profile kind {kind!r}, expected one of {', '.join(KINDS)}")
+        with self._lock:
+            if kind in self.captures:
+                return False
+            os.makedirs(self.directory, exist_ok=True)
+            ext = "prof" if kind == CPROFILE else "folded"
+            path = os.path.join(self.directory, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}")
+            options = {"interval": self.interval} if kind == SAMPLE else {}
+            capture = CAPTURES[kind](path, accounts=frozenset(accounts) if accounts else None, **options)
+            capture.start()
+            self.captures[kind] = capture
+            if seconds:
+                self._timers[kind] = threading.Timer(seconds, self.stop, args=(kind,))
+                self._timers[kind].daemon = True
+                self._timers[kind].start()
+        logger.info("%s profile of %s started", kind, ", ".join(sorted(accounts)) if accounts else "every account")
+        return True
+
+    def stop(self, kind: str = SAMPLE) -> list:
+        """Stop the capture of `kind` and return the files it wrote, empty when none was running."""
+        with self._lock:
+            capture = self.captures.pop(kind, None)
+            timer = self._timers.pop(kind, None)
+        if timer is not None:
+            timer.cancel()
+        return [] if capture is None else capture.stop()
+
+    def toggle(self, kind: str = SAMPLE, accounts=None) -> list:
+        if kind in self.captures:
+            return self.stop(kind)
+        self.start(kind, accounts=accounts)
+        return []
+
+    def status(self) -> dict:
+        return {kind: capture.path for kind, capture in self.captures.items()}
+
+    def scopes(self, account: str) -> list:
+        """The captures that follow `account`, looked up on every call of a scope, so kept cheap."""
+        if not self.captures:
+            return ()
+        return [capture for capture in list(self.captures.values())
+                if capture.accounts is None or account in capture.accounts]
+
+
+profiler = Profiler()
+
+# frames of the scope wrappers themselves, left out of the sampled stacks
+_SCOPE_CODES = set()
+
+
+def profiled(attribute: str = "name"):
+    """
+    Make the decorated method a scope of the profiler for the account named by `attribute` of
+    `self`. Only scopes are sampled and profiled, so `Account.step` and the `_request` of the
+    clients attribute the time to the account, its methods, JSON decoding, logging and the network.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_scope(self, *args, **kwargs):
+                if not (captures := profiler.scopes(getattr(self, attribute, None))):
+                    return await func(self, *args, **kwargs)
+                account, frame = getattr(self, attribute, None) or "-", sys._getframe()
+                tokens = [(capture, capture.enter(frame, account)) for capture in captures]
+                try:
+                    return await func(self, *args, **kwargs)
+                finally:
+                    for capture, token in tokens:
+                        capture.exit(token)
+
+            _SCOPE_CODES.add(async_scope.__code__)
+            return async_scope
+
+        @wraps(func)
+        def scope(self, *args, **kwargs):
+            if not (captures := profiler.scopes(getattr(self, attribute, None))):
+                return func(self, *args, **kwargs)
+            account, frame = getattr(self, attribute, None) or "-", sys._getframe()
+            tokens = [(capture, capture.enter(frame, account)) for capture in captures]
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                for capture, token in tokens:
+                    capture.exit(token)
+
+        _SCOPE_CODES.add(scope.__code__)
+        return scope
+
+    return decorator
+
+
+def handle_request(method: str, query: dict, kind: str = SAMPLE, accounts=None):
+    """
+    `/profile` of the metrics server, `GET` lists the running captures and
+    `POST ?action=start|stop|toggle&kind=...&accounts=a,b&seconds=30` controls them.
+    """
+    if method == "GET":
+        return 200, "".join(f"{kind} {path}\n" for kind, path in profiler.status().items()) or "no capture\n"
+    kind = query.get("kind", kind)
+    action = query.get("action", "toggle")
+    requested = [name for name in query.get("accounts", "").split(",") if name] or accounts
+    try:
+        if action == "start":
+            seconds = float(query["seconds"]) if query.get("seconds") else None
+            started = profiler.start(kind, accounts=requested, seconds=seconds)
+            return (200, f"{kind} started\n") if started else (409, f"{kind} is already running\n")
+        if action == "stop":
+            return 200, "".join(f"{path}\n" for path in profiler.stop(kind)) or f"no {kind} capture\n"
+        if action == "toggle":
+            paths = profiler.toggle(kind, accounts=requested)
+            return 200, "".join(f"{path}\n" for path in paths) or f"{kind} started\n"
+    except ValueError as e:
+        return 400, f"{e}\n"
+    return 400, f"unknown action {action!r}\n"
+
+
+def install_signal_handlers(kind: str = SAMPLE, accounts=None, forward=None):
+    """
+    `SIGUSR1` toggles a capture of `kind`, `SIGUSR2` one of the memory. With `forward` the signal
+    is handed to it instead, the supervisor passes it on to its workers. Main thread only.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    def handler(signum, frame):
+        if forward is not None:
+            forward(signum)
+            return
+        # files are written on a thread, the handler runs between two bytecodes of the main thread
+        toggled = kind if signum == signal.SIGUSR1 else MEMORY
+        threading.Thread(target=profiler.toggle, args=(toggled, accounts), name="profiler toggle",
+                         daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, handler)
+    signal.signal(signal.SIGUSR2, handler)
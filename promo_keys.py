@@ -0,0 +1,215 @@
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from clock import SystemClock, system_clock
+from resilience import get_guard
+from storage import StateStore
+from transport import Transport
+from utils import ClientTokenCache, GamePromo, BColors
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+class PromoKeyPool:
+    """
+    Generates playground promo keys for every account on a shared worker pool.
+
+    `register_event` can wait `delay` seconds up to `maxRetry` times for a single key, so keys are
+    produced here instead of in the account loop. Every finished code is put into the per-account
+    queue in the state store (in memory without one) and the account applies it on its next step.
+    The keys still to generate are checkpointed per account as well, `stop` leaves them for `resume`
+    on the next start instead of dropping the progress.
+    """
+
+    MAX_APPLY_ATTEMPTS = 3
+
+    def __init__(self, store: StateStore = None, workers: int = 4, clock: SystemClock = None,
+                 transport: Transport = None):
+        self.store = store
+        self.workers = max(1, workers)
+        self.clock = system_clock if clock is None else clock
+        # None opens one from the config for every key generated
+        self.transport = transport
+        self.token_cache = ClientTokenCache(ttl=config.PROMO_TOKEN_TTL, store=store)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._in_flight = {}
+        # (account, promo_id) -> (user_agent, promo_data) of the keys in flight
+        self._jobs = {}
+        self._memory = {}
+
+    # region queue
+    def in_flight(self, account: str, promo_id: str) -> int:
+        with self._lock:
+            return self._in_flight.get((account, promo_id), 0)
+
+    def _add_key(self, account: str, promo_id: str, code: str):
+        if self.store is not None:
+            self.store.add_promo_key(account, promo_id, code)
+            return
+        with self._lock:
+            self._memory.setdefault(account, {})[code] = {"code": code, "promo_id": promo_id, "attempts": 0}
+
+    def pending(self, account: str) -> list:
+        """Generated keys the account has not applied yet, oldest first."""
+        if self.store is not None:
+            return self.store.load_promo_keys(account)
+        with self._lock:
+            return [dict(key) for key in self._memory.get(account, {}).values()]
+
+    def queued(self, account: str, promo_id: str) -> int:
+        """Keys of the promo that are generated or being generated and not applied yet."""
+        return self.in_flight(account, promo_id) + sum(key["promo_id"] == promo_id for key in self.pending(account))
+
+    def mark_applied(self, account: str, key: dict):
+        self._finish(account, key, "applied")
+
+    def mark_failed(self, account: str, key: dict):
+        """Keep the key for the next step until it fails `MAX_APPLY_ATTEMPTS` times."""
+        attempts = key["attempts"] + 1
+        self._finish(account, {**key, "attempts": attempts},
+                     "failed" if attempts >= self.MAX_APPLY_ATTEMPTS else "pending")
+
+    def _finish(self, account: str, key: dict, status: str):
+        if self.store is not None:
+            self.store.update_promo_key(key["code"], status, attempts=key["attempts"])
+            return
+        with self._lock:
+            keys = self._memory.get(account, {})
+            if status == "pending":
+                keys[key["code"]] = key
+            else:
+                keys.pop(key["code"], None)
+
+    def prune(self, account: str, keep_days: int):
+        """Delete the keys of the account applied or failed more than `keep_days` ago, the pending ones stay."""
+        if self.store is not None:
+            self.store.prune_promo_keys(keep_days, account=account)
+    # endregion
+
+    def _reserve(self, account: str, user_agent: str, promo_data: dict, count: int):
+        key = (account, promo_data["promoId"])
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + count
+            self._jobs[key] = (user_agent, promo_data)
+        self._checkpoint(account)
+
+    def _release(self, account: str, promo_id: str, count: int = 1):
+        with self._lock:
+            self._in_flight[(account, promo_id)] -= count
+            if self._in_flight[(account, promo_id)] <= 0:
+                self._jobs.pop((account, promo_id), None)
+        self._checkpoint(account)
+
+    def _checkpoint(self, account: str):
+        # frozen once stopped, the keys interrupted then are the ones to resume
+        if self.store is None or self._stopped.is_set():
+            return
+        with self._lock:
+            queue = {
+                promo_id: {"user_agent": user_agent, "promo_data": promo_data,
+                           "count": self._in_flight.get((name, promo_id), 0)}
+                for (name, promo_id), (user_agent, promo_data) in self._jobs.items() if name == account
+            }
+        self.store.save_snapshot(account, "promo_queue", queue)
+
+    def resume(self, account: str):
+        """Submit again the keys of the account a previous run was stopped in the middle of."""
+        queue = None if self.store is None else self.store.load_snapshot(account, "promo_queue")[0]
+        for promo_id, job in (queue or {}).items():
+            if job["count"] > 0 and not self.in_flight(account, promo_id):
+                logger.info(f"[{account}] resuming {job['count']} {job['promo_data'].get('name', 'without_name')} keys")
+                self.submit(account, job["user_agent"], job["promo_data"], count=job["count"])
+
+    def _pause(self, seconds: float) -> bool:
+        return self.clock.wait(self._stopped, seconds)
+
+    def _game_promo(self, account: str, user_agent: str, promo_data: dict,
+                    game_promo_class=GamePromo) -> GamePromo:
+        return game_promo_class(user_agent=user_agent, app_token=promo_data["appToken"],
+                                name=promo_data.get("name", "without_name"),
+                                account=account, token_cache=self.token_cache,
+                                pool_size=config.HTTP_POOL_SIZE, share_session=config.SHARE_HTTP_SESSION,
+                                use_preflight_cache=config.PREFLIGHT_CACHE,
+                                preflight_cache_ttl=config.PREFLIGHT_CACHE_TTL,
+                                guard=get_guard(config.PROMO_API_URL, clock=self.clock),
+                                http_transport=config.HTTP_TRANSPORT, cassette=config.HTTP_CASSETTE,
+                                cassette_mode=config.HTTP_CASSETTE_MODE, url=config.PROMO_API_URL,
+                                transport=self.transport, clock=self.clock, timeout=config.HTTP_TIMEOUT)
+
+    def _store_key(self, account: str, promo_data: dict, promo_code):
+        name = promo_data.get("name", "without_name")
+        if promo_code is None:
+            logger.error(f"[{account}] unable to get {name} in Hamster FAM key.")
+            return
+        logger.info(f"[{account}] {name} key: {promo_code}")
+        self._add_key(account, promo_data["promoId"], promo_code)
+
+    def submit(self, account: str, user_agent: str, promo_data: dict, count: int = 1):
+        """Queue `count` keys of the promo for the account, returns immediately."""
+        if self._stopped.is_set():
+            return
+        self._reserve(account, user_agent, promo_data, count)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="promo_key")
+        self._executor.submit(self._generate, account, user_agent, promo_data, count)
+
+    def _generate(self, account: str, user_agent: str, promo_data: dict, count: int):
+        """
+        Keys of one (account, promo) pair are made one after another, the game counts events per client
+        token, so concurrent keys with the same cached token would take each other's code.
+        """
+        promo_id = promo_data["promoId"]
+        logger.info(BColors.okblue(f"[{account}] start getting key in {promo_data.get('name', 'without_name')} game."))
+        try:
+            with self._game_promo(account, user_agent, promo_data) as game_promo:
+                for _ in range(count):
+                    if self._pause(random.randint(5, 15)):
+                        return
+                    try:
+                        if game_promo.register_event(promo_id=promo_id, max_retry=promo_data.get("maxRetry", 10),
+                                                     delay=promo_data.get("delay", 120), wait=self._pause) is not True:
+                            return
+                        self._store_key(account, promo_data, game_promo.get_key(promo_id=promo_id))
+                    finally:
+                        self._release(account, promo_id, 1)
+                        count -= 1
+        except Exception as e:
+            logger.error(f"[{account}] unable to get promo key: {e}", exc_info=True)
+        finally:
+            self._release(account, promo_id, count)
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=self._stopped.is_set())
+
+    def stop(self):
+        """Stop generating keys, the requests in flight are finished and the keys left checkpointed."""
+        self._stopped.set()
+        self.shutdown(wait=False)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_promo_pool(store: StateStore = None, clock: SystemClock = None, transport: Transport = None) -> PromoKeyPool:
+    """The process wide pool, created on first use with `PROMO_WORKERS` threads and the clock of that caller."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PromoKeyPool(store=store, workers=config.PROMO_WORKERS, clock=clock, transport=transport)
+        return _pool
+
+
+def stop_promo_pool():
+    """Stop the process wide pool when there is one."""
+    with _pool_lock:
+        if _pool is not None:
+            _pool.stop()
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_KEYS = ("name", "bear_token", "user_agent")
+
+
+def read_accounts(path: str):
+    """Yield the accounts of a JSON lines file a line at a time, blank lines and `#` comments are skipped."""
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                account_data = json.loads(line)
+            except ValueError as e:
+                logger.error("%s:%d is not valid JSON: %s", path, number, e)
+                continue
+            if not isinstance(account_data, dict):
+                logger.error("%s:%d is not an object", path, number)
+                continue
+            if missing := [key for key in REQUIRED_KEYS if not account_data.get(key)]:
+                logger.error("%s:%d has no %s", path, number, ", ".join(missing))
+                continue
+            yield account_data
+
+
+class AccountRegistry:
+    """
+    Accounts of a JSON lines file, one `{"name": ..., "bear_token": ..., "user_agent": ...}` per line.
+
+    `watch` checks the file every `interval` seconds and hands the accounts added since the last
+    read to `on_add` and the names of the removed ones to `on_remove`, a changed account goes to
+    both so only it is restarted. A change is applied once the file stayed the same for one check,
+    an editor that truncates and rewrites it does not stop every account in between. `select`
+    keeps only the accounts it returns true for, a worker process of the supervisor runs its shard.
+    """
+
+    def __init__(self, path: str, interval: float = 10, select=None):
+        self.path = path
+        self.interval = interval
+        self.select = select
+        # name -> account data
+        self.accounts = {}
+        self._signature = None
+        self._pending = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _read(self) -> dict:
+        accounts = {}
+        for account_data in read_accounts(self.path):
+            if self.select is not None and not self.select(account_data):
+                continue
+            if account_data["name"] in accounts:
+                logger.warning("account %s is listed twice in %s, the last one is used",
+                               account_data["name"], self.path)
+            accounts[account_data["name"]] = account_data
+        return accounts
+
+    def load(self) -> list:
+        self._signature = self._pending = self._stat()
+        self.accounts = self._read()
+        return list(self.accounts.values())
+
+    def changes(self):
+        """`(added, removed)` since the last read, None while the file is unchanged, settling or missing."""
+        signature = self._stat()
+        if signature is None:
+            if self._signature is not None:
+                logger.warning("%s is missing, the running accounts are kept", self.path)
+            self._signature = self._pending = None
+            return None
+        if signature == self._signature:
+            return None
+        if signature != self._pending:
+            self._pending = signature
+            return None
+
+        try:
+            accounts = self._read()
+        except OSError as e:
+            logger.error("unable to read %s: %s", self.path, e)
+            return None
+        self._signature = signature
+        removed = [name for name, account_data in self.accounts.items() if accounts.get(name) != account_data]
+        added = [account_data for name, account_data in accounts.items() if self.accounts.get(name) != account_data]
+        self.accounts = accounts
+        if added or removed:
+            logger.info("%s changed: %d accounts to start, %d to stop", self.path, len(added), len(removed))
+        return added, removed
+
+    def watch(self, on_add, on_remove, stopped: threading.Event = None):
+        """Block the calling thread applying the changes of the file until `stopped` is set."""
+        stopped = threading.Event() if stopped is None else stopped
+        while not stopped.wait(self.interval):
+            if (changes := self.changes()) is None:
+                continue
+            added, removed = changes
+            if removed:
+                on_remove(removed)
+            if added:
+                on_add(added)
+
+    async def watch_async(self, on_add, on_remove):
+        """`watch` for the asyncio runner, `on_add` is a coroutine function."""
+        while True:
+            await asyncio.sleep(self.interval)
+            if (changes := await asyncio.to_thread(self.changes)) is None:
+                continue
+            added, removed = changes
+            if removed:
+                on_remove(removed)
+            if added:
+                await on_add(added)
+
+
+def get_registry(select=None):
+    """The registry of `ACCOUNTS_FILE`, None when the accounts come from the env variables."""
+    if not config.ACCOUNTS_FILE:
+        return None
+    return AccountRegistry(config.ACCOUNTS_FILE, interval=config.ACCOUNTS_RELOAD_INTERVAL, select=select)
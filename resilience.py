@@ -0,0 +1,313 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from clock import SystemClock, system_clock
+import config
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# queue priorities of `RateLimiter`, lower goes first
+MUTATION = 0
+READ = 1
+
+
+class RateLimiter:
+    """
+    Token bucket of `rate` requests per second with room for `burst` requests, shared by every
+    account talking to one host.
+
+    Callers that have to wait for a token queue up by priority, so while the host is throttled a
+    `MUTATION` (`buy-upgrade`, `claim-*`, ...) goes out before any queued `READ`. `pause` stops
+    the bucket for a while, a 429 with `Retry-After` pauses it for every account at once.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def pause(self, seconds: float):
+        with self._condition:
+            now = time.monotonic()
+            if now + seconds > self._paused_until:
+                self._paused_until = now + seconds
+                # start again from an empty bucket, not with a burst of every waiting request
+                self._tokens = 0.0
+                self._updated = self._paused_until
+
+    def _take(self, ticket: tuple, cost: int) -> float:
+        """Take `cost` tokens for `ticket` and return 0, or return the seconds to wait before trying again."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        if self._waiting[0] != ticket:
+            # somebody with a higher priority or an older ticket is first, it notifies once served
+            return 1 / self.rate
+        if self._tokens < cost:
+            return (cost - self._tokens) / self.rate
+        self._tokens -= cost
+        heapq.heappop(self._waiting)
+        return 0.0
+
+    def _enqueue(self, priority: int) -> tuple:
+        ticket = (priority, next(self._counter))
+        heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _discard(self, ticket: tuple):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+        self._condition.notify_all()
+
+    def acquire(self, priority: int = READ, cost: int = 1):
+        if self.rate <= 0:
+            return
+        cost = min(cost, self.burst)
+        with self._condition:
+            ticket = self._enqueue(priority)
+            try:
+                while (wait := self._take(ticket, cost)) > 0:
+                    self._condition.wait(wait)
+            finally:
+                self._discard(ticket)
+
+    async def acquire_async(self, priority: int = READ, cost: int = 1):
+        if self.rate <= 0:
+            return
+        cost = min(cost, self.burst)
+        with self._condition:
+            ticket = self._enqueue(priority)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._take(ticket, cost)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            with self._condition:
+                self._discard(ticket)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` upstream failures in a row and holds every request to the host
+    for `reset_timeout` seconds. Then a single probe request goes through: success closes the breaker,
+    failure opens it again for twice as long, up to `max_reset_timeout`. Time is read from `clock`,
+    a virtual or scaled clock of the accounts holds them for virtual or scaled seconds.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    # how often requests held behind a probe check whether it is back
+    PROBE_POLL = 1.0
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30,
+                 max_reset_timeout: float = 600, clock: SystemClock = None):
+        self.name = name
+        self.clock = system_clock if clock is None else clock
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(reset_timeout, max_reset_timeout)
+        self.state = self.CLOSED
+        self._failures = 0
+        self._timeout = reset_timeout
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        """Seconds the caller has to hold its request, 0 lets it through."""
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return 0.0
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            now = self.clock.time()
+            if now < self._retry_at:
+                wait = self._retry_at - now
+                return min(wait, self.PROBE_POLL) if self.state == self.HALF_OPEN else wait
+            # open long enough, or the last probe never came back: this caller is the probe
+            self.state = self.HALF_OPEN
+            self._retry_at = now + self._timeout
+            return 0.0
+
+    def record_success(self):
+        if self.state == self.CLOSED and self._failures == 0:
+            return
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("circuit of %s closed", self.name)
+            self.state = self.CLOSED
+            self._failures = 0
+            self._timeout = self.reset_timeout
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN:
+                self._timeout = min(self._timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif self.state == self.CLOSED and self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._retry_at = self.clock.time() + self._timeout
+        logger.warning("circuit of %s opened after %d failures, requests are held for %.0f seconds",
+                       self.name, self._failures, self._timeout)
+
+
+class RetryPolicy:
+    """Up to `attempts` retries with full jitter exponential backoff, never sooner than `Retry-After`."""
+
+    def __init__(self, attempts: int = 3, backoff: float = 1.0, max_backoff: float = 60.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, retry: int, retry_after: float = None) -> float:
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+        return delay if retry_after is None else max(delay, retry_after)
+
+
+class HostGuard:
+    """
+    Rate limiter, circuit breaker and retry policy of one upstream host.
+
+    A request failed with 429, 5xx or one of the client's transport errors counts against the breaker,
+    any other error means the host is alive and is raised at once. A 429 or a connection that never
+    opened is retried, the rest only for `idempotent` templates: a request that changes the game state,
+    `buy-upgrade`, `tap`, `claim-*`, may have been applied before the answer was lost. The limiter runs
+    on the monotonic clock since it protects the real upstream, while requests held by the breaker sleep
+    on its clock and the backoff between retries on the client's clock, like every other sleep of an
+    account.
+    """
+
+    def __init__(self, host: str, limiter: RateLimiter, breaker: CircuitBreaker, retry: RetryPolicy):
+        self.host = host
+        self.limiter = limiter
+        self.breaker = breaker
+        self.retry = retry
+
+    @staticmethod
+    def _priority(template) -> int:
+        # every endpoint with a body changes the game state
+        return MUTATION if template.has_body else READ
+
+    @staticmethod
+    def _cost(template) -> int:
+        return 2 if template.needs_preflight() else 1
+
+    @staticmethod
+    def is_upstream_failure(error: Exception, transport_errors: tuple = ()) -> bool:
+        status = getattr(error, "status", None)
+        return isinstance(error, transport_errors) or status == 429 or (isinstance(status, int) and status >= 500)
+
+    @staticmethod
+    def is_retryable(error: Exception, template, connect_errors: tuple = ()) -> bool:
+        """An upstream failure the request can be sent again after, it was not applied or applying it twice is fine."""
+        return template.idempotent or getattr(error, "status", None) == 429 or isinstance(error, connect_errors)
+
+    def _failed(self, error: Exception, retry: int, template, transport_errors: tuple, connect_errors: tuple):
+        """Count the failure, returns the seconds to wait before the next attempt or None to give up."""
+        if not self.is_upstream_failure(error, transport_errors):
+            self.breaker.record_success()
+            return None
+
+        self.breaker.record_failure()
+        retry_after = getattr(error, "retry_after", None)
+        if getattr(error, "status", None) == 429:
+            self.limiter.pause(retry_after if retry_after is not None else self.retry.delay(retry))
+        if retry >= self.retry.attempts or not self.is_retryable(error, template, connect_errors):
+            return None
+        return self.retry.delay(retry, retry_after)
+
+    def _log_retry(self, template, error: Exception, retry: int, delay: float, account: str):
+        logger.warning("[%s] %s failed: %s, retry %d/%d in %.1f seconds", account, template.path, error, retry + 1,
+                       self.retry.attempts, delay, extra={"account": account, "path": template.path})
+        metrics.record_retry(account, template.path)
+
+    def call(self, send, template, clock: SystemClock = system_clock, transport_errors: tuple = (),
+             connect_errors: tuple = (), account: str = None):
+        """`send()` once the host lets it through, retried on upstream failures."""
+        retry = 0
+        while True:
+            while (wait := self.breaker.wait_time()) > 0:
+                self.breaker.clock.sleep(wait)
+            self.limiter.acquire(self._priority(template), self._cost(template))
+            try:
+                result = send()
+            except Exception as e:
+                delay = self._failed(e, retry, template, transport_errors, connect_errors)
+                if delay is None:
+                    raise
+                self._log_retry(template, e, retry, delay, account)
+                clock.sleep(delay)
+                retry += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, send, template, clock: SystemClock = system_clock, transport_errors: tuple = (),
+                         connect_errors: tuple = (), account: str = None):
+        """`call` for coroutines, `send` returns a new awaitable every time."""
+        retry = 0
+        while True:
+            while (wait := self.breaker.wait_time()) > 0:
+                await self.breaker.clock.sleep_async(wait)
+            await self.limiter.acquire_async(self._priority(template), self._cost(template))
+            try:
+                result = await send()
+            except Exception as e:
+                delay = self._failed(e, retry, template, transport_errors, connect_errors)
+                if delay is None:
+                    raise
+                self._log_retry(template, e, retry, delay, account)
+                await clock.sleep_async(delay)
+                retry += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+def get_guard(url: str, clock: SystemClock = None) -> HostGuard:
+    """
+    Process wide guard of the host of `url`, configured from `config` on first use. Its breaker keeps
+    the `clock` of that first caller, the accounts of a process share one.
+    """
+    host = url.partition("://")[2].partition("/")[0] or url
+    with _guards_lock:
+        guard = _guards.get(host)
+        if guard is None:
+            guard = _guards[host] = HostGuard(
+                host=host,
+                limiter=RateLimiter(rate=config.RATE_LIMIT, burst=config.RATE_LIMIT_BURST),
+                breaker=CircuitBreaker(name=host, failure_threshold=config.CIRCUIT_FAILURES,
+                                       reset_timeout=config.CIRCUIT_RESET_TIMEOUT, clock=clock),
+                retry=RetryPolicy(attempts=config.RETRY_ATTEMPTS, backoff=config.RETRY_BACKOFF,
+                                  max_backoff=config.RETRY_BACKOFF_MAX),
+            )
+        return guard
@@ -0,0 +1,157 @@
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from account import Account, AccountStopped
+from clock import SystemClock, system_clock
+from profiling import profiled
+
+
+logger = logging.getLogger(__name__)
+
+
+class Pause:
+    """A pause of a step handed to the `Scheduler` instead of sleeping in a worker."""
+    __slots__ = ("seconds",)
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+
+class ScheduledAccount(Account):
+    """
+    `Account` driven by the `Scheduler`. The steps are the ones of `Account`, a pause between two
+    requests is yielded as a `Pause` and waited for in the heap, a worker only runs the requests.
+    """
+
+    def _pause(self, seconds: float) -> Pause:
+        if self.stopped:
+            # the step is repeated on the next start, the jobs it finished are not
+            self.wake_at = self.clock.time()
+            raise AccountStopped(self.name)
+        return Pause(seconds)
+
+    def start_step(self):
+        """A new `step` to `advance`."""
+        return self._step()
+
+    @profiled()
+    def advance(self, steps):
+        """Run `steps` up to its next pause, returns the seconds of the pause or None once the step is done."""
+        result = None
+        try:
+            while True:
+                result = steps.send(result)
+                if isinstance(result, Pause):
+                    return result.seconds
+        except StopIteration:
+            return None
+
+
+class Scheduler:
+    """
+    Drives many accounts from one timer thread.
+
+    Accounts sit in a heap ordered by their next wake-up. When one is due its step runs on a small
+    worker pool up to its next pause, the account goes back into the heap until the pause is over
+    and the step continues on whichever worker is free, so the workers only wait for the network.
+    The wake-up time returned by a finished step puts it back into the heap, an account only runs
+    when `Account.next_wakeup` says there is something useful to do.
+    """
+
+    def __init__(self, workers: int = 4, retry_delay: int = 60, clock: SystemClock = None):
+        self.retry_delay = retry_delay
+        self.clock = system_clock if clock is None else clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # removed account -> set once it is closed
+        self._closed = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="account_worker")
+        self._stopped = False
+
+    def add(self, account: ScheduledAccount, wake_at: float = None, steps=None):
+        """Run `account` at `wake_at`, continuing `steps` when it was paused in the middle of one."""
+        wake_at = account.clock.time() if wake_at is None else wake_at
+        with self._lock:
+            heapq.heappush(self._heap, (wake_at, next(self._counter), account, steps))
+        self._wakeup.set()
+
+    def remove(self, account: ScheduledAccount) -> threading.Event:
+        """
+        Stop `account`, it is closed at once when waiting or after the part of its step that is running.
+        The returned event is set once it is closed.
+        """
+        account.stop()
+        with self._lock:
+            closed = self._closed.setdefault(account, threading.Event())
+            waiting = [entry for entry in self._heap if entry[2] is account]
+            if waiting:
+                self._heap = [entry for entry in self._heap if entry[2] is not account]
+                heapq.heapify(self._heap)
+        for _, _, _, steps in waiting:
+            self._close(account, steps)
+        return closed
+
+    def _close(self, account: ScheduledAccount, steps):
+        try:
+            if steps is not None:
+                steps.close()
+            account.close()
+        finally:
+            with self._lock:
+                closed = self._closed.pop(account, None)
+            if closed is not None:
+                closed.set()
+
+    def _run_step(self, account: ScheduledAccount, steps):
+        if account.stopped:
+            self._close(account, steps)
+            return
+        try:
+            if steps is None:
+                steps = account.start_step()
+            pause = account.advance(steps)
+            wake_at = account.wake_at if pause is None else account.clock.time() + pause
+        except Exception as e:
+            # a stopped account ends its step at the next pause by raising
+            if not account.stopped:
+                logger.error("account %s step failed: %s", account.name, e, exc_info=True,
+                             extra={"account": account.name})
+            steps, pause = None, None
+            wake_at = account.clock.time() + self.retry_delay
+        if account.stopped:
+            self._close(account, steps)
+        elif not self._stopped:
+            self.add(account, wake_at, steps=None if pause is None else steps)
+
+    def run(self):
+        """Block the calling thread dispatching due accounts until `stop`."""
+        while not self._stopped:
+            # cleared before the heap is read, an account added meanwhile sets it again
+            self._wakeup.clear()
+            with self._lock:
+                now = self.clock.time()
+                entry = heapq.heappop(self._heap) if self._heap and self._heap[0][0] <= now else None
+                timeout = self._heap[0][0] - now if entry is None and self._heap else None
+            if entry is not None:
+                _, _, account, steps = entry
+                self._executor.submit(self._run_step, account, steps)
+            elif timeout is None:
+                self._wakeup.wait()
+            else:
+                self.clock.wait(self._wakeup, timeout)
+
+        self._executor.shutdown(wait=True)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def accounts(self) -> list:
+        """The accounts waiting in the heap, with the steps they paused in the middle of."""
+        with self._lock:
+            return [(account, steps) for _, _, account, steps in self._heap]
@@ -0,0 +1,70 @@
+from clock import SystemClock, system_clock
+from models import ClickerUser
+
+
+class AccountState:
+    """
+    Local model of `clickerUser`.
+
+    Every response carrying `clickerUser` (`sync`, `tap`, `buy-upgrade`, `buy-boost`) confirms the state.
+    Between confirmations balance and taps are extrapolated from `earnPassivePerHour` and
+    `tapsRecoverPerSec`, so a full `clicker/sync` is only needed once the extrapolated part grows
+    past `drift_threshold` of the confirmed balance or `sync_interval` seconds pass.
+    """
+    # the game stops passive income when the user has not synced for this long
+    MAX_PASSIVE_HOURS = 3
+
+    balance_coins: int = 0
+    available_taps: int = 0
+    max_taps: int = 0
+    earn_per_tap: int = 1
+    taps_recover_per_sec: int = 0
+    earn_passive_per_hour: int = 0
+    balance_keys: int = 0
+    total_keys: int = 0
+
+    def __init__(self, sync_interval: int = 3600, drift_threshold: float = 0.05, clock: SystemClock = None):
+        self.clock = system_clock if clock is None else clock
+        self.sync_interval = sync_interval
+        self.drift_threshold = drift_threshold
+        self.confirmed_at = None
+
+    @property
+    def is_confirmed(self) -> bool:
+        return self.confirmed_at is not None
+
+    def apply(self, clicker_user: ClickerUser, now: float = None):
+        self.balance_coins = clicker_user.balance_coins
+        self.available_taps = clicker_user.available_taps
+        self.max_taps = clicker_user.max_taps
+        self.earn_per_tap = clicker_user.earn_per_tap
+        if clicker_user.taps_recover_per_sec is not None:
+            self.taps_recover_per_sec = clicker_user.taps_recover_per_sec
+        self.earn_passive_per_hour = clicker_user.earn_passive_per_hour
+        self.balance_keys = clicker_user.balance_keys
+        self.total_keys = clicker_user.total_keys
+        self.confirmed_at = self.clock.time() if now is None else now
+
+    def elapsed(self, now: float = None) -> float:
+        if self.confirmed_at is None:
+            return 0
+        return max(0.0, (self.clock.time() if now is None else now) - self.confirmed_at)
+
+    def passive_income(self, now: float = None) -> int:
+        hours = min(self.elapsed(now) / 3600, self.MAX_PASSIVE_HOURS)
+        return int(self.earn_passive_per_hour * hours)
+
+    def projected_balance(self, now: float = None) -> int:
+        return self.balance_coins + self.passive_income(now)
+
+    def projected_taps(self, now: float = None) -> int:
+        return min(self.max_taps, int(self.available_taps + self.taps_recover_per_sec * self.elapsed(now)))
+
+    def drift(self, now: float = None) -> float:
+        """Extrapolated share of the projected balance that the server has not confirmed yet."""
+        return self.passive_income(now) / max(self.balance_coins, 1)
+
+    def needs_sync(self, now: float = None) -> bool:
+        if self.confirmed_at is None:
+            return True
+        return self.elapsed(now) >= self.sync_interval or self.drift(now) >= self.drift_threshold
@@ -0,0 +1,161 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class StateStore:
+    """
+    SQLite backed state that survives restarts.
+
+    `snapshots` keeps the last payload of every kind per account (`clicker_user`, `config`,
+    `tg_data`, `upgrades`, ...) with the time it was taken, `daily_jobs` keeps which daily job
+    finished on which day, `promo_keys` is the queue of generated promo codes every account drains
+    and `catalog` keeps data shared by all accounts.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            account TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (account, kind)
+        );
+        CREATE TABLE IF NOT EXISTS daily_jobs (
+            account TEXT NOT NULL,
+            day TEXT NOT NULL,
+            job TEXT NOT NULL,
+            status TEXT NOT NULL,
+            data TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (account, day, job)
+        );
+        CREATE TABLE IF NOT EXISTS promo_keys (
+            code TEXT PRIMARY KEY,
+            account TEXT NOT NULL,
+            promo_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS promo_keys_account ON promo_keys (account, status);
+        CREATE TABLE IF NOT EXISTS catalog (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # supervisor workers write the same file from several processes, wait for their locks
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, query: str, params: tuple = ()):
+        with self._lock:
+            return self._connection.execute(query, params).fetchall()
+
+    # region snapshots
+    def save_snapshot(self, account: str, kind: str, data, updated_at: float = None):
+        self._execute(
+            "INSERT OR REPLACE INTO snapshots (account, kind, data, updated_at) VALUES (?, ?, ?, ?)",
+            (account, kind, json.dumps(data), time.time() if updated_at is None else updated_at),
+        )
+
+    def load_snapshot(self, account: str, kind: str, max_age: float = None):
+        """Returns `(data, updated_at)`, or `(None, None)` when there is no snapshot younger than `max_age`."""
+        rows = self._execute("SELECT data, updated_at FROM snapshots WHERE account = ? AND kind = ?", (account, kind))
+        if not rows:
+            return None, None
+        data, updated_at = rows[0]
+        if max_age is not None and time.time() - updated_at > max_age:
+            return None, None
+        return json.loads(data), updated_at
+    # endregion
+
+    # region daily jobs
+    def save_daily_job(self, account: str, day: str, job: str, status: str, data=None):
+        self._execute(
+            "INSERT OR REPLACE INTO daily_jobs (account, day, job, status, data, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (account, day, job, status, None if data is None else json.dumps(data), time.time()),
+        )
+
+    def load_daily_jobs(self, account: str, day: str) -> dict:
+        """`{job: (status, data)}` of everything recorded for `day`."""
+        rows = self._execute("SELECT job, status, data FROM daily_jobs WHERE account = ? AND day = ?", (account, day))
+        return {job: (status, None if data is None else json.loads(data)) for job, status, data in rows}
+
+    def prune_daily_jobs(self, keep_days: int = 7, account: str = None):
+        """Delete the jobs recorded more than `keep_days` ago, of `account` or of every account."""
+        if account is None:
+            self._execute("DELETE FROM daily_jobs WHERE updated_at < ?", (time.time() - keep_days * 86400,))
+        else:
+            self._execute("DELETE FROM daily_jobs WHERE account = ? AND updated_at < ?",
+                          (account, time.time() - keep_days * 86400))
+    # endregion
+
+    # region promo keys
+    def add_promo_key(self, account: str, promo_id: str, code: str):
+        now = time.time()
+        self._execute(
+            "INSERT OR IGNORE INTO promo_keys (code, account, promo_id, status, created_at, updated_at)"
+            " VALUES (?, ?, ?, 'pending', ?, ?)",
+            (code, account, promo_id, now, now),
+        )
+
+    def load_promo_keys(self, account: str, status: str = "pending") -> list:
+        """Keys of the account in the order they were generated, as dicts."""
+        rows = self._execute(
+            "SELECT code, promo_id, attempts FROM promo_keys WHERE account = ? AND status = ? ORDER BY created_at",
+            (account, status),
+        )
+        return [{"code": code, "promo_id": promo_id, "attempts": attempts} for code, promo_id, attempts in rows]
+
+    def update_promo_key(self, code: str, status: str, attempts: int = 0):
+        self._execute("UPDATE promo_keys SET status = ?, attempts = ?, updated_at = ? WHERE code = ?",
+                      (status, attempts, time.time(), code))
+
+    def prune_promo_keys(self, keep_days: int = 7, account: str = None):
+        """Delete the keys applied or failed more than `keep_days` ago, of `account` or of every account."""
+        if account is None:
+            self._execute("DELETE FROM promo_keys WHERE status != 'pending' AND updated_at < ?",
+                          (time.time() - keep_days * 86400,))
+        else:
+            self._execute("DELETE FROM promo_keys WHERE account = ? AND status != 'pending' AND updated_at < ?",
+                          (account, time.time() - keep_days * 86400))
+    # endregion
+
+    # region catalog
+    def save_catalog(self, key: str, data):
+        self._execute("INSERT OR REPLACE INTO catalog (key, data, updated_at) VALUES (?, ?, ?)",
+                      (key, json.dumps(data), time.time()))
+
+    def load_catalog(self, key: str, max_age: float = None):
+        rows = self._execute("SELECT data, updated_at FROM catalog WHERE key = ?", (key,))
+        if not rows or (max_age is not None and time.time() - rows[0][1] > max_age):
+            return None
+        return json.loads(rows[0][0])
+    # endregion
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path: str):
+    """One `StateStore` per database file in the process, `None` when `path` is empty."""
+    if not path:
+        return None
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = StateStore(path)
+        return _stores[path]
@@ -0,0 +1,240 @@
+import logging
+import multiprocessing
+import os
+import resource
+import threading
+import time
+import zlib
+from multiprocessing.connection import wait
+
+from registry import get_registry
+import config
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(name: str, shards: int) -> int:
+    return zlib.crc32(name.encode()) % shards
+
+
+def shard_accounts(accounts_data: list, shards: int) -> list:
+    """Split the accounts into `shards` lists by a hash of the name, so an account keeps its shard across restarts."""
+    result = [[] for _ in range(shards)]
+    for account_data in accounts_data:
+        result[shard_of(account_data["name"], shards)].append(account_data)
+    return result
+
+
+def run_worker(shard: int, accounts_data: list, run_mode: str, workers: int, conn, status_interval: float):
+    """Entry point of a worker process: run `accounts_data` with `run_mode` and report to the supervisor."""
+    # the per-host limits are for the whole box, every worker takes its share
+    config.RATE_LIMIT = config.RATE_LIMIT / workers
+    config.RATE_LIMIT_BURST = max(1, config.RATE_LIMIT_BURST // workers)
+    # recorded here, served by the supervisor
+    metrics.registry.enabled = bool(config.METRICS_PORT)
+    # with an accounts file every worker reads and watches the accounts of its own shard
+    registry = get_registry(select=lambda account_data: shard_of(account_data["name"], workers) == shard)
+    if registry is not None:
+        accounts_data = registry.load()
+
+    threading.Thread(
+        target=report_status, name="status", daemon=True,
+        args=(conn, shard, lambda: len(accounts_data if registry is None else registry.accounts), status_interval),
+    ).start()
+
+    import main
+    main.setup_profiling()
+    main.get_runner(run_mode)(accounts_data, registry)
+
+
+def report_status(conn, shard: int, count_accounts, interval: float):
+    while True:
+        conn.send({
+            "shard": shard,
+            "pid": os.getpid(),
+            "accounts": count_accounts(),
+            "threads": threading.active_count(),
+            "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "metrics": metrics.registry.snapshot() if metrics.registry.enabled else None,
+        })
+        time.sleep(interval)
+
+
+class Worker:
+    """Supervisor side of one shard: its process, its status pipe and its restart history."""
+
+    def __init__(self, shard: int, accounts_data: list):
+        self.shard = shard
+        self.accounts_data = accounts_data
+        self.process = None
+        self.conn = None
+        self.started_at = 0.0
+        self.last_report = 0.0
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = 0.0
+        self.status = {}
+
+    @property
+    def accounts(self) -> int:
+        # the worker reads an accounts file itself, its count is the one it reports
+        return self.status.get("accounts", len(self.accounts_data))
+
+    @property
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    """
+    Runs the accounts in `workers` processes, one shard of accounts each.
+
+    A worker that exits or stops reporting for `heartbeat_timeout` seconds is restarted after an
+    exponential backoff, which is reset once a worker survives `stable_after` seconds. Workers send
+    their status and metrics over a pipe every `status_interval` seconds, the metrics are merged
+    into the registry of the supervisor and served from its `/metrics`. With `watch` the workers
+    follow the accounts file themselves, so every shard gets a worker even when it starts empty.
+    On `stop` every worker is sent SIGTERM at once and killed if still running `shutdown_timeout`
+    seconds later.
+    """
+
+    def __init__(self, accounts_data: list, workers: int = 0, run_mode: str = "threads",
+                 status_interval: float = 15, heartbeat_timeout: float = 120, backoff: float = 5,
+                 max_backoff: float = 300, stable_after: float = 600, watch: bool = False,
+                 shutdown_timeout: float = 30):
+        workers = workers or os.cpu_count() or 1
+        self.workers_count = max(1, workers if watch else min(workers, len(accounts_data)))
+        self.run_mode = run_mode
+        self.status_interval = status_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.shutdown_timeout = shutdown_timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._stopped = threading.Event()
+        # a hash can leave a shard empty with few accounts, there is nothing to run for it
+        self.workers = [
+            Worker(shard=shard, accounts_data=shard_data)
+            for shard, shard_data in enumerate(shard_accounts(accounts_data, self.workers_count))
+            if shard_data or watch
+        ]
+
+    def _start(self, worker: Worker):
+        receiver, sender = self._context.Pipe(duplex=False)
+        worker.process = self._context.Process(
+            target=run_worker, name=f"shard-{worker.shard}", daemon=True,
+            args=(worker.shard, worker.accounts_data, self.run_mode, self.workers_count, sender,
+                  self.status_interval),
+        )
+        worker.process.start()
+        # the child holds its own copy of the sending end
+        sender.close()
+        worker.conn = receiver
+        worker.started_at = worker.last_report = time.monotonic()
+        logger.info(f"shard {worker.shard} started with {len(worker.accounts_data)} accounts, "
+                    f"pid {worker.process.pid}")
+
+    def _stop_worker(self, worker: Worker):
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join(10)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+        if worker.conn is not None:
+            worker.conn.close()
+            worker.conn = None
+
+    def _schedule_restart(self, worker: Worker, reason: str):
+        self._stop_worker(worker)
+        if time.monotonic() - worker.started_at >= self.stable_after:
+            worker.failures = 0
+        delay = min(self.max_backoff, self.backoff * 2 ** worker.failures)
+        worker.failures += 1
+        worker.restarts += 1
+        worker.restart_at = time.monotonic() + delay
+        worker.process = None
+        logger.error(f"shard {worker.shard} {reason}, restarting in {delay:.0f} seconds")
+
+    def _receive(self, timeout: float):
+        connections = {worker.conn: worker for worker in self.workers if worker.conn is not None}
+        if not connections:
+            self._stopped.wait(timeout)
+            return
+        for conn in wait(list(connections), timeout=timeout):
+            worker = connections[conn]
+            try:
+                status = conn.recv()
+            except (EOFError, OSError):
+                # the worker is gone, `_check` restarts it
+                conn.close()
+                worker.conn = None
+                continue
+            worker.last_report = time.monotonic()
+            worker.status = status
+            if status.get("metrics") is not None:
+                metrics.registry.set_remote(f"shard-{worker.shard}", status["metrics"])
+
+    def _check(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.process is None:
+                if now >= worker.restart_at:
+                    self._start(worker)
+            elif not worker.process.is_alive():
+                self._schedule_restart(worker, f"exited with code {worker.process.exitcode}")
+            elif now - worker.last_report > self.heartbeat_timeout:
+                self._schedule_restart(worker, f"sent no status for {now - worker.last_report:.0f} seconds")
+            self._export(worker)
+
+    def _export(self, worker: Worker):
+        labels = (("shard", worker.shard),)
+        metrics.registry.set_gauge("hk_worker_up", labels, int(worker.is_running))
+        metrics.registry.set_gauge("hk_worker_restarts", labels, worker.restarts)
+        metrics.registry.set_gauge("hk_worker_accounts", labels, worker.accounts)
+        metrics.registry.set_gauge("hk_worker_threads", labels, worker.status.get("threads", 0))
+        metrics.registry.set_gauge("hk_worker_max_rss_bytes", labels, worker.status.get("rss_kb", 0) * 1024)
+
+    def log_status(self):
+        for worker in self.workers:
+            logger.info(f"shard {worker.shard}: {'up' if worker.is_running else 'down'}, "
+                        f"{worker.accounts} accounts, restarts {worker.restarts}, "
+                        f"threads {worker.status.get('threads', '-')}, "
+                        f"max rss {worker.status.get('rss_kb', 0) // 1024} MB")
+
+    def signal_workers(self, signum: int):
+        """Pass a signal on to every running worker, e.g. the profiling toggles."""
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signum)
+
+    def run(self):
+        """Block the calling thread supervising the workers until `stop`."""
+        logger.info(f"supervising {self.workers_count} workers running {self.run_mode}")
+        next_log = time.monotonic() + self.status_interval * 4
+        try:
+            while not self._stopped.is_set():
+                self._check()
+                self._receive(timeout=1)
+                if time.monotonic() >= next_log:
+                    self.log_status()
+                    next_log = time.monotonic() + self.status_interval * 4
+        finally:
+            self._stop_workers()
+
+    def _stop_workers(self):
+        # the workers stop their accounts in parallel, each one finishes its requests and checkpoints
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(max(0.0, deadline - time.monotonic()))
+            self._stop_worker(worker)
+
+    def stop(self):
+        self._stopped.set()
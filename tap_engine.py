@@ -0,0 +1,107 @@
+from clock import SystemClock, system_clock
+from models import Boost
+from state import AccountState
+
+
+class TapEngine:
+    """
+    Decides when tapping is worth a request, from the energy model of `AccountState`.
+
+    Energy (`availableTaps`) recovers at `tapsRecoverPerSec` up to `maxTaps` and one `tap` request
+    spends all of it for `earnPerTap` coins a tap. Tapping more often earns nothing more, only energy
+    left at the cap is lost, so a request is made once energy reaches `min_fill` of `maxTaps` and the
+    account is woken when it is full.
+
+    The free `BoostFullAvailableTaps` refills energy when its `cooldownSeconds` is zero. It is taken
+    on the wake-up of a full energy tap: the energy is tapped, the boost bought and the refill tapped.
+    The cooldown after a purchase is learned from the first `boosts-for-buy` read after it, later
+    purchases then need no `boosts-for-buy` at all.
+    """
+    BOOST_ID = "BoostFullAvailableTaps"
+
+    def __init__(self, state: AccountState, min_fill: float = 0.9, boost_recheck: float = 3600,
+                 clock: SystemClock = None):
+        self.state = state
+        self.min_fill = min_fill
+        # `boosts-for-buy` is read again after this long when there is no free boost
+        self.boost_recheck = boost_recheck
+        self.clock = system_clock if clock is None else clock
+        # unix time the free boost is off cooldown, or `boosts-for-buy` is read again when there is none
+        self.boost_ready_at = None
+        self.boost_free = False
+        # cooldown after a purchase and the time of the last one, until it is learned
+        self.boost_cooldown = None
+        self._boost_used_at = None
+        self.coins = 0
+        self.requests = 0
+
+    def energy(self, now: float = None) -> int:
+        return self.state.projected_taps(now)
+
+    def tap_args(self, now: float = None) -> tuple:
+        """`(count, availableTaps)` of a request spending all the energy."""
+        energy, earn_per_tap = self.energy(now), max(self.state.earn_per_tap, 1)
+        count = energy // earn_per_tap
+        return count, energy - count * earn_per_tap
+
+    def is_worth_tapping(self, now: float = None, before_boost: bool = False) -> bool:
+        """
+        Energy is at `min_fill` of the maximum, or, right before a refill, the refill would throw
+        away more than the `1 - min_fill` share a regular request leaves unused.
+        """
+        energy = self.energy(now)
+        share = 1 - self.min_fill if before_boost else self.min_fill
+        return energy >= self.state.earn_per_tap and energy >= share * self.state.max_taps
+
+    def _is_due(self, now: float = None) -> bool:
+        return self.boost_ready_at is not None and self.boost_ready_at <= (self.clock.time() if now is None else now)
+
+    def needs_boost_check(self, now: float = None) -> bool:
+        """The state of the free boost is unknown, or there was none and it is time to look again."""
+        return self.boost_ready_at is None or (not self.boost_free and self._is_due(now))
+
+    def is_boost_ready(self, now: float = None) -> bool:
+        return self.boost_free and self._is_due(now)
+
+    def update_boost(self, boost: Boost, now: float = None):
+        """`boost` is the free full energy boost of `boosts-for-buy`, None when there is none to take."""
+        now = self.clock.time() if now is None else now
+        self.boost_free = boost is not None
+        if boost is None:
+            self.boost_ready_at = now + self.boost_recheck
+            return
+
+        self.boost_ready_at = now + boost.cooldown_seconds
+        if self._boost_used_at is not None and boost.cooldown_seconds > 0:
+            self.boost_cooldown = self.boost_ready_at - self._boost_used_at
+        self._boost_used_at = None
+
+    def boost_used(self, now: float = None):
+        now = self.clock.time() if now is None else now
+        if self.boost_cooldown is None:
+            self._boost_used_at = now
+            self.boost_ready_at = None
+        else:
+            self.boost_ready_at = now + self.boost_cooldown
+
+    def boost_failed(self):
+        # read `boosts-for-buy` again before the next try
+        self.boost_ready_at = None
+
+    def next_tap_at(self, now: float = None):
+        """When energy is full, the free boost waits for that wake-up. None when energy does not recover."""
+        now = self.clock.time() if now is None else now
+        if self.state.taps_recover_per_sec > 0:
+            return now + max(0.0, self.state.max_taps - self.energy(now)) / self.state.taps_recover_per_sec
+        if self.boost_free:
+            return self.boost_ready_at
+        return None
+
+    def record(self, coins: int = 0):
+        """One tap related request and the coins it earned."""
+        self.requests += 1
+        self.coins += coins
+
+    @property
+    def coins_per_request(self) -> float:
+        return self.coins / self.requests if self.requests else 0.0
@@ -0,0 +1,341 @@
+import base64
+import collections
+import hashlib
+import http.cookiejar
+import json
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import NewConnectionError
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - optional dependency
+    httpx = None
+
+
+logger = logging.getLogger(__name__)
+
+HTTP1 = "requests"
+HTTP2 = "http2"
+
+RECORD = "record"
+REPLAY = "replay"
+
+# seconds to connect and then between two reads of an answer, a host that stops answering fails the request
+DEFAULT_TIMEOUT = 30.0
+
+
+class Response:
+    """What the clients read of an answer, the same for every transport."""
+    __slots__ = ("status_code", "headers", "content")
+
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        # case insensitive mapping of the response headers
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(errors="replace")
+
+
+class Transport:
+    """
+    Sends one HTTP request and returns its `Response`, under `_request` of the sync clients.
+    `ERRORS` are the exceptions of a request that never got an answer, `CONNECT_ERRORS` the ones of
+    a request that never left the client. The guard retries every request on the latter, the ones
+    that change the game state not on the others, the server may have applied them.
+    """
+    ERRORS: tuple = ()
+    CONNECT_ERRORS: tuple = ()
+
+    def request(self, method: str, url: str, headers, data=None) -> Response:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def no_cookies() -> http.cookiejar.CookiePolicy:
+    """A policy that neither keeps nor sends a cookie, a cookie jar shared by the accounts would mix theirs."""
+    return http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+
+
+def create_session(pool_size: int = 10, cookies: bool = True) -> requests.Session:
+    """
+    Create a keep-alive session whose connection pool holds up to `pool_size` connections per host.
+    Without `cookies` its jar rejects every `Set-Cookie`, for a session every account sends through.
+    """
+    session = requests.Session()
+    if not cookies:
+        session.cookies.set_policy(no_cookies())
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ConnectFailed(requests.ConnectionError):
+    """No connection to the host could be opened, the request was not sent."""
+
+
+class RequestsTransport(Transport):
+    """
+    HTTP/1.1 keep-alive over a `requests.Session`, up to `pool_size` connections per host.
+    A `shared` one is used by every account and keeps no cookies. `timeout` applies to every request.
+    """
+    ERRORS = (requests.ConnectionError, requests.Timeout)
+    CONNECT_ERRORS = (requests.ConnectTimeout, ConnectFailed)
+
+    def __init__(self, session: requests.Session = None, pool_size: int = 10, shared: bool = False,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.session = create_session(pool_size=pool_size, cookies=not shared) if session is None else session
+        self.timeout = timeout
+
+    def request(self, method: str, url: str, headers, data=None) -> Response:
+        try:
+            response = self.session.request(method=method, url=url, headers=headers, data=data, timeout=self.timeout)
+        except requests.ConnectionError as e:
+            # refused or unresolved, a reset after the request went out is a plain `ConnectionError`
+            reason = getattr(e.args[0], "reason", None) if e.args else None
+            if isinstance(reason, NewConnectionError) and not isinstance(e, requests.ConnectTimeout):
+                raise ConnectFailed(*e.args, request=e.request, response=e.response) from e
+            raise
+        return Response(response.status_code, response.headers, response.content)
+
+    def close(self):
+        self.session.close()
+
+
+class Http2Transport(Transport):
+    """
+    HTTP/2 over `httpx`, every request to a host is a stream multiplexed on one of at most
+    `pool_size` connections, so a fleet sharing the transport keeps a few sockets open instead of
+    one per account. A `shared` one keeps no cookies. Needs `pip install httpx[http2]`.
+    """
+    ERRORS = (httpx.TransportError,) if httpx is not None else ()
+    CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout) if httpx is not None else ()
+
+    def __init__(self, pool_size: int = 10, shared: bool = True, timeout: float = DEFAULT_TIMEOUT):
+        if httpx is None:
+            raise RuntimeError("the http2 transport needs `pip install httpx[http2]`")
+        self.client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size,
+                                                                   max_keepalive_connections=pool_size),
+                                   cookies=http.cookiejar.CookieJar(policy=no_cookies() if shared else None),
+                                   timeout=timeout)
+
+    def request(self, method: str, url: str, headers, data=None) -> Response:
+        # `Host` and `Connection` are HTTP/1.1 headers, HTTP/2 sends `:authority` and rejects `Connection`
+        headers = {key: value for key, value in headers.items() if key.lower() not in ("host", "connection")}
+        response = self.client.request(method=method, url=url, headers=headers, content=data)
+        return Response(response.status_code, response.headers, response.content)
+
+    def close(self):
+        self.client.close()
+
+
+TRANSPORTS = {
+    HTTP1: RequestsTransport,
+    HTTP2: Http2Transport,
+}
+
+
+class SharedTransports:
+    """Process wide transports keyed by kind and host, so every account that talks to the same host reuses one pool."""
+    _transports: dict = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host: str, kind: str = HTTP1, pool_size: int = 10, timeout: float = DEFAULT_TIMEOUT) -> Transport:
+        with cls._lock:
+            transport = cls._transports.get((kind, host))
+            if transport is None:
+                transport = TRANSPORTS[kind](pool_size=pool_size, shared=True, timeout=timeout)
+                cls._transports[(kind, host)] = transport
+            return transport
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            for transport in cls._transports.values():
+                transport.close()
+            cls._transports.clear()
+
+
+class SharedSessions:
+    """The `requests.Session` of the shared HTTP/1.1 transport of a host."""
+
+    @classmethod
+    def get(cls, host: str, pool_size: int = 10) -> requests.Session:
+        return SharedTransports.get(host=host, kind=HTTP1, pool_size=pool_size).session
+
+    @classmethod
+    def close_all(cls):
+        SharedTransports.close_all()
+
+
+class CassetteMiss(LookupError):
+    """A replayed request that was never recorded."""
+
+
+class Cassette:
+    """
+    Exchanges of one account in a JSON lines file, one `{"method", "url", "request", "status", "headers",
+    "body"}` per line in the order they happened. A record session starts the file over. Request headers
+    are not written, they hold the tokens, `request` is a hash of the request body.
+
+    Replay answers the requests to a `(method, url, request)` with its recorded responses in order, a
+    request that was not recorded or asked more often than it was raises `CassetteMiss`: a run that
+    diverges from the recording fails instead of reading answers to other requests.
+    """
+    # body fields that differ between two runs of the same requests
+    VOLATILE_FIELDS = frozenset((
+        "timestamp", "eventId", "clientId",
+        # the keys mini game cipher holds random digits
+        "cipher",
+    ))
+
+    def __init__(self, path: str, mode: str = REPLAY):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"unknown cassette mode {mode!r}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._file = None
+        self._exchanges = {}
+        if mode == REPLAY:
+            self._load()
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                exchange = json.loads(line)
+                key = (exchange["method"], exchange["url"], exchange.get("request", ""))
+                self._exchanges.setdefault(key, collections.deque()).append(exchange)
+        logger.info("replaying %d exchanges of %s", sum(map(len, self._exchanges.values())), self.path)
+
+    @classmethod
+    def request_key(cls, data) -> str:
+        """Hash of a request body without its `VOLATILE_FIELDS`, empty without a body."""
+        if data is None:
+            return ""
+        if isinstance(data, str):
+            data = data.encode()
+        try:
+            body = json.loads(data)
+        except ValueError:
+            body = None
+        if isinstance(body, dict):
+            body = {key: value for key, value in body.items() if key not in cls.VOLATILE_FIELDS}
+            data = json.dumps(body, sort_keys=True, separators=(",", ":")).encode()
+        return hashlib.sha1(data).hexdigest()[:16]
+
+    def record(self, method: str, url: str, data, response: Response):
+        exchange = {
+            "method": method, "url": url, "request": self.request_key(data), "status": response.status_code,
+            "headers": dict(response.headers), "body": base64.b64encode(response.content).decode("ascii"),
+        }
+        line = json.dumps(exchange, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                # a recording of an earlier session is replaced, not continued
+                self._file = open(self.path, "w", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+
+    def replay(self, method: str, url: str, data=None) -> Response:
+        with self._lock:
+            exchanges = self._exchanges.get((method, url, self.request_key(data)))
+            if not exchanges:
+                raise CassetteMiss(f"{method.upper()} {url} with this body is not in {self.path}, "
+                                   f"or was asked for more often than it was recorded")
+            exchange = exchanges.popleft()
+        headers = CaseInsensitiveDict(exchange["headers"])
+        return Response(exchange["status"], headers, base64.b64decode(exchange["body"]))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class CassetteTransport(Transport):
+    """Records the exchanges of `inner` to a `Cassette`, or replays them without a network when there is no `inner`."""
+
+    def __init__(self, cassette: Cassette, inner: Transport = None):
+        self.cassette = cassette
+        self.inner = inner
+        self.ERRORS = () if inner is None else inner.ERRORS
+        self.CONNECT_ERRORS = () if inner is None else inner.CONNECT_ERRORS
+
+    def request(self, method: str, url: str, headers, data=None) -> Response:
+        method = method.lower()
+        if self.inner is None:
+            return self.cassette.replay(method, url, data=data)
+        response = self.inner.request(method, url, headers, data=data)
+        self.cassette.record(method, url, data, response)
+        return response
+
+    def close(self):
+        if self.inner is not None:
+            self.inner.close()
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette(directory: str, account: str = None, mode: str = REPLAY) -> Cassette:
+    """The cassette of an account in `directory`, every client of the account shares it."""
+    path = os.path.join(directory, f"{account or 'default'}.jsonl")
+    with _cassettes_lock:
+        cassette = _cassettes.get(path)
+        if cassette is not None and cassette.mode != mode:
+            raise ValueError(f"{path} is already open for {cassette.mode}, not for {mode}")
+        if cassette is None:
+            cassette = Cassette(path, mode=mode)
+            _cassettes[path] = cassette
+        return cassette
+
+
+def open_transport(host: str, kind: str = HTTP1, pool_size: int = 10, share: bool = False,
+                   session: requests.Session = None, cassette: str = None, cassette_mode: str = REPLAY,
+                   account: str = None, transport: Transport = None, timeout: float = DEFAULT_TIMEOUT):
+    """
+    `(transport, owned)` of a client of `host`, `owned` is false for the shared transports and the
+    transports and sessions passed in, the client must not close them. HTTP/2 is always shared,
+    multiplexing is its point. With a `cassette` directory the exchanges are recorded, or replayed
+    with no network.
+    """
+    if kind not in TRANSPORTS:
+        raise ValueError(f"unknown HTTP transport {kind!r}, expected one of {', '.join(TRANSPORTS)}")
+    if cassette and cassette_mode == REPLAY:
+        return CassetteTransport(get_cassette(cassette, account=account, mode=REPLAY)), True
+
+    if transport is not None:
+        owned = False
+    elif session is not None:
+        transport, owned = RequestsTransport(session=session, timeout=timeout), False
+    elif share or kind == HTTP2:
+        transport, owned = SharedTransports.get(host=host, kind=kind, pool_size=pool_size, timeout=timeout), False
+    else:
+        transport, owned = TRANSPORTS[kind](pool_size=pool_size, timeout=timeout), True
+
+    if cassette:
+        # the cassette stays open for the other clients of the account, only `inner` is closed by the client
+        return CassetteTransport(get_cassette(cassette, account=account, mode=RECORD), inner=transport), owned
+    return transport, owned
@@ -0,0 +1,147 @@
+import sys
+
+from hamster_kombat import HamsterKombatUtils
+from models import UpgradeTable
+
+
+class UpgradeGraph:
+    """
+    Unlock dependencies between the cards of `upgradesForBuy`, indexed both ways.
+
+    A card that is not available may carry `condition` `{"_type": "ByUpgrade", "upgradeId": ..., "level": n}`,
+    it unlocks once the prerequisite is owned at level `n`. `level` of a card in `upgradesForBuy` is the one
+    its next purchase buys, so that purchase unlocks the cards waiting for a level up to `level`. Only the
+    price of the next level is known, so the cards that need more than one purchase are indexed, not valued.
+
+    The value of a card is `(price, profit)` of the best bundle its next purchase starts: the card alone or
+    with the chain of cards it unlocks, whichever has the higher profit coefficient. A cheap prerequisite
+    of a high ROI card is ranked by the pair. Values are cached, `update` compares a fresh table with the
+    last one and drops only the values of the changed cards and of the prerequisites above them.
+    """
+    utils = HamsterKombatUtils
+    BY_UPGRADE = "ByUpgrade"
+
+    def __init__(self, upgrades: UpgradeTable = None, max_card_price: int = None):
+        # cards above it are never bought, they unlock nothing worth counting
+        self.max_card_price = max_card_price
+        self._table = UpgradeTable()
+        # locked card -> (prerequisite, level it must be owned at)
+        self._requires = {}
+        # prerequisite -> locked cards waiting for it
+        self._dependents = {}
+        self._signatures = {}
+        # card -> (price, profit, next card of the bundle or None)
+        self._values = {}
+        if upgrades is not None:
+            self.update(upgrades)
+
+    @classmethod
+    def requirement(cls, condition: dict):
+        """`(prerequisite, level)` of a `ByUpgrade` condition, None for the others, referrals or channels."""
+        if not condition or condition.get("_type") != cls.BY_UPGRADE or not condition.get("upgradeId"):
+            return None
+        return sys.intern(condition["upgradeId"]), int(condition.get("level", 0))
+
+    def _is_locked(self, table: UpgradeTable, row: int) -> bool:
+        return not table.flags[row] & (table.AVAILABLE | table.EXPIRED)
+
+    def _link(self, card_id: str, requires) -> str:
+        """Point `card_id` at its new prerequisite, returns the previous one."""
+        previous = self._requires.pop(card_id, None)
+        if previous is not None:
+            waiting = self._dependents[previous[0]]
+            waiting.discard(card_id)
+            if not waiting:
+                del self._dependents[previous[0]]
+        if requires is not None:
+            self._requires[card_id] = requires
+            self._dependents.setdefault(requires[0], set()).add(card_id)
+        return None if previous is None else previous[0]
+
+    def update(self, upgrades: UpgradeTable) -> set:
+        """Apply a fresh `upgradesForBuy` table, returns the cards whose value was dropped."""
+        signatures = {}
+        changed = set()
+        for row, card_id in enumerate(upgrades.ids):
+            requires = self.requirement(upgrades.conditions[row]) if self._is_locked(upgrades, row) else None
+            signature = (upgrades.levels[row], upgrades.prices[row], upgrades.profits[row], upgrades.flags[row],
+                         requires)
+            signatures[card_id] = signature
+            if self._signatures.get(card_id) != signature:
+                changed.add(card_id)
+                # an unlocked card leaves the bundle of its former prerequisite
+                if (previous := self._link(card_id, requires)) is not None:
+                    changed.add(previous)
+        for card_id in self._signatures.keys() - signatures.keys():
+            changed.add(card_id)
+            if (previous := self._link(card_id, None)) is not None:
+                changed.add(previous)
+
+        self._table, self._signatures = upgrades, signatures
+        stale = self._with_prerequisites(changed)
+        for card_id in stale:
+            self._values.pop(card_id, None)
+        return stale
+
+    def _with_prerequisites(self, cards: set) -> set:
+        result = set()
+        for card_id in cards:
+            while card_id is not None and card_id not in result:
+                result.add(card_id)
+                card_id = self._requires.get(card_id, (None,))[0]
+        return result
+
+    def is_locked(self, card_id: str) -> bool:
+        return card_id in self._requires
+
+    def requires(self, card_id: str):
+        """`(prerequisite, level)` of a locked card, None when it is available or waits for something else."""
+        return self._requires.get(card_id)
+
+    def unlocks(self, card_id: str) -> list:
+        """Locked cards the next purchase of `card_id` unlocks."""
+        row = self._table.index.get(card_id)
+        if row is None:
+            return []
+        level = self._table.levels[row]
+        waiting = self._dependents.get(card_id, ())
+        return sorted(dependent for dependent in waiting if self._requires[dependent][1] <= level)
+
+    def value(self, card_id: str) -> tuple:
+        """`(price, profit)` of the best bundle the next purchase of `card_id` starts."""
+        return self._value(card_id, set())[:2]
+
+    def chain(self, card_id: str) -> list:
+        """The cards of that bundle in purchase order, `card_id` first."""
+        chain = []
+        while card_id is not None and card_id not in chain:
+            chain.append(card_id)
+            card_id = self._value(card_id, set())[2]
+        return chain
+
+    def _value(self, card_id: str, visiting: set) -> tuple:
+        value = self._values.get(card_id)
+        if value is not None:
+            return value
+
+        table = self._table
+        row = table.index[card_id]
+        price, profit = table.prices[row], table.profits[row]
+        value = (price, profit, None)
+        # a malformed condition cycle is cut where it closes
+        visiting.add(card_id)
+        for dependent in self.unlocks(card_id):
+            if dependent in visiting:
+                continue
+            if self.max_card_price is not None and table.prices[table.index[dependent]] > self.max_card_price:
+                continue
+            extra_price, extra_profit, _ = self._value(dependent, visiting)
+            if self._coefficient(price + extra_price, profit + extra_profit) > self._coefficient(*value[:2]):
+                value = (price + extra_price, profit + extra_profit, dependent)
+        visiting.discard(card_id)
+
+        self._values[card_id] = value
+        return value
+
+    def _coefficient(self, price: int, profit: int) -> float:
+        return self.utils.profit_coefficient(price=price, profit=profit)
@@ -1,16 +1,28 @@
+import atexit
+import datetime
+import inspect
 import json
 import logging
+import multiprocessing
 import pathlib
+import queue
 import random
+import re
+import threading
 import time
 import uuid
-from functools import wraps
-from logging.handlers import RotatingFileHandler
+from functools import lru_cache, wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import colorlog
 import requests
 
-from hamster_kombat import APIError
+from clock import SystemClock, system_clock
+from hamster_kombat import APIError, HamsterKombatAPI, PreflightCache, RequestTemplate, parse_retry_after
+from profiling import profiled
+from transport import DEFAULT_TIMEOUT, HTTP1, REPLAY, Transport, open_transport
+import metrics
+import models
 
 logger = logging.getLogger(__name__)
 log_dir = pathlib.Path(__file__).parent / 'log'
@@ -57,17 +69,84 @@ class BColors:
         return cls.FAIL + txt + cls.ENDC
 
 
+class ClientTokenCache:
+    """
+    `promo/login-client` tokens per (account, appToken).
+
+    Tokens live in memory and, with a state store, on disk so a restart reuses them as well.
+    A token is dropped after `ttl` seconds or as soon as the promo host rejects it.
+    """
+
+    def __init__(self, ttl: int = 86400, store=None):
+        self.ttl = ttl
+        self.store = store
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _kind(app_token: str) -> str:
+        return f"client_token:{app_token}"
+
+    def get(self, account: str, app_token: str):
+        with self._lock:
+            token, created_at = self._tokens.get((account, app_token), (None, None))
+        if token is not None and time.time() - created_at < self.ttl:
+            return token
+        if self.store is None:
+            return None
+
+        token, created_at = self.store.load_snapshot(account, self._kind(app_token), max_age=self.ttl)
+        if token is not None:
+            with self._lock:
+                self._tokens[(account, app_token)] = (token, created_at)
+        return token
+
+    def put(self, account: str, app_token: str, token: str):
+        now = time.time()
+        with self._lock:
+            self._tokens[(account, app_token)] = (token, now)
+        if self.store is not None:
+            self.store.save_snapshot(account, self._kind(app_token), token, updated_at=now)
+
+    def invalidate(self, account: str, app_token: str):
+        with self._lock:
+            self._tokens.pop((account, app_token), None)
+        if self.store is not None:
+            self.store.save_snapshot(account, self._kind(app_token), None)
+
+
 class GamePromo:
     user_agent: str
     URL: str = "https://api.gamepromo.io/"
+    # statuses of the promo host for a missing or expired client token
+    AUTH_ERROR_STATUSES = (401, 403)
+    TRANSPORT_ERRORS = HamsterKombatAPI.TRANSPORT_ERRORS
+    CONNECT_ERRORS = HamsterKombatAPI.CONNECT_ERRORS
 
     @property
     def client_id(self) -> str:
-        return f"{int(time.time() * 1000)}-{''.join(str(random.randint(0, 9)) for _ in range(19))}"
-
-    def __init__(self, user_agent: str, app_token: str, name: str = None):
+        return f"{int(self.clock.time() * 1000)}-{''.join(str(random.randint(0, 9)) for _ in range(19))}"
+
+    def __init__(self, user_agent: str, app_token: str, name: str = None,
+                 pool_size: int = 10, share_session: bool = False, session: requests.Session = None,
+                 use_preflight_cache: bool = True, preflight_cache_ttl: int = 600, auto_login: bool = True,
+                 account: str = None, token_cache: ClientTokenCache = None, guard=None,
+                 http_transport: str = HTTP1, cassette: str = None, cassette_mode: str = REPLAY,
+                 url: str = None, transport: Transport = None, clock: SystemClock = None,
+                 timeout: float = DEFAULT_TIMEOUT):
         self.logger = logging.getLogger(f"GamePromo_logger[{name}]")
+        if url is not None:
+            self.URL = url if url[-1] == "/" else url + "/"
         self.user_agent = user_agent
+        self.account = account
+        self.guard = guard
+        self.clock = system_clock if clock is None else clock
+        self.token_cache = token_cache
+        self.preflight_cache = PreflightCache(ttl=preflight_cache_ttl) if use_preflight_cache else None
+
+        self._init_session(session=session, share_session=share_session, pool_size=pool_size,
+                           http_transport=http_transport, cassette=cassette, cassette_mode=cassette_mode,
+                           transport=transport, timeout=timeout)
 
         self.default_headers = {
             "Accept": "*/*",
@@ -90,107 +169,222 @@ class GamePromo:
                 '"Android WebView";v="125", "Chromium";v="125", "Not.A/Brand";v="24"'
             )
 
-        self.client_token = self.login(app_token=app_token)
-        self.app_token = app_token
+        self._templates = {}
 
-    def _request(self, method: str, path: str, headers: dict = None, data: dict = None, auth: str = None):
-        # region url path
+        self.app_token = app_token
+        # the async client can not log in from `__init__` and does it on `__aenter__`
+        self.client_token = self.authorize() if auto_login else None
+
+    def _init_session(self, session, share_session: bool, pool_size: int, http_transport: str = HTTP1,
+                      cassette: str = None, cassette_mode: str = REPLAY, transport: Transport = None,
+                      timeout: float = DEFAULT_TIMEOUT):
+        self.transport, self._owns_session = open_transport(
+            self.URL, kind=http_transport, pool_size=pool_size, share=share_session, session=session,
+            cassette=cassette, cassette_mode=cassette_mode, account=self.account, transport=transport,
+            timeout=timeout,
+        )
+        self.TRANSPORT_ERRORS = self.transport.ERRORS
+        self.CONNECT_ERRORS = self.transport.CONNECT_ERRORS
+
+    def close(self):
+        if self._owns_session:
+            self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _build_template(self, method: str, path: str, has_body: bool, headers: dict = None,
+                        auth: str = None) -> RequestTemplate:
         if path[0] == "/":
             path = path[1::]
-        url = self.URL + path
-        # endregion
 
-        # region headers
-        _headers = self.default_headers
+        base_headers = dict(self.default_headers)
         if headers is not None:
-            _headers.update(headers)
-        option_headers = _headers
-        req_headers = _headers
+            base_headers.update(headers)
 
-        option_headers.update({
-            "Access-Control-Request-Method": method.upper(),
-        })
+        option_headers = {**base_headers, "Access-Control-Request-Method": method.upper()}
+        req_headers = dict(base_headers)
+        request_headers = ""
 
-        if data is not None:
+        if has_body:
             if auth is None:
-                option_headers["Access-Control-Request-Headers"] = "content-type"
+                request_headers = "content-type"
                 req_headers.update({"Content-Type": "application/json; charset=utf-8"})
             else:
-                option_headers["Access-Control-Request-Headers"] = "authorization,content-type"
+                request_headers = "authorization,content-type"
 
                 req_headers.update({
                     "Content-Type": "application/json; charset=utf-8",
                     "Authorization": f"Bearer {auth}",
                 })
+            option_headers["Access-Control-Request-Headers"] = request_headers
 
             # , "Accept": "application/json"
-        # endregion
 
+        return RequestTemplate(method=method, url=self.URL + path, path=path, option_headers=option_headers,
+                               request_headers=req_headers, has_body=has_body,
+                               preflight_cache=self.preflight_cache, access_control_headers=request_headers)
+
+    def _get_template(self, method: str, path: str, has_body: bool, headers: dict = None,
+                      auth: str = None) -> RequestTemplate:
+        if headers is not None:
+            return self._build_template(method=method, path=path, has_body=has_body, headers=headers, auth=auth)
+
+        # the client token does not change during the life of the client, so it is part of the key
+        key = (method, path, has_body, auth)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._build_template(method=method, path=path, has_body=has_body, auth=auth)
+            self._templates[key] = template
+        return template
+
+    @profiled("account")
+    def _request(self, method: str, path: str, headers: dict = None, data: dict = None, auth: str = None):
+        template = self._get_template(method=method, path=path, has_body=data is not None, headers=headers,
+                                      auth=auth)
+        if self.guard is None:
+            return self._send(self.logger, template, data=data)
+        return self.guard.call(lambda: self._send(self.logger, template, data=data), template, clock=self.clock,
+                               transport_errors=self.TRANSPORT_ERRORS, connect_errors=self.CONNECT_ERRORS,
+                               account=self.account)
+
+    def _send(self, log, template: RequestTemplate, data: dict = None):
         # region send option request
-        response = requests.options(url=url, headers=option_headers)
-        if not response.ok:
-            self.logger.error(f"Failed OPTION request for '{path}'"
-                              f" Status code is not 204, Response: {response.text}",
-                              extra={"path": path, "method": method, "headers": _headers})
-            raise APIError(url=url, method="option", status=response.status_code, headers=option_headers)
+        if template.needs_preflight():
+            started = time.perf_counter()
+            response = self.transport.request("options", template.url, template.option_headers)
+            metrics.record_request(self.account, template.path, "preflight", time.perf_counter() - started,
+                                   response.status_code, received=len(response.content))
+            if not response.ok:
+                log.error("Failed OPTION request for '%s' Status code is not 204, Response: %s",
+                          template.path, response.text,
+                          extra={"path": template.path, "method": template.method, "account": self.account})
+                metrics.record_error(self.account, template.path)
+                raise APIError(url=template.url, method="option", status=response.status_code,
+                               headers=dict(template.option_headers),
+                               retry_after=parse_retry_after(response.headers.get("Retry-After")))
+            template.store_preflight(response.headers)
         # endregion
 
         # region request
-        response = requests.request(method=method.lower(), url=url, headers=req_headers, data=json.dumps(data))
+        body = template.encode(data)
+        started = time.perf_counter()
+        response = self.transport.request(template.method, template.url, template.request_headers, data=body)
+        metrics.record_request(self.account, template.path, "request", time.perf_counter() - started,
+                               response.status_code, sent=len(body or ""), received=len(response.content))
         if not response.ok:
-            self.logger.error(f"Failed '{method}' request for '{path}'"
-                              f" Status code is not ok, Response: {response.text}",
-                              extra={"path": path, "method": method, "headers": _headers, "data": data})
-            raise APIError(url=url, method=method, status=response.status_code, headers=req_headers, data=data)
+            log.error("Failed '%s' request for '%s' Status code is not ok, Response: %s",
+                      template.method, template.path, response.text,
+                      extra={"path": template.path, "method": template.method, "data": data, "account": self.account})
+            metrics.record_error(self.account, template.path)
+            raise APIError(url=template.url, method=template.method, status=response.status_code,
+                           headers=dict(template.request_headers), data=data,
+                           retry_after=parse_retry_after(response.headers.get("Retry-After")))
         # endregion
 
-        return response.json()
+        return models.loads(response.content)
+
+    # region client token
+    def _cached_token(self):
+        if self.token_cache is None or self.account is None:
+            return None
+        return self.token_cache.get(self.account, self.app_token)
+
+    def _cache_token(self, token):
+        if self.token_cache is not None and self.account is not None and token is not None:
+            self.token_cache.put(self.account, self.app_token, token)
+
+    def _drop_token(self):
+        if self.token_cache is not None and self.account is not None:
+            self.token_cache.invalidate(self.account, self.app_token)
+
+    def authorize(self):
+        """Cached client token of the account, logs in only when there is none."""
+        token = self._cached_token()
+        if token is None:
+            token = self.login(app_token=self.app_token)
+            self._cache_token(token)
+        return token
+
+    def _is_auth_error(self, error: Exception) -> bool:
+        return isinstance(error, APIError) and error.status in self.AUTH_ERROR_STATUSES
+
+    def _auth_request(self, path: str, data: dict):
+        """`_request` with the client token, logging in again once if the host rejects it."""
+        try:
+            return self._request(method="POST", path=path, headers=None, data=data, auth=self.client_token)
+        except APIError as e:
+            if not self._is_auth_error(e):
+                raise
+            self.logger.info(f"client token rejected, login again")
+            metrics.record_retry(self.account, path)
+            self._drop_token()
+            self.client_token = self.authorize()
+            return self._request(method="POST", path=path, headers=None, data=data, auth=self.client_token)
+    # endregion
 
     def login(self, app_token: str):
         self.logger.info(f"login to BikeRide")
-        path = "promo/login-client"
+        result = self._request(method="POST", path="promo/login-client", headers=None,
+                               data=self._login_data(app_token), auth=None)
+        return self._parse_login(result)
 
-        data = {
+    def _login_data(self, app_token: str) -> dict:
+        return {
             "appToken": app_token,
             "clientId": self.client_id,
             "clientOrigin": "deviceid",
         }
 
-        result = self._request(method="POST", path=path, headers=None, data=data, auth=None)
-
+    def _parse_login(self, result):
         if "clientToken" not in result:
             self.logger.error(f"unable to get key.")
             return None
 
         return result["clientToken"]
 
-    def register_event(self, promo_id: str, max_retry: int = 10, delay: int = 120):
+    def register_event(self, promo_id: str, max_retry: int = 10, delay: int = 120, wait=None):
+        """`wait(seconds)` sleeps between the tries, the clock without it, a true result gives up with None."""
         path = "promo/register-event"
         retry_count = 0
         result = None
 
         while retry_count <= max_retry:
             retry_count += 1
-            event_id = str(uuid.uuid4())
-
-            data = {
-                "promoId": promo_id,
-                "eventId": event_id,
-                "eventOrigin": "undefined",
-            }
 
             try:
-                result = self._request(method="POST", path=path, headers=None, data=data, auth=self.client_token)
+                result = self._auth_request(path=path, data=self._register_event_data(promo_id))
             except Exception as e:
                 self.logger.error(f"Failed register event", exc_info=True)
                 result = None
 
-            if result is None or not isinstance(result, dict) or not result.get("hasCode", False):
-                time.sleep(delay + random.randint(5, 15))
+            if not self._has_code(result):
+                if (wait or self.clock.sleep)(delay + random.randint(5, 15)):
+                    # stopped, the key is generated again on the next start
+                    return None
+                metrics.record_retry(self.account, path)
                 continue
             break
 
-        if result is None or not isinstance(result, dict) or not result.get("hasCode", False):
+        return self._parse_register_event(result)
+
+    @staticmethod
+    def _register_event_data(promo_id: str) -> dict:
+        return {
+            "promoId": promo_id,
+            "eventId": str(uuid.uuid4()),
+            "eventOrigin": "undefined",
+        }
+
+    @staticmethod
+    def _has_code(result) -> bool:
+        return result is not None and isinstance(result, dict) and result.get("hasCode", False)
+
+    def _parse_register_event(self, result) -> bool:
+        if not self._has_code(result):
             self.logger.error(f"Unable to register event.")
             return False
 
@@ -199,14 +393,10 @@ class GamePromo:
 
     def get_key(self, promo_id: str):
         self.logger.info(f"getting key...")
+        result = self._auth_request(path="promo/create-code", data={"promoId": promo_id})
+        return self._parse_key(result)
 
-        path = "promo/create-code"
-
-        data = {
-            "promoId": promo_id,
-        }
-
-        result = self._request(method="POST", path=path, headers=None, data=data, auth=self.client_token)
+    def _parse_key(self, result):
         if result.get("promoCode", "") == "":
             self.logger.error(f"unable to get key.")
             return None
@@ -214,28 +404,201 @@ class GamePromo:
         return result["promoCode"]
 
 
+_ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*m")
+_ACCOUNT_LOGGER = re.compile(r"^HK_account_\[(.*)\]$")
+# `extra` fields of the request logs that go to JSON lines as they are
+_JSON_EXTRA = ("path", "method")
+
+
+@lru_cache(maxsize=None)
+def _logger_account(logger_name: str):
+    match = _ACCOUNT_LOGGER.match(logger_name)
+    return match.group(1) if match else None
+
+
+def record_account(record: logging.LogRecord):
+    """The account a record belongs to, from `extra={"account": ...}` or the name of an account logger."""
+    account = getattr(record, "account", None)
+    return account if account is not None else _logger_account(record.name)
+
+
+class PlainFormatter(logging.Formatter):
+    """The text format without the terminal colors `BColors` puts into messages."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return _ANSI_ESCAPE.sub("", super().format(record))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+            .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "thread": record.threadName,
+            "message": _ANSI_ESCAPE.sub("", record.getMessage()),
+        }
+        account = record_account(record)
+        if account is not None:
+            entry["account"] = account
+        for key in _JSON_EXTRA:
+            if (value := getattr(record, key, None)) is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DedupFilter(logging.Filter):
+    """
+    Drops a warning or error identical to one the same logger let through less than `interval` seconds ago.
+
+    The first copy after the interval carries the number of dropped ones, so a failing endpoint logs
+    once a minute instead of once per account and retry.
+    """
+
+    MAX_KEYS = 4096
+
+    def __init__(self, interval: float = 60, level: int = logging.WARNING):
+        super().__init__()
+        self.interval = interval
+        self.level = level
+        # (logger, level, message) -> [let through at, dropped since]
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level or self.interval <= 0:
+            return True
+
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and record.created - seen[0] < self.interval:
+                seen[1] += 1
+                return False
+            self._seen[key] = [record.created, 0]
+            if len(self._seen) > self.MAX_KEYS:
+                self._prune(record.created)
+
+        if seen is not None and seen[1]:
+            record.msg, record.args = f"{message} (repeated {seen[1]} more times)", None
+        return True
+
+    def _prune(self, now: float):
+        for key in [key for key, (at, _) in self._seen.items() if now - at >= self.interval]:
+            del self._seen[key]
+
+
+class AccountFileHandler(logging.Handler):
+    """Writes the records of every account to its own rotating `<account>.log` in `directory`."""
+
+    def __init__(self, directory: pathlib.Path, max_bytes: int = log_maxBytes, backup_count: int = log_backupCount):
+        super().__init__()
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._handlers = {}
+
+    def _handler(self, account: str) -> RotatingFileHandler:
+        handler = self._handlers.get(account)
+        if handler is None:
+            file_name = re.sub(r"[^\w.-]", "_", account) + ".log"
+            handler = RotatingFileHandler(self.directory / file_name, maxBytes=self.max_bytes,
+                                          backupCount=self.backup_count, encoding="utf-8", delay=True)
+            handler.setFormatter(self.formatter)
+            self._handlers[account] = handler
+        return handler
+
+    def emit(self, record: logging.LogRecord):
+        account = record_account(record)
+        if account is not None:
+            self._handler(account).handle(record)
+
+    def close(self):
+        for handler in self._handlers.values():
+            handler.close()
+        self._handlers.clear()
+        super().close()
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # rendered by the thread that logs, its arguments may change before the listener gets to them
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+_exception_formatter = logging.Formatter()
+
+
 def setup_logging(
         is_debug: bool = False,
         tg_bot_key: str = None,
         tg_chat_id: str = None,
-        is_only_notificator: bool = False):
-    stream_handler = colorlog.StreamHandler()
-    stream_handler_format = colorlog.ColoredFormatter(
-        fmt="%(log_color)s%(asctime)-15s %(threadName)s %(levelname)s %(name)s %(message)s",
-        log_colors={
-            'DEBUG': 'cyan',
-            'INFO': 'green',
-            'WARNING': 'yellow',
-            'ERROR': 'red',
-            'CRITICAL': 'red,bg_white',
-        },
-    )
+        is_only_notificator: bool = False,
+        queued: bool = True,
+        json_lines: bool = False,
+        log_file: str = None,
+        account_files: bool = False,
+        dedup_interval: float = 60):
+    """
+    Log to stderr and, optionally, to `log_file` and `log/accounts/<account>.log` in `log_dir`.
+
+    With `queued` the threads that log only put records on a queue and one listener thread formats
+    and writes them, so accounts never wait on the handlers' locks or on disk. `json_lines` writes
+    JSON objects instead of text, `dedup_interval` drops repeated identical warnings and errors.
+    """
+    # configured already, like `logging.basicConfig` does
+    if logging.getLogger().handlers:
+        return
+
+    if json_lines:
+        stream_handler_format = file_format = JsonFormatter()
+    else:
+        stream_handler_format = colorlog.ColoredFormatter(
+            fmt="%(log_color)s%(asctime)-15s %(threadName)s %(levelname)s %(name)s %(message)s",
+            log_colors={
+                'DEBUG': 'cyan',
+                'INFO': 'green',
+                'WARNING': 'yellow',
+                'ERROR': 'red',
+                'CRITICAL': 'red,bg_white',
+            },
+        )
+        file_format = PlainFormatter(fmt="%(asctime)-15s %(threadName)s %(levelname)s %(name)s %(message)s")
 
+    stream_handler = colorlog.StreamHandler()
     stream_handler.setFormatter(stream_handler_format)
     handlers = [
         stream_handler,
-        # RotatingFileHandler(log_dir / 'hamster_kombat_bot.log', maxBytes=log_maxBytes, backupCount=log_backupCount),
     ]
+    if log_file:
+        log_path = log_dir / log_file
+        # every worker process of the supervisor writes a file of its own, rotation is not safe across processes
+        if multiprocessing.parent_process() is not None:
+            process_name = multiprocessing.current_process().name
+            log_path = log_path.with_name(f"{log_path.stem}.{process_name}{log_path.suffix}")
+        file_handler = RotatingFileHandler(log_path, maxBytes=log_maxBytes, backupCount=log_backupCount,
+                                           encoding="utf-8")
+        file_handler.setFormatter(file_format)
+        handlers.append(file_handler)
+    if account_files:
+        # an account runs in one process only, so its file has one writer in the supervisor mode as well
+        account_handler = AccountFileHandler(log_dir / "accounts")
+        account_handler.setFormatter(file_format)
+        handlers.append(account_handler)
 
     # try:
     #     if tg_bot_key is not None and tg_chat_id is not None:
@@ -256,17 +619,55 @@ def setup_logging(
     # except Exception as e:
     #     pass
 
+    if queued:
+        listener = QueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        handlers = [_QueueHandler(listener.queue)]
+    if dedup_interval > 0:
+        # in front of the queue, a dropped record costs the thread that logs it only a lookup
+        list(map(lambda x: x.addFilter(DedupFilter(interval=dedup_interval)), handlers))
+
     logging.basicConfig(format="%(asctime)-15s %(threadName)s %(levelname)s %(name)s %(message)s",
                         level=(logging.DEBUG if is_debug else logging.INFO), handlers=handlers)
 
 
+def _log_error(func, args: tuple, error: APIError):
+    # to the logger of the account when a method of it failed, a step by the name of the method running it
+    log = getattr(args[0], "logger", logger) if args else logger
+    log.error("%s failed: %s", func.__name__.lstrip("_"), error, exc_info=log.isEnabledFor(logging.DEBUG))
+
+
 def handle_error(func):
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except APIError as e:
+                _log_error(func, args, e)
+                return False
+
+        return async_wrapper
+
+    if inspect.isgeneratorfunction(func):
+        # a step of `Account`, the error is raised or thrown into it at the request it yielded
+        @wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            try:
+                return (yield from func(*args, **kwargs))
+            except APIError as e:
+                _log_error(func, args, e)
+                return False
+
+        return generator_wrapper
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except APIError as e:
-            logger.error(e.message, exc_info=True)
+            _log_error(func, args, e)
             return False
 
     return wrapper